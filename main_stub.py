@@ -24,6 +24,9 @@ import typing
 
 import twitchirc
 
+from plugins.helpers.deadline_scheduler import DeadlineScheduler
+from plugins.helpers.outbound import OutboundScheduler
+
 
 class Fake:
     class PluginStorage:
@@ -115,7 +118,7 @@ class Fake:
         def _call_command_handlers(self):
             pass
 
-        def send(self, *args):
+        def send(self, *args, **kwargs):
             pass
 
         def add_command(self, command: str,
@@ -180,6 +183,8 @@ class Fake:
 
     def __init__(self):
         self.bot = Fake.Bot()
+        self.deadlines = DeadlineScheduler(self.make_log_function('deadlines'))
+        self.outbound = OutboundScheduler(lambda data: None, 1)
         self.Base = object
         self.reloadables = {}
 
@@ -0,0 +1,90 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import typing
+from collections import deque
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton, finds which of many literal strings occur in a text in a single pass over it.
+
+    Every word has a value attached to it, `find_all` returns the values of all words found, overlapping ones
+    included.
+    """
+
+    def __init__(self, words: typing.Iterable[typing.Tuple[str, typing.Any]] = ()):
+        self._goto: typing.List[typing.Dict[str, int]] = [{}]
+        self._fail: typing.List[int] = [0]
+        self._own_output: typing.List[typing.Tuple[typing.Any, ...]] = [()]
+        self._output: typing.List[typing.Tuple[typing.Any, ...]] = [()]
+        self._built = False
+        for word, value in words:
+            self.add(word, value)
+        self.build()
+
+    def __len__(self):
+        return sum(len(i) for i in self._own_output)
+
+    def add(self, word: str, value: typing.Any):
+        if not word:
+            raise ValueError('Cannot add an empty word.')
+        state = 0
+        for ch in word:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._own_output.append(())
+                self._goto[state][ch] = next_state
+            state = next_state
+        self._own_output[state] += (value,)
+        self._built = False
+
+    def build(self):
+        """Compute failure links. Needs to be called after adding words, the constructor does it automatically."""
+        self._output = list(self._own_output)
+        todo = deque()
+        for state in self._goto[0].values():
+            self._fail[state] = 0
+            todo.append(state)
+        while todo:
+            state = todo.popleft()
+            for ch, next_state in self._goto[state].items():
+                todo.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                # states are visited in order of depth, so the failure state's output is already complete.
+                self._output[next_state] += self._output[self._fail[next_state]]
+        self._built = True
+
+    def find_all(self, text: str) -> typing.Set[typing.Any]:
+        if not self._built:
+            self.build()
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
@@ -0,0 +1,160 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import sys
+import typing
+
+import twitchirc
+
+# Badges that are stored in CompactMessage.badges, every badge gets a bit. Others are dropped.
+BADGES = [
+    'broadcaster',
+    'moderator',
+    'vip',
+    'subscriber',
+    'founder',
+    'staff',
+    'admin',
+    'global_mod',
+    'partner',
+    'turbo',
+    'premium',
+    'bits',
+]
+BADGE_BITS = {name: 1 << num for num, name in enumerate(BADGES)}
+# Tags kept as they were, besides user-id and tmi-sent-ts which have their own fields. Others (emotes, flags, turbo,
+# ...) are dropped.
+KEPT_FLAGS = ('badge-info', 'badges', 'color', 'display-name', 'id', 'room-id')
+_UNIQUE_FLAGS = ('id',)  # not worth interning
+
+
+def badges_to_bits(badges: typing.Union[str, typing.List[str]]) -> int:
+    bits = 0
+    for i in (badges if isinstance(badges, list) else [badges]):
+        bits |= BADGE_BITS.get(i.split('/', 1)[0], 0)
+    return bits
+
+
+def _pack_flag(name: str, value: typing.Union[str, typing.List[str], None]) -> typing.Optional[str]:
+    if value is None:
+        return None
+    value = ','.join(value) if isinstance(value, list) else value
+    return value if name in _UNIQUE_FLAGS else sys.intern(value)
+
+
+def _unpack_flag(value: str) -> typing.Union[str, typing.List[str]]:
+    # same as twitchirc does when parsing tags
+    return value.split(',') if ',' in value else value
+
+
+class CompactMessage:
+    """
+    Small, read-only version of a chat message, to be kept in caches.
+
+    Holds the user name, user id, text, timestamp, a bitfield of badges for quick checks and the tags listed in
+    KEPT_FLAGS. Use `message` to get a ChannelMessage back, it has those tags, `user-id` and `tmi-sent-ts`.
+    """
+    __slots__ = ('user', 'user_id', 'text', 'timestamp', 'badges', 'channel', 'flags')
+
+    def __init__(self, user: str, user_id: typing.Optional[int], text: str, timestamp: float, badges: int,
+                 channel: str, flags: typing.Tuple[typing.Optional[str], ...] = ()):
+        self.user = user
+        self.user_id = user_id
+        self.text = text
+        self.timestamp = timestamp
+        self.badges = badges
+        self.channel = channel
+        self.flags = flags  # values of KEPT_FLAGS, in the same order, None if missing
+
+    @staticmethod
+    def from_message(message: twitchirc.ChannelMessage, timestamp: float) -> 'CompactMessage':
+        user_id = message.flags.get('user-id')
+        return CompactMessage(
+            user=sys.intern(message.user),
+            user_id=int(user_id) if user_id else None,
+            text=message.text,
+            timestamp=timestamp,
+            badges=badges_to_bits(message.flags.get('badges', '')),
+            channel=sys.intern(message.channel),
+            flags=tuple(_pack_flag(name, message.flags.get(name)) for name in KEPT_FLAGS)
+        )
+
+    def has_badge(self, badge: str) -> bool:
+        return bool(self.badges & BADGE_BITS[badge])
+
+    @property
+    def message(self) -> twitchirc.ChannelMessage:
+        """Rebuild a ChannelMessage from this record. This creates a new object every time."""
+        msg = twitchirc.ChannelMessage(text=self.text, user=self.user, channel=self.channel)
+        msg.flags = {name: _unpack_flag(value) for name, value in zip(KEPT_FLAGS, self.flags) if value is not None}
+        msg.flags['user-id'] = str(self.user_id) if self.user_id is not None else ''
+        msg.flags['tmi-sent-ts'] = str(round(self.timestamp * 1000))
+        return msg
+
+    def __repr__(self):
+        return (f'CompactMessage(user={self.user!r}, user_id={self.user_id!r}, text={self.text!r}, '
+                f'timestamp={self.timestamp!r}, badges={self.badges!r}, channel={self.channel!r}, '
+                f'flags={self.flags!r})')
+
+
+def _benchmark(count=100_000):
+    """Compare memory used by `count` cached ChannelMessages against `count` CompactMessages."""
+    import gc
+    import random
+    import time
+    import tracemalloc
+
+    now = time.time()
+    users = [(f'user{i}', 1000 + i) for i in range(2000)]
+
+    def _raw(num):
+        user, user_id = random.choice(users)
+        ts = int((now + num) * 1000)
+        # the message needs a unique text, otherwise every object would share a single string
+        return (f'@badge-info=subscriber/14;badges=subscriber/12,premium/1;color=#FF0000;display-name={user};'
+                f'emotes=;flags=;id=3a51b0f4-7a3d-4c84-a1c2-{num:012d};mod=0;room-id=117691339;subscriber=1;'
+                f'tmi-sent-ts={ts};turbo=0;user-id={user_id};user-type= '
+                f':{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #channel :message number {num} Kappa')
+
+    def _measure(make):
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        objects = [make(num) for num in range(count)]
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        size = sum(i.size_diff for i in after.compare_to(before, 'filename'))
+        del objects
+        return size
+
+    def _make_full(num):
+        msg = twitchirc.auto_message(_raw(num))
+        return msg, int(msg.flags['tmi-sent-ts']) / 1000
+
+    def _make_compact(num):
+        msg = twitchirc.auto_message(_raw(num))
+        return CompactMessage.from_message(msg, int(msg.flags['tmi-sent-ts']) / 1000)
+
+    full = _measure(_make_full)
+    compact = _measure(_make_compact)
+    print(f'{count} messages')
+    print(f'ChannelMessage: {full / 1024 / 1024:.2f} MiB ({full / count:.0f} B/message)')
+    print(f'CompactMessage: {compact / 1024 / 1024:.2f} MiB ({compact / count:.0f} B/message)')
+    print(f'Ratio: {full / compact:.2f}x')
+
+
+if __name__ == '__main__':
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,119 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import math
+import threading
+import time
+import traceback
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+
+MAX_WORKERS = 4
+# Jobs that can wait or run at once, `submit` refuses new ones after that.
+MAX_PENDING = 64
+
+
+class CommandStats:
+    __slots__ = ('name', 'calls', 'rejected', 'errors', 'total_time', 'max_time', 'wait_time')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.rejected = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.wait_time = 0.0
+
+    def add(self, wait_time: float, total_time: float):
+        self.calls += 1
+        self.wait_time += wait_time
+        self.total_time += total_time
+        if total_time > self.max_time:
+            self.max_time = total_time
+
+    def to_json(self) -> dict:
+        return {
+            'name': self.name,
+            'calls': self.calls,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'avg_time': self.total_time / self.calls if self.calls else 0.0,
+            'avg_wait_time': self.wait_time / self.calls if self.calls else 0.0,
+            'max_time': self.max_time
+        }
+
+    def __repr__(self):
+        return (f'CommandStats(name={self.name!r}, calls={self.calls!r}, rejected={self.rejected!r}, '
+                f'errors={self.errors!r}, total_time={self.total_time!r}, max_time={self.max_time!r}, '
+                f'wait_time={self.wait_time!r})')
+
+
+class DBExecutor:
+    """
+    Run blocking database work on a fixed number of threads.
+
+    At most `max_pending` jobs can wait or run at once, after that `submit` returns None and the caller should tell
+    the client to try again later. Latency, from submitting to finishing, is kept per name, see `stats`.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, max_pending: int = MAX_PENDING, log=None):
+        self.log = log if log is not None else (lambda level, *data: print(level, *data))
+        self.max_pending = max_pending
+        self.pending = 0
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix='db_executor')
+        self._lock = threading.Lock()
+        self._stats: typing.Dict[str, CommandStats] = {}
+
+    def _get_stats(self, name: str) -> CommandStats:
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = CommandStats(name)
+            self._stats[name] = stats
+        return stats
+
+    def submit(self, name: str, function, *args, **kwargs) -> typing.Optional[Future]:
+        """Run `function(*args, **kwargs)` on the pool. Returns None if too many jobs are waiting."""
+        with self._lock:
+            stats = self._get_stats(name)
+            if self.pending >= self.max_pending:
+                stats.rejected += 1
+                return None
+            self.pending += 1
+        return self._pool.submit(self._run, stats, time.monotonic(), function, args, kwargs)
+
+    def _run(self, stats: CommandStats, submitted: float, function, args, kwargs):
+        start = time.monotonic()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            stats.errors += 1
+            self.log('err', f'Error while running database job {stats.name}')
+            for i in traceback.format_exc().split('\n'):
+                self.log('err', i)
+            raise
+        finally:
+            with self._lock:
+                self.pending -= 1
+                stats.add(start - submitted, time.monotonic() - submitted)
+
+    def stats(self) -> typing.List[CommandStats]:
+        """Return statistics for every name, the most expensive first."""
+        with self._lock:
+            stats = list(self._stats.values())
+        return sorted(stats, key=lambda i: i.total_time, reverse=True)
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait)
@@ -0,0 +1,282 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import select
+import threading
+import time
+import traceback
+import typing
+
+# Longest time `poll` will wait for, even if nothing is scheduled.
+MAX_SLEEP = 5.0
+
+
+class TaskStats:
+    __slots__ = ('name', 'runs', 'total_time', 'max_time', 'errors')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.runs = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.errors = 0
+
+    def add(self, run_time: float):
+        self.runs += 1
+        self.total_time += run_time
+        if run_time > self.max_time:
+            self.max_time = run_time
+
+    def __repr__(self):
+        return (f'TaskStats(name={self.name!r}, runs={self.runs!r}, total_time={self.total_time!r}, '
+                f'max_time={self.max_time!r}, errors={self.errors!r})')
+
+
+class Task:
+    __slots__ = ('function', 'args', 'kwargs', 'priority', 'interval', 'deadline', 'cancelled', 'stats', 'seq')
+
+    def __init__(self, function, args, kwargs, priority, interval, deadline, stats):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.interval = interval
+        self.deadline = deadline
+        self.cancelled = False
+        self.stats: TaskStats = stats
+        self.seq = -1  # number of the task's current heap entry
+
+    @property
+    def name(self):
+        return self.stats.name
+
+    def __repr__(self):
+        return (f'<Task {self.name} at {self.deadline}{f", every {self.interval}s" if self.interval else ""}'
+                f'{", cancelled" if self.cancelled else ""}>')
+
+
+class DeadlineScheduler:
+    """
+    Run tasks at their deadlines and wait for I/O in between.
+
+    Deadlines are kept in a min-heap, `poll` sleeps in `select` until the earliest deadline or until one of the readers
+    has data. Tasks can be moved using `reschedule` and `wake`, the old heap entries are skipped when they come up.
+    All times are `time.monotonic()`. Tasks and readers are run on the thread calling `poll`, other threads can add
+    or wake tasks, `poll` gets woken up through a pipe when that happens.
+
+    Run times are collected per task name, see `stats`.
+    """
+
+    def __init__(self, log=None):
+        self.log = log if log is not None else (lambda level, *data: print(level, *data))
+        self._heap: typing.List[typing.Tuple[float, int, int, Task]] = []
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+        self._stats: typing.Dict[str, TaskStats] = {}
+        self._readers: typing.Dict[typing.Any, typing.Tuple[typing.Callable[[], typing.Any], TaskStats]] = {}
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self._poll_thread = None
+        self._waiting = False  # True while `wait` is waiting, the poll thread can wake it up too
+
+    def _get_stats(self, name: str) -> TaskStats:
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = TaskStats(name)
+            self._stats[name] = stats
+        return stats
+
+    def _push(self, task: Task):
+        task.seq = next(self._counter)
+        heapq.heappush(self._heap, (task.deadline, task.priority, task.seq, task))
+        self._push_wakeup()
+
+    def call_at(self, deadline: float, function, args: tuple = (), kwargs: typing.Optional[dict] = None,
+                priority: int = 100, name: typing.Optional[str] = None, interval: typing.Optional[float] = None) -> Task:
+        """
+        Run `function` at `deadline` (`time.monotonic()`).
+
+        :param priority: Tasks with the same deadline run in order of priority, lowest first.
+        :param name: Name used for the statistics, defaults to the qualified name of the function.
+        :param interval: Repeat every `interval` seconds.
+
+        `deadline` can be `math.inf`, the task will only run after it's woken up.
+        """
+        if name is None:
+            name = getattr(function, '__qualname__', repr(function))
+        with self._lock:
+            task = Task(function, args, kwargs or {}, priority, interval, deadline, self._get_stats(name))
+            if deadline != math.inf:
+                self._push(task)
+        return task
+
+    def call_later(self, delay: float, function, args: tuple = (), kwargs: typing.Optional[dict] = None,
+                   **kw) -> Task:
+        return self.call_at(time.monotonic() + delay, function, args, kwargs, **kw)
+
+    def call_every(self, interval: float, function, args: tuple = (), kwargs: typing.Optional[dict] = None,
+                   delay: typing.Optional[float] = None, **kw) -> Task:
+        """Run `function` every `interval` seconds, first in `delay` seconds, which defaults to `interval`."""
+        return self.call_later(interval if delay is None else delay, function, args, kwargs, interval=interval, **kw)
+
+    def reschedule(self, task: Task, deadline: float):
+        """Move `task` to `deadline`. `math.inf` parks it until it's rescheduled or woken up."""
+        with self._lock:
+            task.deadline = deadline
+            task.cancelled = False
+            if deadline == math.inf:
+                task.seq = -1
+            else:
+                self._push(task)
+
+    def wake(self, task: Task):
+        """Run `task` as soon as possible, unless it's already due. Tasks that ran once can be woken up again."""
+        now = time.monotonic()
+        with self._lock:
+            if task.deadline > now and not task.cancelled:
+                self.reschedule(task, now)
+
+    def cancel(self, task: Task):
+        with self._lock:
+            task.cancelled = True
+
+    def add_reader(self, file, callback: typing.Callable[[], typing.Any], name: typing.Optional[str] = None):
+        """Call `callback` when `file` (anything with a `fileno()` or a file descriptor) has data to read."""
+        if name is None:
+            name = getattr(callback, '__qualname__', repr(callback))
+        with self._lock:
+            self._readers[file] = (callback, self._get_stats(name))
+        self._push_wakeup()
+
+    def remove_reader(self, file):
+        with self._lock:
+            self._readers.pop(file, None)
+
+    def _push_wakeup(self):
+        if self._poll_thread is not None and (self._waiting or threading.get_ident() != self._poll_thread):
+            try:
+                os.write(self._wakeup_write, b'\0')
+            except BlockingIOError:  # the pipe is full, poll will wake up anyway.
+                pass
+
+    def _is_stale(self, entry) -> bool:
+        task = entry[3]
+        return task.cancelled or task.seq != entry[2]
+
+    def timeout(self, max_timeout: float = MAX_SLEEP) -> float:
+        """Return the time until the next deadline, at most `max_timeout`."""
+        with self._lock:
+            while self._heap and self._is_stale(self._heap[0]):
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return max_timeout
+            return min(max(self._heap[0][0] - time.monotonic(), 0.0), max_timeout)
+
+    def _run(self, function, args, kwargs, stats: TaskStats):
+        start = time.perf_counter()
+        try:
+            function(*args, **kwargs)
+        except Exception:
+            stats.errors += 1
+            self.log('err', f'Error while running scheduled task {stats.name}')
+            for i in traceback.format_exc().split('\n'):
+                self.log('err', i)
+        finally:
+            stats.add(time.perf_counter() - start)
+
+    def run_due(self):
+        """Run all tasks that are due. Tasks scheduled while running these are left for the next call."""
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                if self._is_stale(entry):
+                    continue
+                task = entry[3]
+                if task.interval is not None:
+                    task.deadline = task.deadline + task.interval
+                    if task.deadline <= now:  # don't try to catch up on missed runs
+                        task.deadline = now + task.interval
+                    self._push(task)
+                else:
+                    task.deadline = math.inf
+                    task.seq = -1
+                due.append(task)
+        for task in due:
+            if task.cancelled:
+                continue
+            self._run(task.function, task.args, task.kwargs, task.stats)
+
+    async def wait(self, files: typing.Sequence = (), max_timeout: float = MAX_SLEEP):
+        """
+        Wait like `poll` does, but in the asyncio event loop, so that its other tasks and servers keep running.
+        Nothing is run, call `poll` with `max_timeout=0` afterwards.
+        """
+        loop = asyncio.get_event_loop()
+        ready = loop.create_future()
+
+        def _set_ready():
+            if not ready.done():
+                ready.set_result(None)
+
+        with self._lock:
+            watched = [*files, self._wakeup_read, *self._readers]
+        for file in watched:
+            loop.add_reader(file, _set_ready)
+        self._poll_thread = threading.get_ident()
+        self._waiting = True
+        try:
+            await asyncio.wait([ready], timeout=self.timeout(max_timeout))
+        finally:
+            self._waiting = False
+            for file in watched:
+                loop.remove_reader(file)
+
+    def poll(self, files: typing.Sequence = (), max_timeout: float = MAX_SLEEP) -> typing.List:
+        """
+        Wait until the next deadline, or until one of `files` or the readers has data. Then run the readers that are
+        ready and all tasks that are due.
+
+        :return: Elements of `files` that have data to read.
+        """
+        self._poll_thread = threading.get_ident()
+        with self._lock:
+            readers = list(self._readers)
+        ready = select.select([*files, self._wakeup_read, *readers], [], [], self.timeout(max_timeout))[0]
+        if self._wakeup_read in ready:
+            try:
+                while os.read(self._wakeup_read, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        for file in ready:
+            reader = self._readers.get(file)
+            if reader is not None:
+                self._run(reader[0], (), {}, reader[1])
+        self.run_due()
+        return [i for i in ready if i in files]
+
+    def stats(self) -> typing.List[TaskStats]:
+        """Return statistics for all tasks and readers, the most expensive first."""
+        with self._lock:
+            stats = list(self._stats.values())
+        return sorted(stats, key=lambda i: i.total_time, reverse=True)
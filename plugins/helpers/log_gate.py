@@ -0,0 +1,113 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import time
+import typing
+
+LEVELS = {
+    'debug': -1,
+    'info': 0,
+    'warn': 1,
+    'WARN': 2,
+    'err': 3,
+    'fat': 10
+}
+# Lines at this level or above are never dropped.
+ALWAYS_ENABLED = LEVELS['err']
+# Rate limits only apply below this level.
+RATE_LIMITED_BELOW = LEVELS['warn']
+
+
+class RateLimit:
+    __slots__ = ('lines', 'per', 'window_end', 'count', 'suppressed')
+
+    def __init__(self, lines: int, per: float):
+        self.lines = lines
+        self.per = per
+        self.window_end = 0.0
+        self.count = 0
+        self.suppressed = 0
+
+    def take(self, now: float) -> bool:
+        if now >= self.window_end:
+            self.window_end = now + self.per
+            self.count = 0
+        if self.count < self.lines:
+            self.count += 1
+            return True
+        self.suppressed += 1
+        return False
+
+    def __repr__(self):
+        return f'<RateLimit {self.lines}/{self.per}s, {self.suppressed} suppressed>'
+
+
+class LogGate:
+    """
+    Decide which log lines are worth formatting, before anything is formatted.
+
+    Every source has a minimum level, the default is used for sources that don't have one. Sources can have a rate
+    limit for lines below `warn`, lines over it are counted, `take_suppressed` returns the count so that the next
+    line that gets through can mention it. Errors always get through.
+    """
+
+    def __init__(self, default_level: str = 'debug', levels: typing.Optional[typing.Dict[str, str]] = None,
+                 rate_limits: typing.Optional[typing.Dict[str, typing.Tuple[int, float]]] = None):
+        self.default_level = LEVELS[default_level]
+        self.levels: typing.Dict[str, int] = {}
+        self.rate_limits: typing.Dict[str, RateLimit] = {}
+        for source, level in (levels or {}).items():
+            self.set_level(source, level)
+        for source, (lines, per) in (rate_limits or {}).items():
+            self.set_rate_limit(source, lines, per)
+
+    def set_level(self, source: str, level: typing.Optional[str]):
+        """Set the minimum level for `source`, None resets it to the default."""
+        if level is None:
+            self.levels.pop(source, None)
+        else:
+            self.levels[source] = LEVELS[level]
+
+    def set_rate_limit(self, source: str, lines: typing.Optional[int], per: float = 1.0):
+        """Allow at most `lines` lines per `per` seconds from `source`, None removes the limit."""
+        if lines is None:
+            self.rate_limits.pop(source, None)
+        else:
+            self.rate_limits[source] = RateLimit(lines, per)
+
+    def is_enabled(self, level: typing.Union[str, int], source: str) -> bool:
+        value = level if isinstance(level, int) else LEVELS[level]
+        return value >= ALWAYS_ENABLED or value >= self.levels.get(source, self.default_level)
+
+    def allow(self, level: typing.Union[str, int], source: str) -> bool:
+        """Like `is_enabled`, but also counts the line against the rate limit of `source`."""
+        value = level if isinstance(level, int) else LEVELS[level]
+        if value >= ALWAYS_ENABLED:
+            return True
+        if value < self.levels.get(source, self.default_level):
+            return False
+        limit = self.rate_limits.get(source)
+        if limit is None or value >= RATE_LIMITED_BELOW:
+            return True
+        return limit.take(time.monotonic())
+
+    def take_suppressed(self, source: str) -> int:
+        """Return and reset the number of lines from `source` dropped by its rate limit."""
+        limit = self.rate_limits.get(source)
+        if limit is None or not limit.suppressed:
+            return 0
+        suppressed = limit.suppressed
+        limit.suppressed = 0
+        return suppressed
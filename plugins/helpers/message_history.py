@@ -0,0 +1,139 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import bisect
+import heapq
+import itertools
+import typing
+
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.compact_message import CompactMessage
+except ImportError:
+    from plugins.helpers.compact_message import CompactMessage
+
+
+class MessageHistory:
+    """
+    Bounded message history of a channel, ordered by timestamp, with an index of messages by user.
+
+    Entries are kept in sorted lists, so a time window can be found using bisect. The oldest entry is evicted when the
+    history grows over `max_length`, this is amortized O(1): evicted entries are only cut off the front of the lists
+    once they make up half of them.
+
+    Messages older than the newest entry (ex. ones loaded from recent-messages after live chat started coming in) are
+    put in a heap instead of being inserted in the middle of the lists. The heap is merged in when the history is
+    read, so adding k such messages costs O(k log k + n) instead of O(k * n).
+    """
+    COMPACT_THRESHOLD = 64
+
+    def __init__(self, max_length: typing.Optional[int] = None, index_users=True):
+        self.max_length = max_length
+        self._timestamps: typing.List[float] = []
+        self._messages: typing.List[typing.Optional[CompactMessage]] = []
+        self._start = 0  # entries before this index were evicted, see `_compact`
+        # (timestamp, arrival number, message), the arrival number keeps equal timestamps in order.
+        self._late: typing.List[typing.Tuple[float, int, CompactMessage]] = []
+        self._arrivals = itertools.count()
+        self.users: typing.Optional[typing.Dict[str, 'MessageHistory']] = {} if index_users else None
+
+    def __len__(self):
+        return len(self._timestamps) - self._start + len(self._late)
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[CompactMessage, float]]:
+        self._merge_late()
+        for i in range(self._start, len(self._timestamps)):
+            yield self._messages[i], self._timestamps[i]
+
+    def add(self, message: CompactMessage, timestamp: float):
+        if len(self._timestamps) == self._start or self._timestamps[-1] <= timestamp:
+            # messages usually arrive in order
+            self._timestamps.append(timestamp)
+            self._messages.append(message)
+        else:
+            heapq.heappush(self._late, (timestamp, next(self._arrivals), message))
+
+        if self.users is not None:
+            if message.user not in self.users:
+                self.users[message.user] = MessageHistory(index_users=False)
+            self.users[message.user].add(message, timestamp)
+        self.trim()
+
+    def trim(self):
+        while self.max_length is not None and len(self) > self.max_length:
+            self.pop_oldest()
+
+    def pop_oldest(self) -> typing.Tuple[CompactMessage, float]:
+        if self._late and (len(self._timestamps) == self._start or self._late[0][0] < self._timestamps[self._start]):
+            timestamp, _, message = heapq.heappop(self._late)
+        else:
+            message = self._messages[self._start]
+            timestamp = self._timestamps[self._start]
+            self._messages[self._start] = None
+            self._start += 1
+            self._compact()
+
+        if self.users is not None:
+            user_history = self.users[message.user]
+            user_history._remove(message, timestamp)
+            if not len(user_history):
+                del self.users[message.user]
+        return message, timestamp
+
+    def _remove(self, message: CompactMessage, timestamp: float):
+        """Remove `message`, usually the oldest entry, which is cheap."""
+        self._merge_late()
+        if self._messages[self._start] is message:
+            self.pop_oldest()
+            return
+        # don't depend on both histories ordering messages with equal timestamps the same way
+        pos = bisect.bisect_left(self._timestamps, timestamp, lo=self._start)
+        while self._messages[pos] is not message:
+            pos += 1
+        del self._timestamps[pos]
+        del self._messages[pos]
+
+    def _merge_late(self):
+        if not self._late:
+            return
+        late = sorted(self._late)
+        self._late = []
+        # on equal timestamps entries that were already in the lists go first, like with bisect.insort_right
+        merged = list(heapq.merge(
+            ((self._timestamps[i], 0, i, self._messages[i]) for i in range(self._start, len(self._timestamps))),
+            ((timestamp, 1, arrival, message) for timestamp, arrival, message in late),
+            key=lambda entry: entry[:3]
+        ))
+        self._timestamps = [entry[0] for entry in merged]
+        self._messages = [entry[3] for entry in merged]
+        self._start = 0
+
+    def _compact(self):
+        if self._start > self.COMPACT_THRESHOLD and self._start * 2 > len(self._timestamps):
+            del self._timestamps[:self._start]
+            del self._messages[:self._start]
+            self._start = 0
+
+    def between(self, min_timestamp: typing.Optional[float] = None,
+                max_timestamp: typing.Optional[float] = None) -> typing.List[CompactMessage]:
+        """Return messages sent after `min_timestamp` and before `max_timestamp`, both ends are exclusive."""
+        self._merge_late()
+        low = self._start
+        if min_timestamp is not None:
+            low = bisect.bisect_right(self._timestamps, min_timestamp, lo=low)
+        high = len(self._timestamps)
+        if max_timestamp is not None:
+            high = bisect.bisect_left(self._timestamps, max_timestamp, lo=low)
+        return self._messages[low:high]
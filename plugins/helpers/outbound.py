@@ -0,0 +1,260 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import math
+import threading
+import time
+import typing
+from collections import OrderedDict, deque
+
+# Priority classes, lower goes first.
+PRIORITY_MODERATION = 0
+PRIORITY_REPLY = 1
+PRIORITY_SPAM = 2
+PRIORITY_NAMES = {
+    PRIORITY_MODERATION: 'moderation',
+    PRIORITY_REPLY: 'reply',
+    PRIORITY_SPAM: 'spam',
+}
+# Global tokens that lower priority messages can't use, so that moderation actions and replies don't have to wait
+# for a pyramid to finish.
+GLOBAL_RESERVE = {
+    PRIORITY_MODERATION: 0,
+    PRIORITY_REPLY: 0,
+    PRIORITY_SPAM: 5,
+}
+MODERATION_COMMANDS = ('/timeout', '/ban', '/unban', '/untimeout', '/delete', '/clear')
+
+# Twitch's limits: messages per 30 seconds, globally, for channels where the bot isn't a moderator or VIP and for all
+# channels. In channels where the bot is a moderator or VIP only the second limit applies.
+GLOBAL_LIMIT = (20, 30)
+ELEVATED_GLOBAL_LIMIT = (100, 30)
+# Messages per seconds in a single channel. The limit for normal users is `message_cooldown` of the bot.
+ELEVATED_CHANNEL_LIMIT = (100, 30)
+
+# queue used for things that aren't chat messages, it's only limited by the global buckets.
+MISC_QUEUE = 'misc'
+
+
+class TokenBucket:
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, capacity: float, per: float):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float, reserve: float = 0) -> float:
+        """Return how long to wait until a token can be taken, leaving `reserve` tokens in the bucket."""
+        self._refill(now)
+        missing = 1 + reserve - self.tokens
+        if missing <= 0:
+            return 0.0
+        if reserve + 1 > self.capacity:
+            return math.inf
+        return missing / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def __repr__(self):
+        return f'<TokenBucket {self.tokens:.2f}/{self.capacity} +{self.rate:.2f}/s>'
+
+
+QueuedMessage = typing.Tuple[bytes, typing.Any, typing.Optional[typing.Callable[[], typing.Any]]]
+
+
+class OutboundScheduler:
+    """
+    Send queued messages as fast as Twitch's limits allow.
+
+    Every channel has a token bucket, every message also takes a token from the global buckets. Messages are sent in
+    order of priority (see PRIORITY_*), channels with the same priority take turns. If nothing can be sent `flush`
+    returns the time to wait for, the bot wakes up exactly then.
+
+    Messages can have a tag, to count or cancel them together, and a function to call once they were sent.
+    """
+
+    def __init__(self, send: typing.Callable[[bytes], typing.Any], message_cooldown: float):
+        self._send = send
+        self.message_cooldown = message_cooldown
+        # channel: [queue of (data, tag, on_sent) for every priority class], ordered by which channel should go next.
+        self.queues: typing.Dict[str, typing.List[typing.Deque[QueuedMessage]]] = OrderedDict()
+        self.channel_buckets: typing.Dict[str, TokenBucket] = {}
+        self.elevated: typing.Set[str] = set()
+        self.global_bucket = TokenBucket(*GLOBAL_LIMIT)
+        self.elevated_global_bucket = TokenBucket(*ELEVATED_GLOBAL_LIMIT)
+        self.sent = {i: 0 for i in PRIORITY_NAMES}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def classify(data: bytes) -> int:
+        text = data.split(b' :', 1)[1] if b' :' in data else b''
+        if text.startswith(tuple(i.encode() for i in MODERATION_COMMANDS)):
+            return PRIORITY_MODERATION
+        return PRIORITY_REPLY
+
+    def _get_channel_bucket(self, channel: str) -> TokenBucket:
+        bucket = self.channel_buckets.get(channel)
+        if bucket is None:
+            if channel in self.elevated:
+                bucket = TokenBucket(*ELEVATED_CHANNEL_LIMIT)
+            else:
+                bucket = TokenBucket(1, self.message_cooldown)
+            self.channel_buckets[channel] = bucket
+        return bucket
+
+    def set_elevated(self, channel: str, elevated: bool):
+        """Mark `channel` as one where the bot is (or isn't) a moderator or VIP, this changes its limits."""
+        with self._lock:
+            if (channel in self.elevated) == elevated:
+                return
+            if elevated:
+                self.elevated.add(channel)
+            else:
+                self.elevated.discard(channel)
+            self.channel_buckets.pop(channel, None)
+
+    def enqueue(self, channel: str, data: bytes, priority: typing.Optional[int] = None, tag=None,
+                on_sent: typing.Optional[typing.Callable[[], typing.Any]] = None):
+        """
+        :param tag: Anything, see `pending` and `cancel`.
+        :param on_sent: Called after the message was sent, on the thread calling `flush`.
+        """
+        if priority is None:
+            priority = self.classify(data)
+        with self._lock:
+            queues = self.queues.get(channel)
+            if queues is None:
+                queues = [deque() for _ in PRIORITY_NAMES]
+                self.queues[channel] = queues
+            queues[priority].append((data, tag, on_sent))
+
+    def pending(self, channel: typing.Optional[str] = None, priority: typing.Optional[int] = None,
+                tag=None) -> int:
+        """Return the number of waiting messages, only for `channel`, `priority` and `tag` if given."""
+        with self._lock:
+            if channel is not None:
+                channels = [self.queues[channel]] if channel in self.queues else []
+            else:
+                channels = self.queues.values()
+            if priority is not None:
+                selected = [queues[priority] for queues in channels]
+            else:
+                selected = [q for queues in channels for q in queues]
+            if tag is not None:
+                return sum(1 for q in selected for message in q if message[1] is tag)
+            return sum(len(q) for q in selected)
+
+    def cancel(self, tag) -> int:
+        """Drop all waiting messages with `tag`. Returns the number of dropped messages."""
+        dropped = 0
+        with self._lock:
+            for channel, queues in list(self.queues.items()):
+                for num, q in enumerate(queues):
+                    kept = deque(message for message in q if message[1] is not tag)
+                    dropped += len(q) - len(kept)
+                    queues[num] = kept
+                if not any(queues):
+                    del self.queues[channel]
+        return dropped
+
+    def _wait_time(self, channel: str, priority: int, now: float) -> float:
+        reserve = GLOBAL_RESERVE[priority]
+        wait = self.elevated_global_bucket.wait_time(now, reserve)
+        if channel == MISC_QUEUE or channel not in self.elevated:
+            wait = max(wait, self.global_bucket.wait_time(now, reserve))
+        if channel != MISC_QUEUE:
+            wait = max(wait, self._get_channel_bucket(channel).wait_time(now))
+        return wait
+
+    def _take(self, channel: str, now: float):
+        self.elevated_global_bucket.take(now)
+        if channel == MISC_QUEUE or channel not in self.elevated:
+            self.global_bucket.take(now)
+        if channel != MISC_QUEUE:
+            self._get_channel_bucket(channel).take(now)
+
+    def flush(self, max_messages: int = 1000) -> typing.Tuple[int, float]:
+        """
+        Send as many messages as the limits allow, at most `max_messages`.
+
+        :return: Number of messages sent and the time to wait until more can be sent. The time is `math.inf` if no
+        messages are waiting.
+
+        If sending raises the message stays at the front of its queue and the exception is re-raised.
+        """
+        sent = 0
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                wait = math.inf
+                picked = None
+                for priority in PRIORITY_NAMES:
+                    for channel, queues in self.queues.items():
+                        if not queues[priority]:
+                            continue
+                        channel_wait = self._wait_time(channel, priority, now)
+                        if channel_wait <= 0:
+                            picked = channel, priority
+                            break
+                        wait = min(wait, channel_wait)
+                    if picked is not None:
+                        break
+                if picked is None or sent >= max_messages:
+                    if picked is not None:
+                        wait = 0.0
+                    return sent, wait
+
+                channel, priority = picked
+                queues = self.queues[channel]
+                self._take(channel, now)
+                message = queues[priority].popleft()
+                data, _, on_sent = message
+                try:
+                    self._send(data)
+                except Exception:
+                    queues[priority].appendleft(message)  # keep the order, it's tried again on the next flush
+                    raise
+                self.sent[priority] += 1
+                sent += 1
+                if on_sent is not None:
+                    on_sent()
+                if any(queues):
+                    self.queues.move_to_end(channel)  # let other channels go first
+                else:
+                    del self.queues[channel]
+
+    def drain(self, timeout: float) -> bool:
+        """
+        Send all waiting messages, sleeping in between if necessary. Blocks for up to `timeout` seconds.
+
+        :return: True if everything was sent.
+        """
+        end = time.monotonic() + timeout
+        while True:
+            _, wait = self.flush()
+            if wait == math.inf:
+                return True
+            if time.monotonic() + wait > end:
+                return False
+            time.sleep(wait)
@@ -0,0 +1,144 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import threading
+import time
+import typing
+from collections import OrderedDict
+
+import regex
+
+# Maximum time a single match call can take, in seconds.
+REGEX_TIMEOUT = 0.05
+# Patterns that time out this many times are marked as bad.
+BAD_AFTER_TIMEOUTS = 3
+# Patterns marked as bad get another chance after this many seconds.
+BAD_EXPIRE_TIME = 60 * 60
+# Number of patterns to keep statistics for, the least recently used ones are forgotten first.
+MAX_TRACKED_PATTERNS = 1000
+
+_REGEX_PATTERN_TYPE = type(regex.compile(''))
+
+
+class PatternStats:
+    __slots__ = ('source', 'pattern', 'calls', 'cpu_time', 'timeouts', 'bad_until')
+
+    def __init__(self, source: str, pattern: str):
+        self.source = source
+        self.pattern = pattern
+        self.calls = 0
+        self.cpu_time = 0.0
+        self.timeouts = 0
+        self.bad_until: typing.Optional[float] = None  # time.monotonic() value
+
+    @property
+    def bad(self) -> bool:
+        return self.bad_until is not None and self.bad_until > time.monotonic()
+
+    def forgive(self):
+        self.timeouts = 0
+        self.bad_until = None
+
+    def __repr__(self):
+        return (f'PatternStats(source={self.source!r}, pattern={self.pattern!r}, calls={self.calls!r}, '
+                f'cpu_time={self.cpu_time!r}, timeouts={self.timeouts!r}, bad={self.bad!r})')
+
+
+class RegexBudget:
+    """
+    Run user supplied patterns with a time limit and keep track of how expensive they are.
+
+    Every call to `run` gets `timeout` seconds, if that isn't enough `TimeoutError` is raised. After `bad_after`
+    timeouts the pattern is marked as bad for `bad_expire_time` seconds, callers should check `is_bad` and not use it
+    until then. Functions in `on_bad` are called with the pattern's `PatternStats` when it gets marked.
+    """
+
+    def __init__(self, timeout: float = REGEX_TIMEOUT, bad_after: int = BAD_AFTER_TIMEOUTS,
+                 max_patterns: int = MAX_TRACKED_PATTERNS, bad_expire_time: float = BAD_EXPIRE_TIME):
+        self.timeout = timeout
+        self.bad_after = bad_after
+        self.max_patterns = max_patterns
+        self.bad_expire_time = bad_expire_time
+        self.on_bad: typing.List[typing.Callable[[PatternStats], typing.Any]] = []
+        self._stats: typing.Dict[typing.Tuple[str, str], PatternStats] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_stats(self, source: str, pattern) -> PatternStats:
+        key = (source, pattern.pattern)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = PatternStats(source, pattern.pattern)
+                self._stats[key] = stats
+                if len(self._stats) > self.max_patterns:
+                    self._stats.popitem(last=False)
+            else:
+                self._stats.move_to_end(key)
+            return stats
+
+    def run(self, source: str, pattern, method: str, *args, **kwargs):
+        """
+        Call `pattern.method(*args, **kwargs)` with a time limit.
+
+        :param source: What the pattern is used for, ex. 'ban_phrase'.
+        :param pattern: Compiled pattern. Only patterns from the `regex` module support time limits.
+        :param method: Name of the method to call, ex. 'search'.
+        :raises TimeoutError: if the call took too long.
+        """
+        stats = self._get_stats(source, pattern)
+        if stats.bad_until is not None and not stats.bad:
+            stats.forgive()  # the mark expired
+        if isinstance(pattern, _REGEX_PATTERN_TYPE):
+            kwargs['timeout'] = self.timeout
+        start = time.thread_time()
+        try:
+            return getattr(pattern, method)(*args, **kwargs)
+        except TimeoutError:
+            stats.timeouts += 1
+            if stats.timeouts >= self.bad_after and stats.bad_until is None:
+                stats.bad_until = time.monotonic() + self.bad_expire_time
+                for handler in self.on_bad:
+                    handler(stats)
+            raise
+        finally:
+            stats.calls += 1
+            stats.cpu_time += time.thread_time() - start
+
+    def is_bad(self, source: str, pattern) -> bool:
+        stats = self._stats.get((source, pattern.pattern))
+        if stats is None or stats.bad_until is None:
+            return False
+        if stats.bad:
+            return True
+        stats.forgive()  # the mark expired
+        return False
+
+    def clear(self, source: typing.Optional[str] = None) -> int:
+        """Remove bad marks, only from patterns used for `source` if given. Returns the number of cleared marks."""
+        cleared = 0
+        with self._lock:
+            for stats in self._stats.values():
+                if stats.bad_until is not None and (source is None or stats.source == source):
+                    stats.forgive()
+                    cleared += 1
+        return cleared
+
+    def most_expensive(self, count: int = 5) -> typing.List[PatternStats]:
+        with self._lock:
+            stats = list(self._stats.values())
+        return sorted(stats, key=lambda i: i.cpu_time, reverse=True)[:count]
+
+
+budget = RegexBudget()
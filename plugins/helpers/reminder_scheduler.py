@@ -0,0 +1,124 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import heapq
+import itertools
+import re
+import time
+import typing
+
+TIME_STR_PATTERN = r'(?:([0-9]+)h)?([0-9]+)m(?:([0-9]+)s)?'
+
+
+def process_time(time_string: str) -> int:
+    """Convert a time like `1h10m5s` to seconds. The minutes are required. Returns -1 if the format is wrong."""
+    m = re.match(TIME_STR_PATTERN, time_string)
+    if m:
+        seconds = (
+                ((int(m[1]) * 3600) if m[1] is not None else 0)
+                + (int(m[2]) * 60)
+                + ((int(m[3])) if m[3] is not None else 0)
+        )
+        return seconds
+    return -1
+
+
+class ReminderScheduler:
+    """
+    Keep pending reminders in a min-heap on their due time and send them when they are due.
+
+    Only one task is kept in `deadlines`, for the earliest reminder. Recurring reminders are pushed back onto
+    the heap after they are sent. Removed reminders are left in the heap and skipped when they come up.
+
+    Reminders need `id`, `channel`, `due` (`time.time()`), `seconds` and `recurring` attributes. `remind` is called
+    with every reminder that is due, `save` with the ids of finished reminders and a list of the re-armed ones.
+    """
+
+    def __init__(self, deadlines, remind: typing.Callable[[typing.Any], typing.Any],
+                 save: typing.Callable[[typing.List[int], typing.List[typing.Any]], typing.Any]):
+        self.deadlines = deadlines
+        self.remind = remind
+        self.save = save
+        self._heap: typing.List[typing.Tuple[float, int, int]] = []  # (due, counter, reminder id)
+        self._counter = itertools.count()
+        self._timer = None
+        self._timer_due = None
+        self.reminders: typing.Dict[int, typing.Any] = {}
+        self.by_channel: typing.Dict[str, typing.List[typing.Any]] = {}
+
+    def _push(self, reminder):
+        heapq.heappush(self._heap, (reminder.due, next(self._counter), reminder.id))
+
+    def _is_stale(self, entry) -> bool:
+        reminder = self.reminders.get(entry[2])
+        return reminder is None or reminder.due != entry[0]
+
+    def add(self, reminder):
+        self.reminders[reminder.id] = reminder
+        self.by_channel.setdefault(reminder.channel, []).append(reminder)
+        self._push(reminder)
+        self._arm()
+
+    def extend(self, reminders: typing.Iterable[typing.Any]):
+        for i in reminders:
+            if i.id in self.reminders:
+                continue
+            self.reminders[i.id] = i
+            self.by_channel.setdefault(i.channel, []).append(i)
+            self._push(i)
+        self._arm()
+
+    def remove(self, reminder):
+        del self.reminders[reminder.id]
+        self.by_channel[reminder.channel].remove(reminder)
+        if not self.by_channel[reminder.channel]:
+            del self.by_channel[reminder.channel]
+
+    def _arm(self):
+        while self._heap and self._is_stale(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return
+        due = self._heap[0][0]
+        if self._timer_due is not None and self._timer_due <= due:
+            return
+        deadline = time.monotonic() + max(0.0, due - time.time())
+        if self._timer is None:
+            self._timer = self.deadlines.call_at(deadline, self._run, priority=5, name='reminders')
+        else:
+            self.deadlines.reschedule(self._timer, deadline)
+        self._timer_due = due
+
+    def _run(self):
+        self._timer_due = None
+        now = time.time()
+        finished = []
+        rearmed = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._is_stale(entry):
+                continue
+            reminder = self.reminders[entry[2]]
+            self.remind(reminder)
+            if reminder.recurring:
+                reminder.due = now + max(reminder.seconds, 1)
+                self._push(reminder)
+                rearmed.append(reminder)
+            else:
+                self.remove(reminder)
+                finished.append(reminder.id)
+        if finished or rearmed:
+            self.save(finished, rearmed)
+        self._arm()
@@ -21,7 +21,13 @@ import typing
 import regex as re
 import sqlalchemy
 from sqlalchemy import orm
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, joinedload
+
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.regex_budget import budget as regex_budget
+except ImportError:
+    from plugins.helpers.regex_budget import budget as regex_budget
 
 
 class BanPhraseType(enum.Enum):
@@ -52,7 +58,7 @@ def get(Base, log, session_scope, User):
 
         @staticmethod
         def _load_all(session):
-            return session.query(BanPhrase).all()
+            return session.query(BanPhrase).options(joinedload(BanPhrase.channel)).all()
 
         @staticmethod
         def load_all(session=None):
@@ -75,7 +81,7 @@ def get(Base, log, session_scope, User):
             return codecs.getdecoder("unicode_escape")(self.replacement, 'ignore')[0]
 
         def check_and_replace(self, text: str):
-            if self.bad:
+            if self.disabled:
                 return text
 
             check_result = self.check(text)
@@ -84,7 +90,8 @@ def get(Base, log, session_scope, User):
 
             if self.trigger_is_regex:
                 if self.type == BanPhraseType.replacement:
-                    return self.pattern.sub(self.unescaped_replacement, text)
+                    new_text = self._run_pattern('sub', self.unescaped_replacement, text)
+                    return text if new_text is None else new_text
                 elif self.type == BanPhraseType.deny:
                     return self.unescaped_warning
                 elif self.type == BanPhraseType.deny_no_warning:
@@ -98,14 +105,15 @@ def get(Base, log, session_scope, User):
                     return None
 
         def check(self, text: str):
-            if self.bad:
+            if self.disabled:
                 return False
 
             if self.trigger_is_regex:
                 self._ensure_pattern_compiled()
                 if self.bad:
                     return False
-                return len(self.pattern.findall(text))
+                matches = self._run_pattern('findall', text)
+                return len(matches) if matches is not None else False
             else:
                 return self.trigger in text
 
@@ -163,6 +171,19 @@ def get(Base, log, session_scope, User):
             else:
                 raise RuntimeError(f'Ban phrase type {self.type.name} has no warning')
 
+        @property
+        def disabled(self) -> bool:
+            """True if the pattern doesn't compile or if it was marked as bad by `regex_budget`, that mark expires."""
+            return self.bad or (self.pattern is not None and regex_budget.is_bad('ban_phrase', self.pattern))
+
+        def _run_pattern(self, method, *args):
+            """Run `self.pattern.method(*args)` with a time limit. Returns None if it took too long."""
+            try:
+                return regex_budget.run('ban_phrase', self.pattern, method, *args)
+            except TimeoutError:
+                log('warn', f'Pattern {self.trigger!r} timed out.')
+                return None
+
         def _ensure_pattern_compiled(self):
             if self.pattern is not None:
                 return
@@ -21,7 +21,7 @@ import twitchirc
 from sqlalchemy.orm import relationship, joinedload
 
 
-def get(Base, session_scope, blacklists, expire_queue):
+def get(Base, session_scope):
     class BlacklistEntry(Base):
         __tablename__ = 'blacklist'
         id = sqlalchemy.Column(sqlalchemy.Integer, autoincrement=True, primary_key=True)
@@ -36,10 +36,10 @@ def get(Base, session_scope, blacklists, expire_queue):
         expires_on = sqlalchemy.Column(sqlalchemy.DateTime, nullable=True)
         is_active = sqlalchemy.Column(sqlalchemy.Boolean, default=True)
 
-        def _check_expire(self):
-            if self.expires_on is not None and self.expires_on <= datetime.datetime.now():
-                blacklists.remove(self)
-                expire_queue.put(self)
+        def is_expired(self, now=None):
+            if self.expires_on is None:
+                return False
+            return self.expires_on <= (now if now is not None else datetime.datetime.now())
 
         @staticmethod
         def _load_all(session):
@@ -55,6 +55,21 @@ def get(Base, session_scope, blacklists, expire_queue):
             else:
                 return BlacklistEntry._load_all(session)
 
+        @staticmethod
+        def _delete_by_ids(ids, session):
+            return (session.query(BlacklistEntry)
+                    .filter(BlacklistEntry.id.in_(ids))
+                    .delete(synchronize_session=False))
+
+        @staticmethod
+        def delete_by_ids(ids, session=None):
+            """Delete entries with given ids using a single query. Returns the number of rows deleted."""
+            if session is None:
+                with session_scope() as s:
+                    return BlacklistEntry._delete_by_ids(ids, s)
+            else:
+                return BlacklistEntry._delete_by_ids(ids, session)
+
         def _check_channel(self, message: twitchirc.ChannelMessage):
             if self.channel is None:
                 return True
@@ -70,13 +85,15 @@ def get(Base, session_scope, blacklists, expire_queue):
                 return True
             return command.chat_command.lower().rstrip(' ') == self.command.lower().rstrip(' ')
 
-        def check(self, message: twitchirc.ChannelMessage, cmd: twitchirc.Command):
-            print(self.is_active)
+        def is_applicable(self):
+            """Check if this entry is active and not expired, without comparing it with a message."""
             if self.is_active is False:
                 return False
-            # if self._validate() is False:
-            #     return False
-            self._check_expire()
+            return not self.is_expired()
+
+        def check(self, message: twitchirc.ChannelMessage, cmd: twitchirc.Command):
+            if not self.is_applicable():
+                return False
             return self._check_channel(message) and self._check_command(cmd) and self._check_user(message)
 
 
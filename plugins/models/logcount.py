@@ -0,0 +1,36 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sqlalchemy
+
+
+def get(Base):
+    class LogCount(Base):
+        """Number of log entries per source, level and hour, kept after the entries themselves are deleted."""
+        __tablename__ = 'log_counts'
+        __table_args__ = (
+            sqlalchemy.Index('ix_log_counts_hour_source_level', 'hour', 'source', 'level'),
+        )
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, nullable=False)
+        hour = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
+        source = sqlalchemy.Column(sqlalchemy.String(128), nullable=False)
+        level = sqlalchemy.Column(sqlalchemy.SmallInteger, nullable=False)
+        count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+
+        def __repr__(self):
+            return f'<LogCount {self.source}/{self.level} at {self.hour}: {self.count}>'
+
+    return LogCount
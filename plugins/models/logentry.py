@@ -41,6 +41,9 @@ CAUSES = {
 def get(Base):
     class LogEntry(Base):
         __tablename__ = 'logs'
+        __table_args__ = (
+            sqlalchemy.Index('ix_logs_time_level', 'time', 'level'),
+        )
         id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, nullable=False)
         time = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now, nullable=False)
         source = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
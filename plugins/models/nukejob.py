@@ -0,0 +1,80 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import datetime
+
+import sqlalchemy
+
+
+def get(Base, session_scope):
+    class NukeJob(Base):
+        """A finished nuke, kept so that it can be reverted with unnuke."""
+        __tablename__ = 'nuke_jobs'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=False)  # the job's number
+        channel = sqlalchemy.Column(sqlalchemy.String(64), nullable=False, index=True)
+        issuer = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+        action = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+        users = sqlalchemy.Column(sqlalchemy.UnicodeText, nullable=False)  # users acted on, in order, one per line
+        state = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+        reverts = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
+        finished = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False, default=datetime.datetime.now)
+
+        @staticmethod
+        def _load_recent(channel, limit, session):
+            jobs = (session.query(NukeJob)
+                    .filter(NukeJob.channel == channel)
+                    .order_by(NukeJob.id.desc())
+                    .limit(limit)
+                    .all())
+            return jobs[::-1]
+
+        @staticmethod
+        def load_recent(channel, limit, session=None):
+            """Load the newest `limit` jobs from `channel`, oldest first."""
+            if session is None:
+                with session_scope() as s:
+                    return NukeJob._load_recent(channel, limit, s)
+            else:
+                return NukeJob._load_recent(channel, limit, session)
+
+        @staticmethod
+        def _max_id(session):
+            return session.query(sqlalchemy.func.max(NukeJob.id)).scalar() or 0
+
+        @staticmethod
+        def max_id(session=None):
+            if session is None:
+                with session_scope() as s:
+                    return NukeJob._max_id(s)
+            else:
+                return NukeJob._max_id(session)
+
+        @staticmethod
+        def prune(channel, keep, session):
+            """Delete all but the newest `keep` jobs from `channel`."""
+            kept = [i for i, in (session.query(NukeJob.id)
+                                 .filter(NukeJob.channel == channel)
+                                 .order_by(NukeJob.id.desc())
+                                 .limit(keep))]
+            if kept:
+                (session.query(NukeJob)
+                 .filter(NukeJob.channel == channel)
+                 .filter(~NukeJob.id.in_(kept))
+                 .delete(synchronize_session=False))
+
+        def __repr__(self):
+            return f'<NukeJob #{self.id} {self.action} in #{self.channel}, {self.state}>'
+
+    return NukeJob
@@ -0,0 +1,63 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import sqlalchemy
+
+
+def get(Base, session_scope):
+    class Reminder(Base):
+        __tablename__ = 'reminders'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        channel = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+        user = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+        text = sqlalchemy.Column(sqlalchemy.UnicodeText, nullable=False)
+
+        seconds = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+        due = sqlalchemy.Column(sqlalchemy.Float, nullable=False, index=True)  # unix timestamp
+        recurring = sqlalchemy.Column(sqlalchemy.Boolean, nullable=False, default=False)
+
+        @staticmethod
+        def _load_pending(session):
+            return session.query(Reminder).order_by(Reminder.due).all()
+
+        @staticmethod
+        def load_pending(session=None):
+            """Load all reminders that weren't sent yet. Sent one-time reminders are deleted."""
+            if session is None:
+                with session_scope() as s:
+                    return Reminder._load_pending(s)
+            else:
+                return Reminder._load_pending(session)
+
+        @staticmethod
+        def _delete_by_ids(ids, session):
+            return (session.query(Reminder)
+                    .filter(Reminder.id.in_(ids))
+                    .delete(synchronize_session=False))
+
+        @staticmethod
+        def delete_by_ids(ids, session=None):
+            if session is None:
+                with session_scope() as s:
+                    return Reminder._delete_by_ids(ids, s)
+            else:
+                return Reminder._delete_by_ids(ids, session)
+
+        def __repr__(self):
+            return (f'<Reminder {self.id} for {self.user} in #{self.channel}, due {self.due}'
+                    f'{", recurring" if self.recurring else ""}>')
+
+
+    return Reminder
@@ -14,19 +14,25 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import datetime
+import queue
 import threading
 import time
+import traceback
 import typing
+from collections import OrderedDict
 
 import sqlalchemy
 import twitchirc
 from twitchirc import ChannelMessage
 
 CACHE_EXPIRE_TIME = 15 * 60
+IDENTITY_CACHE_SIZE = 10_000
+IDENTITY_CACHE_TTL = 10 * 60
+WRITE_CHUNK_SIZE = 500
+WRITE_RETRY_TIME = 60
 
 
 def _is_pleb(msg: twitchirc.ChannelMessage) -> bool:
-    print(msg.flags['badges'])
     for i in (msg.flags['badges'] if isinstance(msg.flags['badges'], list) else [msg.flags['badges']]):
         # print(i)
         if i.startswith('subscriber'):
@@ -34,6 +40,88 @@ def _is_pleb(msg: twitchirc.ChannelMessage) -> bool:
     return True
 
 
+class UserIdentity(typing.NamedTuple):
+    """The parts of a `User` that never change, safe to share between callers."""
+    id: int
+    twitch_id: int
+
+    def schedule_update(self, msg: twitchirc.ChannelMessage):
+        _schedule_update(self.id, msg)
+
+
+def _schedule_update(db_id: int, msg: twitchirc.ChannelMessage):
+    cached_users[db_id] = {
+        'last_active': datetime.datetime.now(),
+        'msg': msg,
+        'expire_time': time.time() + CACHE_EXPIRE_TIME
+    }
+
+
+class UserIdentityCache:
+    """
+    Bounded LRU cache of `UserIdentity` objects keyed by Twitch user id.
+
+    Entries expire `ttl` seconds after they were inserted, the least recently used entry is evicted when the cache is
+    full.
+    """
+
+    def __init__(self, max_size: int = IDENTITY_CACHE_SIZE, ttl: float = IDENTITY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: typing.Dict[int, typing.Tuple[float, UserIdentity]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, twitch_id: int) -> typing.Optional[UserIdentity]:
+        with self._lock:
+            entry = self._data.get(twitch_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expire_time, user = entry
+            if expire_time <= time.monotonic():
+                del self._data[twitch_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(twitch_id)
+            self.hits += 1
+            return user
+
+    def put(self, twitch_id: int, user: UserIdentity):
+        with self._lock:
+            self._data[twitch_id] = (time.monotonic() + self.ttl, user)
+            self._data.move_to_end(twitch_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, twitch_id: int):
+        with self._lock:
+            self._data.pop(twitch_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> typing.Dict[str, typing.Union[int, float]]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits / total) if total else 0.0
+        }
+
+
+identity_cache = UserIdentityCache()
+
 cached_users: typing.Dict[int, typing.Dict[str, typing.Union[datetime.datetime, int, ChannelMessage]]] = {
     # base_id
     # 123: {
@@ -71,10 +159,13 @@ def get(Base, session_scope, log):
                           .filter(User.twitch_id == msg.flags['user-id'])
                           .first())
 
-            if user is None and not no_create:
+            if user is None:
+                if no_create:
+                    return None
                 user = User(twitch_id=msg.flags['user-id'], last_known_username=msg.user, mod_in_raw='',
                             sub_in_raw='')
                 session.add(user)
+                session.flush()  # get an id assigned, so the user can be cached and scheduled for updates.
             session.expunge(user)
             return user
 
@@ -86,6 +177,25 @@ def get(Base, session_scope, log):
             else:
                 return User._get_by_message(msg, no_create, session)
 
+        @staticmethod
+        def get_identity(msg: twitchirc.ChannelMessage, no_create=False) -> typing.Optional[UserIdentity]:
+            """
+            Like `get_by_message` but only returns the user's ids, repeat chatters are served from `identity_cache`.
+
+            Use `get_by_message` to get a `User` that can be changed.
+            """
+            twitch_id = int(msg.flags['user-id'])
+            identity = identity_cache.get(twitch_id)
+            if identity is not None:
+                return identity
+
+            user = User.get_by_message(msg, no_create)
+            if user is None:
+                return None
+            identity = UserIdentity(user.id, user.twitch_id)
+            identity_cache.put(twitch_id, identity)
+            return identity
+
         @staticmethod
         def get_by_twitch_id(id_: int):
             with session_scope() as session:
@@ -109,6 +219,21 @@ def get(Base, session_scope, log):
             else:
                 return User._get_by_local_id(id_, s)
 
+        @staticmethod
+        def _get_many(column, keys, session):
+            return session.query(User).filter(column.in_(keys)).all()
+
+        @staticmethod
+        def get_many(column, keys, session=None) -> typing.List[typing.Any]:
+            """Get all users whose `column` (ex. User.twitch_id) is in `keys`, using a single query."""
+            if not keys:
+                return []
+            if session is None:
+                with session_scope() as s:
+                    return User._get_many(column, keys, s)
+            else:
+                return User._get_many(column, keys, session)
+
         @staticmethod
         def _get_by_name(name: str, session):
             users: typing.List[User] = session.query(User).filter(User.last_known_username == name).all()
@@ -154,12 +279,7 @@ def get(Base, session_scope, log):
                 self._update(msg, update, s)
 
         def schedule_update(self, msg: twitchirc.ChannelMessage):
-            global cached_users
-            cached_users[self.id] = {
-                'last_active': datetime.datetime.now(),
-                'msg': msg,
-                'expire_time': time.time() + CACHE_EXPIRE_TIME
-            }
+            _schedule_update(self.id, msg)
 
         @property
         def mod_in(self):
@@ -205,50 +325,158 @@ def get(Base, session_scope, log):
             return f'<User {self.last_known_username}, alias {self.id}>'
 
 
-    def flush_users():
-        # print('flush users: pre lock')
-        if users_lock.locked():
-            return
-        # print('flush users: post lock')
-        users_lock.acquire()
+    def _load_rows(session, column, keys):
+        rows = {}
+        keys = list(keys)
+        for i in range(0, len(keys), WRITE_CHUNK_SIZE):
+            chunk = keys[i:i + WRITE_CHUNK_SIZE]
+            query = (session.query(User.id, User.twitch_id, User.last_known_username, User.mod_in_raw,
+                                   User.sub_in_raw)
+                     .filter(column.in_(chunk)))
+            for row in query:
+                rows[getattr(row, column.key)] = row
+        return rows
+
+    def _write_batch(batch: typing.Dict[typing.Optional[int], typing.Dict[str, typing.Any]]):
+        """Write a batch of scheduled updates using bulk statements, in one transaction."""
+        with session_scope() as session:
+            new_users = {int(update['msg'].flags['user-id']): update
+                         for db_id, update in batch.items() if db_id is None}
+            rows = _load_rows(session, User.id, [db_id for db_id in batch if db_id is not None])
+            existing_new_users = _load_rows(session, User.twitch_id, new_users.keys())
+
+            updates = []
+            renamed = {}
+            for db_id, update in batch.items():
+                if db_id is None:
+                    continue
+                if db_id not in rows:
+                    log('warn', f'Cannot update user {db_id}: no such user.')
+                    continue
+                updates.append(_make_update_mapping(rows[db_id], update, renamed))
+            inserts = []
+            for twitch_id, update in new_users.items():
+                if twitch_id in existing_new_users:
+                    updates.append(_make_update_mapping(existing_new_users[twitch_id], update, renamed))
+                else:
+                    inserts.append(_make_insert_mapping(twitch_id, update))
+
+            # there can be only one user with a name, forget the old owner's name.
+            names = list(renamed.keys())
+            for i in range(0, len(names), WRITE_CHUNK_SIZE):
+                old_owners = (session.query(User)
+                              .filter(User.last_known_username.in_(names[i:i + WRITE_CHUNK_SIZE]))
+                              .filter(~User.id.in_(list(renamed.values()))))
+                old_owners.update({User.last_known_username: '<UNKNOWN_USERNAME>'}, synchronize_session=False)
+            if updates:
+                session.bulk_update_mappings(User, updates)
+            if inserts:
+                session.bulk_insert_mappings(User, inserts)
+        log('debug', f'Wrote {len(updates)} user updates and {len(inserts)} new users.')
+
+    def _writer_thread_func():
+        while 1:
+            batch = write_queue.get()
+            try:
+                _write_batch(batch)
+            except Exception:
+                log('err', 'Failed to write user updates, putting them back in the cache.')
+                for i in traceback.format_exc(30).split('\n'):
+                    log('err', i)
+                with users_lock:
+                    for db_id, update in batch.items():
+                        # don't overwrite newer updates
+                        if db_id not in cached_users:
+                            update['expire_time'] = time.time() + WRITE_RETRY_TIME
+                            cached_users[db_id] = update
+            finally:
+                write_queue.task_done()
+
+    def flush_users(wait=False):
+        """
+        Hand over expired entries of `cached_users` to the writer thread.
+
+        :param wait: Block until everything handed over was written.
+        """
+        global writer_thread
+        if writer_thread is None:
+            writer_thread = threading.Thread(target=_writer_thread_func, args=(), kwargs={}, daemon=True)
+            writer_thread.start()
+
         current_time = int(time.time())
         to_update = {}
-        for db_id, user in cached_users.copy().items():
-            if user['expire_time'] <= current_time:
-                log('debug', f'flush user {db_id}')
-                to_update[db_id] = user
+        with users_lock:
+            for db_id, user in list(cached_users.items()):
+                if user['expire_time'] <= current_time:
+                    to_update[db_id] = cached_users.pop(db_id)
         if to_update:
-            # print(f'updating users: {to_update}')
-            log('debug', f'users cache is of length {len(cached_users)}, {len(to_update)} are going to be removed from the '
-                  f'cache.')
-
-            def _update_users():
-                try:
-                    with session_scope() as session:
-                        for db_id, update in to_update.copy().items():
-                            log('debug', db_id, 'updating dankCircle')
-                            if db_id is None:
-                                log('debug', 'create new')
-                                user = User.get_by_message(update['msg'])
-                                user.update(update, session)
-                                continue
-
-                            user = User.get_by_local_id(db_id)
-                            user.update(update, session)
-                    log('debug', 'Deleting to_updates.')
-                    for db_id in to_update:
-                        del cached_users[db_id]
-                finally:
-                    log('debug', 'release lock.')
-                    users_lock.release()
-
-            t = threading.Thread(target=_update_users, args=(), kwargs={})
-            t.start()
-        else:
-            users_lock.release()
+            log('debug', f'users cache is of length {len(cached_users)}, {len(to_update)} were handed over to '
+                         f'the writer.')
+            write_queue.put(to_update)
+        if wait:
+            write_queue.join()
 
     return User, flush_users
 
 
+def _split_channels(raw: typing.Optional[str]) -> typing.List[str]:
+    return [] if not raw else raw.replace(', ', ',').split(',')
+
+
+def _add_channel(raw: typing.Optional[str], channel: str) -> str:
+    channels = _split_channels(raw)
+    if channel.lower() not in channels:
+        channels.append(channel.lower())
+    return ', '.join(channels)
+
+
+def _remove_channel(raw: typing.Optional[str], channel: str) -> str:
+    channels = _split_channels(raw)
+    if channel.lower() in channels:
+        channels.remove(channel.lower())
+    return ', '.join(channels)
+
+
+def _make_update_mapping(row, update, renamed: typing.Dict[str, int]) -> typing.Dict[str, typing.Any]:
+    """Do the same thing as `User._update` but on a plain row, to be used with `bulk_update_mappings`."""
+    msg: ChannelMessage = update['msg']
+    if 'moderator/1' in msg.flags['badges'] or 'broadcaster/1' in msg.flags['badges']:
+        mod_in_raw = _add_channel(row.mod_in_raw, msg.channel)
+    else:
+        mod_in_raw = _remove_channel(row.mod_in_raw, msg.channel)
+    if _is_pleb(msg):
+        sub_in_raw = _remove_channel(row.sub_in_raw, msg.channel)
+    else:
+        sub_in_raw = _add_channel(row.sub_in_raw, msg.channel)
+    if msg.user != row.last_known_username:
+        renamed[msg.user] = row.id
+    return {
+        'id': row.id,
+        'last_active': update['last_active'],
+        'last_message': msg.text,
+        'last_message_channel': msg.channel,
+        'last_known_username': msg.user,
+        'mod_in_raw': mod_in_raw,
+        'sub_in_raw': sub_in_raw
+    }
+
+
+def _make_insert_mapping(twitch_id: int, update) -> typing.Dict[str, typing.Any]:
+    msg: ChannelMessage = update['msg']
+    is_mod = 'moderator/1' in msg.flags['badges'] or 'broadcaster/1' in msg.flags['badges']
+    return {
+        'twitch_id': twitch_id,
+        'last_known_username': msg.user,
+        'last_active': update['last_active'],
+        'last_message': msg.text,
+        'last_message_channel': msg.channel,
+        'first_active': datetime.datetime.now(),
+        'mod_in_raw': msg.channel.lower() if is_mod else '',
+        'sub_in_raw': '' if _is_pleb(msg) else msg.channel.lower()
+    }
+
+
 users_lock = threading.Lock()
+write_queue: 'queue.Queue[typing.Dict[typing.Optional[int], typing.Dict[str, typing.Any]]]' = queue.Queue()
+writer_thread: typing.Optional[threading.Thread] = None
 
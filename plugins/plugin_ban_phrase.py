@@ -32,6 +32,17 @@ except ImportError:
 
     exit(1)
 import plugins.models.banphrase as banphrase_model
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.regex_budget import budget as regex_budget
+except ImportError:
+    from plugins.helpers.regex_budget import budget as regex_budget
+
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.aho_corasick import AhoCorasick
+except ImportError:
+    from plugins.helpers.aho_corasick import AhoCorasick
 
 NAME = 'ban_phrase'
 __meta_data__ = {
@@ -43,41 +54,158 @@ BanPhraseType = banphrase_model.BanPhraseType
 BanPhrase = banphrase_model.get(main.Base, log, main.session_scope, main.User)
 ban_phrases: typing.List[BanPhrase] = []
 
+DEFAULT_REGEX_FLAGS = re.compile('').flags
+BACKREFERENCE_PATTERN = re.compile(r'\\[1-9]|\\g<|\(\?P=')
+
+
+class BanPhraseMatcher:
+    """
+    Find which ban phrases might match a text, without checking every phrase separately.
+
+    Literal triggers are found using an Aho-Corasick automaton. Regex triggers are combined into one alternation with a
+    named group per phrase, if it doesn't match none of them do. Patterns that wouldn't work inside of an alternation
+    (inline flags, back references) are always checked.
+    """
+
+    def __init__(self, phrases: typing.List[BanPhrase]):
+        self.phrases = phrases
+        self.always_check: typing.Set[int] = set()
+        self.regex_phrases: typing.Set[int] = set()
+
+        literals = []
+        alternatives = []
+        for num, phrase in enumerate(phrases):
+            if phrase.bad:
+                continue
+            if not phrase.trigger_is_regex:
+                if phrase.trigger:
+                    literals.append((phrase.trigger, num))
+                else:
+                    self.always_check.add(num)
+                continue
+
+            phrase._ensure_pattern_compiled()
+            if phrase.bad:
+                continue
+            if (phrase.pattern.flags != DEFAULT_REGEX_FLAGS
+                    or BACKREFERENCE_PATTERN.search(phrase.pattern.pattern)):
+                self.always_check.add(num)
+            else:
+                alternatives.append(f'(?P<phrase_{num}>{phrase.pattern.pattern})')
+                self.regex_phrases.add(num)
+        self.literals = AhoCorasick(literals)
+        self.combined_pattern = None
+        if alternatives:
+            try:
+                self.combined_pattern = re.compile('|'.join(alternatives))
+            except Exception as e:
+                log('warn', f'Unable to combine ban phrase patterns, they will be checked one by one: {e}')
+                self.always_check.update(self.regex_phrases)
+                self.regex_phrases = set()
+
+    def candidates(self, text: str) -> typing.Set[int]:
+        """Return indexes of phrases that might match `text`. Phrases not in this set definitely don't match."""
+        found = self.literals.find_all(text)
+        found.update(self.always_check)
+        if self.combined_pattern is None:
+            return found
+        if regex_budget.is_bad('ban_phrase_combined', self.combined_pattern):
+            # check the phrases one by one until the mark expires
+            found.update(self.regex_phrases)
+            return found
+        try:
+            if regex_budget.run('ban_phrase_combined', self.combined_pattern, 'search', text):
+                # alternatives don't report overlapping matches, check all of the regex phrases.
+                found.update(self.regex_phrases)
+        except TimeoutError:
+            # the phrases get checked one by one, every one of them with its own time limit.
+            found.update(self.regex_phrases)
+        return found
+
+
+# Built by _init, keyed by plain channel names so that the middleware never touches the database session.
+channel_ban_phrases: typing.Dict[str, typing.List[BanPhrase]] = {
+    # 'channel': [phrases for this channel and global phrases, in the order they were loaded]
+}
+global_ban_phrases: typing.List[BanPhrase] = []
+# (channel, 'input' or 'output'): matcher
+matchers: typing.Dict[typing.Tuple[str, str], BanPhraseMatcher] = {}
+# used for channels without their own ban phrases
+global_matchers: typing.Dict[str, BanPhraseMatcher] = {
+    'input': BanPhraseMatcher([]),
+    'output': BanPhraseMatcher([])
+}
+
+
+def _build_index():
+    channel_names = {}
+    for phrase in ban_phrases:
+        if phrase.channel_alias is not None:
+            channel_names[phrase.id] = phrase.channel.last_known_username
+
+    global_ban_phrases.clear()
+    global_ban_phrases.extend(phrase for phrase in ban_phrases if phrase.channel_alias is None)
+    channel_ban_phrases.clear()
+    for channel in set(channel_names.values()):
+        channel_ban_phrases[channel] = [phrase for phrase in ban_phrases
+                                        if phrase.channel_alias is None or channel_names[phrase.id] == channel]
+
+    matchers.clear()
+    for direction in ('input', 'output'):
+        global_matchers[direction] = BanPhraseMatcher([i for i in global_ban_phrases if getattr(i, direction)])
+        for channel, phrases in channel_ban_phrases.items():
+            matchers[(channel, direction)] = BanPhraseMatcher([i for i in phrases if getattr(i, direction)])
+
+
+def _get_matcher(channel: str, direction: str) -> BanPhraseMatcher:
+    matcher = matchers.get((channel, direction))
+    if matcher is None:
+        return global_matchers[direction]
+    return matcher
+
 
 class BanPhraseMiddleware(twitchirc.AbstractMiddleware):
     def send(self, event: Event) -> None:
         msg: twitchirc.ChannelMessage = event.data.get('message')
         if isinstance(msg, twitchirc.ChannelMessage):
             text = msg.text
+            matcher = _get_matcher(msg.channel, 'output')
+            candidates = matcher.candidates(text)
 
-            for phrase in ban_phrases:
-                if phrase.channel_alias is None or phrase.channel.last_known_username == msg.channel:
-                    if not phrase.output:
-                        continue
-                    text = phrase.check_and_replace(text)
-                    if text is None:
-                        event.cancel()
-                        return
+            for num, phrase in enumerate(matcher.phrases):
+                if num not in candidates:
+                    continue
+                new_text = phrase.check_and_replace(text)
+                if new_text is None:
+                    event.cancel()
+                    return
+                if new_text != text:
+                    # phrases later in the list need to see the new text.
+                    text = new_text
+                    candidates = matcher.candidates(text)
             msg.text = text
 
     def receive(self, event: Event) -> None:
         msg: twitchirc.ChannelMessage = event.data.get('message')
         if isinstance(msg, twitchirc.ChannelMessage):
             text = msg.text
+            matcher = _get_matcher(msg.channel, 'input')
+            candidates = matcher.candidates(text)
 
-            for phrase in ban_phrases:
-                if phrase.channel_alias is None or phrase.channel.last_known_username == msg.channel:
-                    if not phrase.input:
-                        continue
-
-                    text = phrase.check_and_replace(text)
-                    if phrase.type == BanPhraseType.deny and phrase.check(text):
-                        event.cancel()
-                        event.source.send(msg.reply(phrase.warning))
-                        return
-                    if text is None:
-                        event.cancel()
-                        return
+            for num, phrase in enumerate(matcher.phrases):
+                if num not in candidates:
+                    continue
+                new_text = phrase.check_and_replace(text)
+                if phrase.type == BanPhraseType.deny and phrase.check(new_text):
+                    event.cancel()
+                    event.source.send(msg.reply(phrase.warning))
+                    return
+                if new_text is None:
+                    event.cancel()
+                    return
+                if new_text != text:
+                    text = new_text
+                    candidates = matcher.candidates(text)
             msg.text = text
 
     def command(self, event: Event) -> None:
@@ -104,6 +232,32 @@ class BanPhraseMiddleware(twitchirc.AbstractMiddleware):
 
 main.bot.middleware.append(BanPhraseMiddleware())
 
+
+def _on_bad_pattern(stats):
+    minutes = round(regex_budget.bad_expire_time / 60)
+    if stats.source == 'ban_phrase_combined':
+        log('warn', f'Combined ban phrase pattern timed out too many times, regex phrases will be checked one by one '
+                    f'for {minutes} minutes.')
+        return
+    if stats.source != 'ban_phrase':
+        return
+    for phrase in ban_phrases:
+        if phrase.pattern is None or phrase.pattern.pattern != stats.pattern:
+            continue
+        log('warn', f'Pattern {phrase.trigger!r} timed out too many times, disabling it for {minutes} minutes.')
+        if phrase.channel_alias is None:
+            continue
+        # tell the channel owner, global phrases are only logged.
+        channel = phrase.channel.last_known_username
+        msg = twitchirc.ChannelMessage(text=f'@{channel}, ban phrase #{phrase.id} took too long to check '
+                                            f'{stats.timeouts} times, it is disabled for {minutes} minutes.',
+                                       user='OUTGOING', channel=channel, outgoing=True, parent=None)
+        # this is called from inside of the middleware, send the message after it's done.
+        main.bot.schedule_event(0.1, 10, main.bot.send, (msg,), {})
+
+
+regex_budget.on_bad.append(_on_bad_pattern)
+
 ban_phrase_read_only_session = None
 
 
@@ -115,7 +269,8 @@ def _init():
     print('Load ban phrases.')
     for i in BanPhrase.load_all(ban_phrase_read_only_session):
         ban_phrases.append(i)
-    print(f'Done. Loaded {len(ban_phrases)} ban phrases.')
+    _build_index()
+    print(f'Done. Loaded {len(ban_phrases)} ban phrases, {len(channel_ban_phrases)} channels have their own.')
 
 
 main.bot.schedule_event(0.1, 100, _init, (), {})
@@ -14,11 +14,11 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import datetime
-import queue
+import heapq
+import itertools
 import threading
-import time
 import typing
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 import regex
 from twitchirc import Event
@@ -48,9 +48,142 @@ __meta_data__ = {
     ]
 }
 log = main.make_log_function(NAME)
-expire_queue = queue.Queue()
-blacklists: List['BlacklistEntry'] = []
-BlacklistEntry = blacklistentry_model.get(main.Base, main.session_scope, blacklists, expire_queue)
+BlacklistKey = Tuple[Optional[str], Optional[str], Optional[str]]  # (channel, user, command)
+
+
+class BlacklistIndex:
+    """
+    Blacklist entries indexed by (channel, user, command). None in any of those means "all".
+
+    Finding the entries that apply to a command invocation takes at most eight dict lookups, no matter how many entries
+    there are. Keys are computed once when an entry is added, so lookups don't touch any relationships.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[BlacklistKey, List['BlacklistEntry']] = {}
+        self._keys: Dict[int, BlacklistKey] = {}  # id(entry): key
+
+    @staticmethod
+    def _key_for(entry) -> BlacklistKey:
+        return (
+            entry.channel.last_known_username.lower() if entry.channel is not None else None,
+            entry.target.last_known_username.lower() if entry.target is not None else None,
+            entry.command.lower().rstrip(' ') if entry.command is not None else None
+        )
+
+    def append(self, entry):
+        key = self._key_for(entry)
+        self._keys[id(entry)] = key
+        self._buckets.setdefault(key, []).append(entry)
+
+    def extend(self, entries):
+        for i in entries:
+            self.append(i)
+
+    def remove(self, entry):
+        key = self._keys.pop(id(entry), None)
+        if key is None:
+            raise ValueError(f'{entry!r} is not in the index.')
+        bucket = self._buckets[key]
+        bucket.remove(entry)
+        if not bucket:
+            del self._buckets[key]
+
+    def clear(self):
+        self._buckets.clear()
+        self._keys.clear()
+
+    def find(self, channel: str, user: str, command: str) -> List['BlacklistEntry']:
+        """Return entries that might apply to `user` running `command` in `channel`."""
+        channel = channel.lower()
+        user = user.lower()
+        command = command.lower().rstrip(' ')
+        found = []
+        for ch in (channel, None):
+            for usr in (user, None):
+                for cmd in (command, None):
+                    bucket = self._buckets.get((ch, usr, cmd))
+                    if bucket:
+                        found.extend(bucket)
+        return found
+
+    def __iter__(self):
+        for bucket in list(self._buckets.values()):
+            yield from bucket
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, entry):
+        return id(entry) in self._keys
+
+
+class BlacklistExpiry:
+    """
+    Remove blacklist entries from an index exactly when they expire.
+
+    Entries are kept in a min-heap by `expires_on`, `run` sleeps until the earliest one lapses, removes everything that
+    expired from the index and deletes those rows using a single query.
+    """
+    # wake up at least this often, `expires_on` is wall clock time which can jump.
+    MAX_SLEEP = 60
+
+    def __init__(self, index: BlacklistIndex):
+        self.index = index
+        self.condition = threading.Condition()
+        self._heap: List[Tuple[datetime.datetime, int, 'BlacklistEntry']] = []
+        self._counter = itertools.count()
+
+    def add(self, entry):
+        if entry.expires_on is None:
+            return
+        with self.condition:
+            heapq.heappush(self._heap, (entry.expires_on, next(self._counter), entry))
+            if self._heap[0][2] is entry:
+                self.condition.notify()
+
+    def extend(self, entries):
+        for i in entries:
+            self.add(i)
+
+    def clear(self):
+        with self.condition:
+            self._heap.clear()
+
+    def _pop_expired(self, now: datetime.datetime) -> List['BlacklistEntry']:
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)[2]
+            if entry in self.index:
+                self.index.remove(entry)
+                expired.append(entry)
+        return expired
+
+    def run(self):
+        while 1:
+            with self.condition:
+                expired = self._pop_expired(datetime.datetime.now())
+                if not expired:
+                    timeout = self.MAX_SLEEP
+                    if self._heap:
+                        timeout = min(timeout, (self._heap[0][0] - datetime.datetime.now()).total_seconds())
+                    if timeout > 0:
+                        self.condition.wait(timeout)
+                    continue
+            ids = [i.id for i in expired if i.id is not None]
+            if not ids:
+                continue
+            try:
+                count = BlacklistEntry.delete_by_ids(ids)
+                log('info', f'Expired {count} blacklist entries.')
+            except Exception as e:
+                # rows left in the database expire again when the blacklist is loaded.
+                log('err', f'Failed to delete expired blacklist entries {ids!r}: {e!r}')
+
+
+blacklists = BlacklistIndex()
+expiry = BlacklistExpiry(blacklists)
+BlacklistEntry = blacklistentry_model.get(main.Base, main.session_scope)
 TIMEDELTA_REGEX = regex.compile(r'(\d+d(?:ays)?)?([0-5]?\dh(?:ours?)?)?([0-5]?\dm(?:inutes?)?)?'
                                 r'([0-5]?\ds(?:econds?)?)?')
 
@@ -58,9 +191,9 @@ TIMEDELTA_REGEX = regex.compile(r'(\d+d(?:ays)?)?([0-5]?\dh(?:ours?)?)?([0-5]?\d
 class Plugin(main.Plugin):
     def __init__(self, module, source):
         super().__init__(module, source)
-        self.expire_lock = threading.Lock()
         main.bot.schedule_event(0.1, 10, self._post_init, (), {})
-        self.expire_thread = threading.Thread(target=self._periodically_expire, args=(), kwargs={})
+        self.expire_thread = threading.Thread(target=expiry.run, args=(), kwargs={}, daemon=True,
+                                              name='blacklist_expiry')
         self.expire_thread.start()
         main.reloadables['blacklist'] = self.reload_blacklist
         decorator = main.bot.add_command('plonk', enable_local_bypass=False, required_permissions=['blacklist.plonk'])
@@ -75,37 +208,29 @@ class Plugin(main.Plugin):
         decorator(self.command_manage_blacklists)
 
     def reload_blacklist(self):
-        global blacklists
-        with self.expire_lock:  # don't expire black lists while reloading
-            with main.session_scope() as dank_circle:
-                blacklists = BlacklistEntry.load_all(dank_circle)
+        with main.session_scope() as dank_circle:
+            entries = BlacklistEntry.load_all(dank_circle)
+        with expiry.condition:  # don't expire black lists while reloading
+            blacklists.clear()
+            expiry.clear()
+            self._add_entries(entries)
 
     def _post_init(self):
-        global blacklists
         # load all entries
         with main.session_scope() as dank_circle:
-            blacklists = BlacklistEntry.load_all(dank_circle)
+            self._add_entries(BlacklistEntry.load_all(dank_circle))
 
         # initialize middleware
         main.bot.middleware.append(
             BlacklistMiddleware()
         )
 
-    def _periodically_expire(self):
-        while 1:
-            time.sleep(30)  # don't need to flush this right away.
-            to_expire = []
-            while 1:
-                try:
-                    o = expire_queue.get_nowait()
-                    to_expire.append(o)
-                except queue.Empty:
-                    break
-            if to_expire:
-                with main.session_scope() as session, self.expire_lock:
-                    for e in to_expire:
-                        e: BlacklistEntry
-                        session.delete(e)
+    @staticmethod
+    def _add_entries(entries):
+        with expiry.condition:
+            for i in entries:
+                blacklists.append(i)
+                expiry.add(i)
 
     def _parse_blacklist_args(self, text, msg):
         kwargs = {
@@ -165,6 +290,46 @@ class Plugin(main.Plugin):
 
         return kwargs
 
+    @staticmethod
+    def _create_entries(msg, kw, session, added: list) -> typing.Optional[str]:
+        """Add the entries described by `kw` to `session` and `added`. Returns an error message if a name is wrong."""
+        if kw['scope'] == 'global':
+            targets = main.User.get_by_name(kw['user'], session) if kw['user'] is not True else None
+
+            if targets is None or len(targets) == 1:
+                obj = BlacklistEntry(target=targets[0] if targets is not None else targets,
+                                     command=kw['command'] if kw['command'] is not True else None,
+                                     channel=None, expires_on=kw['expires'],
+                                     is_active=True)
+                session.add(obj)
+                added.append(obj)
+            elif len(targets) == 0:
+                return f'@{msg.user} Failed to find user: {kw["user"]}'
+            else:
+                return f'@{msg.user} Found multiple users possible with name {kw["user"]}'
+        else:
+            for ch in kw['scope']:
+                targets = main.User.get_by_name(kw['user'], session) if kw['user'] is not True else None
+                channels = main.User.get_by_name(ch, session)
+                if len(channels) == 1:
+                    if targets is None or len(targets) == 1:
+                        obj = BlacklistEntry(target=targets[0] if targets is not None else targets,
+                                             command=kw['command'] if kw['command'] is not True else None,
+                                             channel=channels[0],
+                                             expires_on=kw['expires'],
+                                             is_active=True)
+                        session.add(obj)
+                        added.append(obj)
+                    elif len(targets) == 0:
+                        return f'@{msg.user} Failed to find user: {kw["user"]}'
+                    else:
+                        return f'@{msg.user} Found multiple users possible with name {kw["user"]}'
+                elif len(channels) == 0:
+                    return f'@{msg.user} Failed to find channel: {ch}'
+                elif len(channels) > 1:
+                    return f'@{msg.user} Found multiple channels possible with name {ch}'
+        return None
+
     def command_manage_blacklists(self, msg: twitchirc.ChannelMessage):
         argv = main.delete_spammer_chrs(msg.text).rstrip(' ').split(' ', 1)
         if len(argv) == 1:
@@ -177,42 +342,13 @@ class Plugin(main.Plugin):
             return f'@{msg.user}, No `command:...` provided.'
         if kw['user'] is None:
             return f'@{msg.user}, No `user:...` provided.'
+        added = []
         with main.session_scope() as session:
-            if kw['scope'] == 'global':
-                targets = main.User.get_by_name(kw['user'], session) if kw['user'] is not True else None
-
-                if targets is None or len(targets) == 1:
-                    obj = BlacklistEntry(target=targets[0] if targets is not None else targets,
-                                         command=kw['command'] if kw['command'] is not True else None,
-                                         channel=None, expires_on=kw['expires'],
-                                         is_active=True)
-                    blacklists.append(obj)
-                    session.add(obj)
-                elif len(targets) == 0:
-                    return f'@{msg.user} Failed to find user: {kw["user"]}'
-                else:
-                    return f'@{msg.user} Found multiple users possible with name {kw["user"]}'
-            else:
-                for ch in kw['scope']:
-                    targets = main.User.get_by_name(kw['user'], session) if kw['user'] is not True else None
-                    channels = main.User.get_by_name(ch, session)
-                    if len(channels) == 1:
-                        if targets is None or len(targets) == 1:
-                            obj = BlacklistEntry(target=targets[0] if targets is not None else targets,
-                                                 command=kw['command'] if kw['command'] is not True else None,
-                                                 channel=channels[0],
-                                                 expires_on=kw['expires'],
-                                                 is_active=True)
-                            blacklists.append(obj)
-                            session.add(obj)
-                        elif len(targets) == 0:
-                            return f'@{msg.user} Failed to find user: {kw["user"]}'
-                        else:
-                            return f'@{msg.user} Found multiple users possible with name {kw["user"]}'
-                    elif len(channels) == 0:
-                        return f'@{msg.user} Failed to find channel: {ch}'
-                    elif len(channels) > 1:
-                        return f'@{msg.user} Found multiple channels possible with name {ch}'
+            error = self._create_entries(msg, kw, session, added)
+        # added after committing, so that entries that expire have an id by then
+        self._add_entries(added)
+        if error is not None:
+            return error
         return f'@{msg.user}, Added blacklist for command {kw["command"]} with scope {kw["scope"]} for {kw["user"]}'
 
     @property
@@ -242,12 +378,12 @@ class BlacklistMiddleware(twitchirc.AbstractMiddleware):
     def command(self, event: Event) -> None:
         message: twitchirc.ChannelMessage = event.data['message']
         command: twitchirc.Command = event.data['command']
-        for bl in blacklists.copy():
-            r = bl.check(message, command)
-            if r is True:
+        for bl in blacklists.find(message.channel, message.user, command.chat_command):
+            if bl.is_applicable():
                 log('info', f'Ignored {message.user}\'s command ({command.chat_command!r}), \n'
                             f'message: {message.text}')
                 event.cancel()
+                break
 
     def permission_check(self, event: Event) -> None:
         pass
@@ -34,6 +34,12 @@ try:
 except ImportError:
     from plugins.helpers import braille
 
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.outbound import PRIORITY_SPAM
+except ImportError:
+    from plugins.helpers.outbound import PRIORITY_SPAM
+
 try:
     import plugin_plugin_help as plugin_help
 except ImportError:
@@ -140,6 +146,10 @@ class Plugin(main.Plugin):
 
         if msg.text.startswith('$ps sneeze') and msg.channel in ['supinic', 'mm2pl']:
             self._sneeze = (time.time() + self.cooldown_timeout, msg)
+            if self._sneeze_task is not None:
+                main.deadlines.cancel(self._sneeze_task)
+            self._sneeze_task = main.deadlines.call_later(self.cooldown_timeout, self.waytoodank_timer,
+                                                          name='cancer.waytoodank_timer')
 
         if msg.user == 'supibot' and self._sneeze[1] is not None and (
                 msg.text.startswith(
@@ -148,9 +158,14 @@ class Plugin(main.Plugin):
         ):
             # don't respond if the playsound didn't play
             self._sneeze = (-1, None)
+            if self._sneeze_task is not None:
+                main.deadlines.cancel(self._sneeze_task)
+                self._sneeze_task = None
 
     def waytoodank_timer(self):
-        if self._sneeze[0] <= time.time() and self._sneeze[1] is not None:
+        # runs when the cooldown passes
+        self._sneeze_task = None
+        if self._sneeze[1] is not None:
             main.bot.send(self._sneeze[1].reply('WAYTOODANK'))
             self._sneeze = (-1, None)
 
@@ -203,6 +218,7 @@ class Plugin(main.Plugin):
         )
 
         self._sneeze = (-1, None)
+        self._sneeze_task = None
         self.storage = main.PluginStorage(self, main.bot.storage)
         main.bot.handlers['chat_msg'].append(self.chan_msg_handler)
 
@@ -264,8 +280,6 @@ class Plugin(main.Plugin):
         plugin_help.add_manual_help_using_command('Add yourself to the list of people who will be reminded to eat '
                                                   'cookies', None)(self.c_cookie_optin)
 
-        main.bot.schedule_repeated_event(0.1, 1, self.waytoodank_timer, (), {})
-
         plugin_help.create_topic('plugin_cancer',
                                  'Plugin dedicated to things that shouldn\'t be done '
                                  '(responding to messages other than commands, spamming).',
@@ -309,9 +323,9 @@ class Plugin(main.Plugin):
             if not args.strip(' '):
                 return f'@{msg.user}, Nothing to send. NaM'
             for i in range(1, size):
-                main.bot.send(msg.reply(args * i))
+                main.bot.send(msg.reply(args * i), priority=PRIORITY_SPAM)
             for i in range(size, 0, -1):
-                main.bot.send(msg.reply(args * i))
+                main.bot.send(msg.reply(args * i), priority=PRIORITY_SPAM)
 
     async def c_braillefy(self, msg: twitchirc.ChannelMessage):
         cd_state = main.do_cooldown('braille', global_cooldown=0, local_cooldown=60, msg=msg)
@@ -24,6 +24,24 @@ import regex
 import requests
 from twitchirc import ChannelMessage
 
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.compact_message import CompactMessage
+except ImportError:
+    from plugins.helpers.compact_message import CompactMessage
+
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.message_history import MessageHistory
+except ImportError:
+    from plugins.helpers.message_history import MessageHistory
+
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.regex_budget import budget as regex_budget
+except ImportError:
+    from plugins.helpers.regex_budget import budget as regex_budget
+
 try:
     # noinspection PyPackageRequirements
     import main
@@ -47,7 +65,7 @@ log = main.make_log_function(NAME)
 
 class Plugin(main.Plugin):
 
-    cache: Dict[str, typing.List[typing.Tuple[twitchirc.ChannelMessage, float]]]
+    cache: Dict[str, MessageHistory]
 
     def __init__(self, module, source):
         super().__init__(module, source)
@@ -56,9 +74,7 @@ class Plugin(main.Plugin):
         # }
         self.max_cache_length = defaultdict(lambda: 500)
         self.cache = {
-            # 'channel': [
-            #     # [message, time.time()]  # message, timestamp
-            # ]
+            # 'channel': MessageHistory(max_length=self.max_cache_length['channel'])
         }
         main.bot.handlers['chat_msg'].append(self.on_message)
         main.bot.schedule_event(0.1, 10, self._load_recents_from_connected, (), {})
@@ -111,38 +127,48 @@ class Plugin(main.Plugin):
         :param min_timestamp: Minimum timestamp to search for. Optional
         :param max_timestamp: Maximum timestamp to search for. Optional
         :param expr: Pattern you want to search for. Optional.
-        :return: A list of messages found.
+        :return: A list of messages found. These are rebuilt from the cache, see `CompactMessage.message`.
+        :raises TimeoutError: if the pattern timed out too many times and was marked as bad. Single timeouts count
+        as messages not matching.
         """
         if expr is None:
             pattern = None
         else:
             pattern = regex.compile(expr)
-        if channel in self.cache:
-            ret_list = []
-            for msg, t in self.cache[channel]:
-                if ((user is None or msg.user == user)
-                        and (pattern is None or pattern.findall(msg.text))
-                        and (min_timestamp is None or min_timestamp < t)
-                        and (max_timestamp is None or max_timestamp > t)):
-                    ret_list.append(msg)
-            return ret_list
-        else:
+        if channel not in self.cache:
             raise KeyError(f'Channel not found: {channel}')
 
+        history = self.cache[channel]
+        if user is not None:
+            history = history.users.get(user)
+            if history is None:
+                return []
+        candidates = history.between(min_timestamp, max_timestamp)
+        if pattern is not None:
+            candidates = [record for record in candidates if self._search(pattern, record.text)]
+        return [record.message for record in candidates]
+
+    @staticmethod
+    def _search(pattern, text):
+        try:
+            return regex_budget.run('chat_cache', pattern, 'search', text)
+        except TimeoutError:
+            if regex_budget.is_bad('chat_cache', pattern):
+                raise
+            return None
+
     def on_message(self, event, message: twitchirc.ChannelMessage):
-        self._clear_cache()
         if message.channel not in self.cache:
-            self.cache[message.channel] = []
+            self.cache[message.channel] = MessageHistory(max_length=self.max_cache_length[message.channel])
         t = None
         if 'tmi-sent-ts' in message.flags:
             t = int(message.flags['tmi-sent-ts'])/1000
         else:
             t = time.time()
-        self.cache[message.channel].append(
-            (message, t)
-        )
-
-    def _clear_cache(self):
-        for channel in self.cache:
-            while len(self.cache[channel]) > self.max_cache_length[channel]:
-                self.cache[channel].pop(0)  # delete the oldest entry.
+        self.cache[message.channel].add(CompactMessage.from_message(message, t), t)
+
+    def set_max_cache_length(self, channel, length):
+        self.max_cache_length[channel] = length
+        if channel in self.cache:
+            self.cache[channel].max_length = length
+            self.cache[channel].trim()
@@ -15,21 +15,19 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 # noinspection PyUnresolvedReferences
-import io
+import asyncio
+import collections
+import inspect
 import json
 import os
-import queue
-import select
-import socket
+import struct
 import threading
+import time
 import typing
 import uuid
 import re
 import traceback
-from typing import Dict
 
-import dill as dill
-import sqlalchemy.ext.declarative
 import twitchirc
 from twitchirc import Event
 
@@ -39,11 +37,68 @@ except ImportError:
     import util_bot as main
 
     exit()
+
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.db_executor import DBExecutor
+except ImportError:
+    from plugins.helpers.db_executor import DBExecutor
+
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.outbound import MODERATION_COMMANDS
+except ImportError:
+    from plugins.helpers.outbound import MODERATION_COMMANDS
 __meta_data__ = {
     'name': 'plugin_ipc',
     'commands': []
 }
 
+# Longest message a client can send, longer ones close the connection.
+MAX_MESSAGE_SIZE = 64 * 1024
+SOCKET_PATH = './ipc_server'
+
+# Binary mode, see the `binary` command. Every message is a frame: the payload's length and kind, then the payload.
+# In text mode every message is a line, starting with the prefix of its kind. JSON payloads are compact.
+FRAME_HEADER = struct.Struct('>IB')
+KIND_COMMAND = ord('>')  # client to server
+KIND_OUTPUT = ord('~')
+KIND_CHAT = ord('%')  # messages sent by commands
+KIND_ERROR = ord('!')
+KIND_JSON = ord('$')
+TEXT_PREFIXES = {
+    KIND_OUTPUT: b'~',
+    KIND_CHAT: b'~~',
+    KIND_ERROR: b'!',
+    KIND_JSON: b'$',
+}
+BINARY_CONFIRMATION = 'Switched to binary mode.'
+
+# What commands return and Connection.send takes: (kind, payload) pairs.
+Messages = typing.List[typing.Tuple[int, bytes]]
+
+# Events waiting to be written to a subscriber, when a slow subscriber has more the oldest ones are dropped.
+SUBSCRIBER_QUEUE_SIZE = 500
+TOPICS = ('commands', 'moderation', 'logs')  # and chat:CHANNEL
+
+
+def encode_messages(messages: Messages, binary: bool) -> bytes:
+    if binary:
+        return b''.join(FRAME_HEADER.pack(len(payload), kind) + payload for kind, payload in messages)
+    return b''.join(TEXT_PREFIXES[kind] + payload + b'\r\n' for kind, payload in messages)
+
+
+def output(text: str) -> Messages:
+    return [(KIND_OUTPUT, text.encode('utf-8'))]
+
+
+def error(code: int, text: str) -> Messages:
+    return [(KIND_ERROR, str(code).encode('utf-8')), (KIND_OUTPUT, text.encode('utf-8'))]
+
+
+def format_json(data) -> Messages:
+    return [(KIND_JSON, json.dumps(data, separators=(',', ':')).encode('utf-8'))]
+
 
 class ListDict(dict):
     def __init__(self):
@@ -55,22 +110,124 @@ class ListDict(dict):
         self[self.last_id] = obj
 
 
+class Connection:
+    """
+    A client connected to the IPC socket. `send` can be called from any thread, the data is written by the event
+    loop.
+    """
+
+    def __init__(self, conn_id: int, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self.id = conn_id
+        self.writer = writer
+        self.loop = loop
+        self.closed = False
+        self.binary = False
+        self._loop_thread = threading.get_ident()
+
+    def _write(self, messages: Messages):
+        # encoded here, so messages sent from other threads before switching modes use the right one.
+        if not self.closed:
+            self.writer.write(encode_messages(messages, self.binary))
+
+    def send(self, messages: Messages):
+        if threading.get_ident() == self._loop_thread:
+            self._write(messages)
+        else:
+            self.loop.call_soon_threadsafe(self._write, messages)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+    def __repr__(self):
+        return f'<Connection {self.id}{" closed" if self.closed else ""}>'
+
+
+class Subscriber:
+    """
+    Events for one connection. `push` never blocks, events wait in a bounded queue until the client reads what was
+    already written to it. If the client is too slow the oldest events are dropped and it's told how many.
+    """
+
+    def __init__(self, conn: Connection, max_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.conn = conn
+        self.topics: typing.Set[str] = set()
+        # topic: function deciding which events of that topic get sent, for topics subscribed to with a filter
+        self.filters: typing.Dict[str, typing.Callable[[dict], bool]] = {}
+        self.queue: typing.Deque[Messages] = collections.deque(maxlen=max_size)
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self._run(), loop=conn.loop)
+
+    def push(self, messages: Messages):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(messages)
+        if threading.get_ident() == self.conn._loop_thread:
+            self._wakeup.set()
+        else:
+            self.conn.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        try:
+            while not self.conn.closed:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.queue and not self.conn.closed:
+                    if self.dropped:
+                        dropped, self.dropped = self.dropped, 0
+                        self.conn.send(format_json({
+                            'type': 'subscription/dropped',
+                            'source': 'subscribe',
+                            'count': dropped
+                        }))
+                    self.conn.send(self.queue.popleft())
+                    # only waits if the client isn't reading, new events pile up in the queue in the meantime.
+                    await self.conn.writer.drain()
+        except ConnectionError:
+            pass
+
+    def close(self):
+        self.task.cancel()
+        self.queue.clear()
+
+
 log = main.make_log_function('plugin_ipc')
-commands: typing.Dict[str, typing.Callable[[socket.socket, str, int], str]] = {}
-sockets: ListDict = ListDict()
+commands: typing.Dict[str, typing.Callable[[Connection, str, int], typing.Optional[Messages]]] = {}
+connections: ListDict = ListDict()
+subscribers: typing.Dict[int, Subscriber] = {}
+# topic: {connection id: subscriber}
+subscriptions: typing.Dict[str, typing.Dict[int, Subscriber]] = {}
 
-server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-if os.path.isfile('./ipc_server'):
-    os.unlink('./ipc_server')
-server_socket.bind('./ipc_server')
-server_socket.listen(0)
 
-_old_send = main.bot.send
+def has_subscribers(topic: str) -> bool:
+    return bool(subscriptions.get(topic))
+
+
+def publish(topic: str, data: dict):
+    """Send an event to everyone subscribed to `topic`. Can be called from any thread."""
+    subs = subscriptions.get(topic)
+    if not subs:
+        return
+    message = None
+    for sub in list(subs.values()):
+        accept = sub.filters.get(topic)
+        if accept is not None and not accept(data):
+            continue
+        if message is None:
+            message = format_json({
+                'type': 'event',
+                'source': 'subscribe',
+                'topic': topic,
+                'data': data
+            })
+        sub.push(message)
 
 
 def send_msg_to_socket(sock_id, msg):
-    if sock_id in sockets:
-        sockets[sock_id].send(f'~~{msg.text}\r\n'.encode('utf-8'))
+    if sock_id in connections:
+        connections[sock_id].send([(KIND_CHAT, msg.text.encode('utf-8'))])
     else:
         log('warn', 'Cannot send message to deleted connection. Happened here:')
         st = traceback.format_stack(limit=100)
@@ -81,20 +238,46 @@ def send_msg_to_socket(sock_id, msg):
 class IPCMiddleware(twitchirc.AbstractMiddleware):
     def send(self, event: Event) -> None:
         msg: typing.Union[str, bytes, twitchirc.Message] = event.data['message']
-        queue: typing.Optional[str] = event.data['queue'] if 'queue' in event.data else None
         if isinstance(msg, twitchirc.ChannelMessage):
             m = re.match(r'__IPC ([0-9]+)', msg.channel)
             if m:
                 event.cancel()
                 send_msg_to_socket(int(m.group(1)), msg)
-            else:
-                return
+            elif msg.text.startswith(MODERATION_COMMANDS) and has_subscribers('moderation'):
+                action, *args = msg.text.split(' ', 2)
+                publish('moderation', {
+                    'channel': msg.channel,
+                    'action': action[1:],
+                    'target': args[0] if args else None,
+                    'text': msg.text,
+                    'time': time.time()
+                })
 
     def receive(self, event: Event) -> None:
-        pass
+        msg = event.data['message']
+        if isinstance(msg, twitchirc.ChannelMessage):
+            topic = f'chat:{msg.channel}'
+            if has_subscribers(topic):
+                publish(topic, {
+                    'channel': msg.channel,
+                    'user': msg.user,
+                    'user_id': msg.flags.get('user-id'),
+                    'display_name': msg.flags.get('display-name'),
+                    'id': msg.flags.get('id'),
+                    'text': msg.text,
+                    'time': time.time()
+                })
 
     def command(self, event: Event) -> None:
-        pass
+        if has_subscribers('commands'):
+            msg = event.data['message']
+            publish('commands', {
+                'channel': msg.channel,
+                'user': msg.user,
+                'command': event.data['command'].chat_command,
+                'text': msg.text,
+                'time': time.time()
+            })
 
     def permission_check(self, event: Event) -> None:
         pass
@@ -118,22 +301,6 @@ class IPCMiddleware(twitchirc.AbstractMiddleware):
 main.bot.middleware.append(IPCMiddleware())
 
 
-# def new_send(message: typing.Union[str, twitchirc.ChannelMessage], queue='misc') -> None:
-#     if isinstance(message, twitchirc.ChannelMessage) and (message.user.startswith('__IPC ')
-#                                                           or message.channel.startswith('__IPC ')):
-#         print(message)
-#         sock_id = int(message.channel.split(' ', 1)[1])
-#         if sock_id in sockets:
-#             sockets[sock_id].send(('~~' + message.text).encode('utf-8'))
-#         else:
-#             return  # socket was closed.
-#     else:
-#         return  # _old_send(message, queue)
-#
-#
-# main.bot.send = new_send
-#
-#
 def add_command(command_name):
     def decorator(func):
         commands[command_name.lower()] = func
@@ -143,102 +310,110 @@ def add_command(command_name):
     return decorator
 
 
-def _purge_closed():
-    global sockets
-    for k, v in sockets.copy().items():
-        v: socket.socket
-        if v.fileno() == -1:
-            del sockets[k]
-            del response_write_queues[k]
-
-
-msg_buffer: Dict[int, bytes] = {
-}
-response_write_queues: Dict[int, queue.Queue] = {
-
-}
+def subscribe(conn: Connection, topics: typing.Iterable[str],
+              accept: typing.Optional[typing.Callable[[dict], bool]] = None) -> Subscriber:
+    """
+    Subscribe `conn` to `topics`. If `accept` is given only events for which it returns True are sent, otherwise
+    all of them.
+    """
+    sub = subscribers.get(conn.id)
+    if sub is None:
+        sub = Subscriber(conn)
+        subscribers[conn.id] = sub
+    for topic in topics:
+        sub.topics.add(topic)
+        if accept is None:
+            sub.filters.pop(topic, None)
+        else:
+            sub.filters[topic] = accept
+        subscriptions.setdefault(topic, {})[conn.id] = sub
+    return sub
 
 
-def _find_message(sock_id):
-    print(sock_id, msg_buffer[sock_id])
-    if b'\r\n' in msg_buffer[sock_id]:
-        p_1, p_2 = msg_buffer[sock_id].split(b'\r\n', 1)
-        msg_buffer[sock_id] = p_2
-        return p_1
-    return None
+def unsubscribe(sock_id, topics: typing.Iterable[str]):
+    sub = subscribers.get(sock_id)
+    if sub is None:
+        return
+    for topic in list(topics):
+        sub.topics.discard(topic)
+        sub.filters.pop(topic, None)
+        subs = subscriptions.get(topic)
+        if subs is not None:
+            subs.pop(sock_id, None)
+            if not subs:
+                del subscriptions[topic]
+    if not sub.topics:
+        del subscribers[sock_id]
+        sub.close()
+
+
+def _close_connection(sock_id):
+    sub = subscribers.get(sock_id)
+    if sub is not None:
+        unsubscribe(sock_id, sub.topics)
+    conn = connections.pop(sock_id, None)
+    if conn is not None:
+        conn.close()
+
+
+# Database queries made by commands run here, instead of in a new thread for every request.
+db_executor = DBExecutor(log=log)
+
+
+def _internal_error() -> Messages:
+    return (error(-500, 'Internal error')
+            +
+            format_json({
+                'type': 'error',
+                'message': 'Internal error',
+                'source': 'command_handler'
+            }))
 
 
-def format_json(data) -> bytes:
-    return (f'$' + json.dumps(data) + '\r\n').encode('utf-8')
-
-
-def _check_for_messages():
-    global sockets
-    _purge_closed()
-    read_ready, _, _ = select.select(sockets.values(), [], [], 0)
-    if read_ready:
-        for sock in read_ready:
-            msg: bytes = sock.recv(8_192)
-            sock_id = _get_sock_id(sock)
-
-            if sock_id == -1:
-                raise main.WayTooDank('weee woo')
-            if msg == b'':
-                log('debug', f'Auto-close bad connection {sock_id}')
-                sock.close()
-                if sock_id in sockets:
-                    del sockets[sock_id]
-                return
-            if sock_id in msg_buffer:
-                msg_buffer[sock_id] += msg
-            else:
-                msg_buffer[sock_id] = msg
-            message = _find_message(sock_id)
-            if message is not None:
-                on_receive_message(sock, message, sock_id)
+def submit_query(command: str, conn: Connection, function: typing.Callable[[Connection], typing.Any]):
+    """
+    Run `function(conn)` in `db_executor`, it should send the response itself.
 
+    :return: Error to send back if too many queries are waiting, None otherwise.
+    """
+    future = db_executor.submit(command, function, conn)
+    if future is None:
+        log('warn', f'Database executor is full, rejected {command} from connection {conn.id}')
+        return (error(503, 'Too many requests, try again later.')
+                +
+                format_json({
+                    'type': 'error',
+                    'source': command,
+                    'message': 'Too many requests, try again later.'
+                }))
 
-def _get_sock_id(sock):
-    for k, s in sockets.items():
-        if sock is s:
-            return k
-    return -1
+    def _on_done(f):
+        if f.exception() is not None:
+            conn.send(_internal_error())
 
+    future.add_done_callback(_on_done)
+    return None
 
-def on_receive_message(sock: socket.socket, msg: bytes, sock_id):
-    print(f'Recv message {msg}')
-    if sock_id == -1:
-        log('err', 'How did this happen?\n'
-                   'Received message from socket with no internal id.')
-        log('warn', traceback.format_stack())
-        return
 
-    msg: str = msg.decode('utf-8')
+async def on_receive_message(conn: Connection, msg: bytes, sock_id):
+    log('debug', f'Recv message {msg}')
+    msg: str = msg.decode('utf-8', 'replace')
     cmd = msg.split(' ', 1)
-    print(repr(cmd), repr(cmd[0].lower()), commands)
     if cmd[0].lower() in commands:
-        print(f'TRIGGER COMMAND {cmd[0]} with args: {cmd!r}')
         try:
-            result = commands[cmd[0].lower()](sock, msg, sock_id)
-        except:
-            for i in ''.join(traceback.format_stack(1000)).split('\n'):
+            result = commands[cmd[0].lower()](conn, msg, sock_id)
+            if inspect.isawaitable(result):
+                result = await result
+        except Exception:
+            for i in traceback.format_exc().split('\n'):
                 log('warn', i)
 
-            result = (b'!-500\r\n'
-                      b'~Internal error\r\n'
-                      +
-                      format_json({
-                          'type': 'error',
-                          'message': 'Internal error',
-                          'source': 'command_handler'
-                      }))
-
-        if isinstance(result, str):
-            sock.send(result.encode('utf-8'))
-        elif isinstance(result, bytes):
-            sock.send(result)
+            result = _internal_error()
+
+        if result:
+            conn.send(result)
     else:
-        sock.send((b'!1\r\n~No command\r\n'
+        conn.send((error(1, 'No command')
                    +
                    format_json({
                        'type': 'error',
@@ -247,48 +422,74 @@ def on_receive_message(sock: socket.socket, msg: bytes, sock_id):
                    })))
 
 
-def _check_for_new_connections():
-    read_ready, _, _ = select.select([server_socket], [], [], 0)
-    if read_ready:
-        sock, ip = server_socket.accept()
-        sockets.append(sock)
-        print(f'Accepted connection for {ip}. Sock id {sockets.last_id}')
-        response_write_queues[sockets.last_id] = queue.Queue()
-        sock.send(f'~Welcome to the Mm\'s Utility bot IPC interface.\r\n'.encode('utf-8'))
-        sock.send(f'~You have logged in with ID {sockets.last_id}\r\n'.encode('utf-8'))
-        sock.send(format_json({
-            'type': 'login/your_id',
-            'id': sockets.last_id,
-            'source': 'login_burst'
-        }))
-
-
-def _write_queued_messages():
-    for sid, q in response_write_queues.items():
-        while not q.empty():
-            task = q.get(False)
-            log('debug', f'Write message {task} to socket {sid}')
-            sockets[sid].send(task)
-            q.task_done()
-            log('debug', f'Done.')
+def _message_too_long(conn: Connection):
+    log('warn', f'Connection {conn.id} sent a message longer than {MAX_MESSAGE_SIZE} bytes, closing.')
+    conn.send(error(1, 'Message too long')
+              + format_json({
+                  'type': 'error',
+                  'message': 'Message too long',
+                  'source': 'connection'
+              }))
+
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    conn = Connection(connections.last_id + 1, writer, asyncio.get_event_loop())
+    connections.append(conn)
+    sock_id = conn.id
+    log('debug', f'Accepted connection. Sock id {sock_id}')
+    conn.send(output('Welcome to the Mm\'s Utility bot IPC interface.')
+              + output(f'You have logged in with ID {sock_id}')
+              + format_json({
+                  'type': 'login/your_id',
+                  'id': sock_id,
+                  'source': 'login_burst'
+              }))
+    try:
+        while not conn.closed:
+            if conn.binary:
+                length, kind = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                if length > MAX_MESSAGE_SIZE:
+                    _message_too_long(conn)
+                    break
+                message = await reader.readexactly(length)
+                if kind != KIND_COMMAND:
+                    conn.send(error(1, 'Unknown frame kind')
+                              + format_json({
+                                  'type': 'error',
+                                  'message': f'Unknown frame kind: {kind}',
+                                  'source': 'connection'
+                              }))
+                    continue
+            else:
+                # readuntil returns every complete message that's already buffered without waiting for the socket.
+                message = (await reader.readuntil(b'\r\n'))[:-2]
+            await on_receive_message(conn, message, sock_id)
+    except asyncio.IncompleteReadError:
+        log('debug', f'Connection {sock_id} closed.')
+    except asyncio.LimitOverrunError:
+        _message_too_long(conn)
+    except (ConnectionError, OSError) as e:
+        log('debug', f'Connection {sock_id} failed: {e}')
+    finally:
+        _close_connection(sock_id)
 
 
-def on_timer_hit():
-    try:
-        _check_for_new_connections()
-        _check_for_messages()
-        _write_queued_messages()
-    except:
-        log('err', traceback.format_exc())
+async def _start_server():
+    if os.path.exists(SOCKET_PATH):
+        os.unlink(SOCKET_PATH)
+    server = await asyncio.start_unix_server(_handle_connection, path=SOCKET_PATH, limit=MAX_MESSAGE_SIZE)
+    log('info', f'Listening on {SOCKET_PATH}')
+    return server
 
 
-main.bot.schedule_repeated_event(0.1, 5, on_timer_hit, (), {})
+# Starts once the bot's event loop runs.
+server_task = asyncio.ensure_future(_start_server(), loop=asyncio.get_event_loop())
 
 
 # basic commands:
 
 @add_command('run')
-def _command_run(sock: socket.socket, msg: str, socket_id):
+async def _command_run(conn: Connection, msg: str, socket_id):
     text = msg.split(' ', 1)[1]
     message = twitchirc.ChannelMessage(channel=f'__IPC {socket_id}',
                                        text=text,
@@ -306,36 +507,91 @@ def _command_run(sock: socket.socket, msg: str, socket_id):
         'emotes': ''
     }
     # noinspection PyProtectedMember
-    main.bot._call_command_handlers(message)
-    return f'~Sent: {text} as {message.user!r}\r\n'.encode('utf-8')
+    await main.bot._acall_command_handlers(message)
+    return output(f'Sent: {text} as {message.user!r}')
+
+
+@add_command('binary')
+def _command_binary(conn: Connection, msg: str, socket_id):
+    """
+    Switch to binary mode. The confirmation is the last text line sent, everything after it is framed (see
+    FRAME_HEADER). The next message is read as a frame, clients don't have to wait for the confirmation.
+    """
+    conn.send(output(BINARY_CONFIRMATION))
+    conn.binary = True
 
 
 @add_command('quit')
-def _command_quit(sock: socket.socket, msg: str, socket_id):
-    global sockets, msg_buffer
+def _command_quit(conn: Connection, msg: str, socket_id):
     log('debug', f'Closed connection {socket_id} by request.')
-    sock.shutdown(socket.SHUT_RDWR)
-    sock.close()
-    if socket_id in sockets:
-        del sockets[socket_id]
-    if socket_id in msg_buffer:
-        del msg_buffer[socket_id]
+    _close_connection(socket_id)
     return None
 
 
+def _parse_topics(text: str) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """Return valid and invalid topics from a space separated list."""
+    valid, invalid = [], []
+    for topic in text.split():
+        if topic.startswith('chat:') and len(topic) > 5:
+            valid.append('chat:' + topic[5:].lstrip('#').lower())
+        elif topic in TOPICS:
+            valid.append(topic)
+        else:
+            invalid.append(topic)
+    return valid, invalid
+
+
+def _subscription_info(sub: typing.Optional[Subscriber], command: str) -> Messages:
+    topics = sorted(sub.topics) if sub is not None else []
+    return (output(f'Subscribed to: {", ".join(topics) or "nothing"}')
+            + format_json({
+                'type': 'subscriptions',
+                'source': command,
+                'topics': topics
+            }))
+
+
+@add_command('subscribe')
+def _command_subscribe(conn: Connection, msg: str, socket_id):
+    """
+    subscribe TOPIC...: get events as they happen. Topics are chat:CHANNEL, commands, moderation and logs.
+    """
+    topics, invalid = _parse_topics(msg.split(' ', 1)[1] if ' ' in msg else '')
+    if invalid or not topics:
+        return (error(1, f'Invalid topics: {", ".join(invalid)}. Valid topics are chat:CHANNEL, '
+                         f'{", ".join(TOPICS)}')
+                + format_json({
+                    'type': 'error',
+                    'source': 'subscribe',
+                    'message': 'Invalid topics',
+                    'topics': invalid
+                }))
+    return _subscription_info(subscribe(conn, topics), 'subscribe')
+
+
+@add_command('unsubscribe')
+def _command_unsubscribe(conn: Connection, msg: str, socket_id):
+    """
+    unsubscribe [TOPIC...]: stop getting events for the topics, or all of them.
+    """
+    sub = subscribers.get(socket_id)
+    if sub is not None:
+        unsubscribe(socket_id, _parse_topics(msg.split(' ', 1)[1])[0] if ' ' in msg else sub.topics)
+    return _subscription_info(subscribers.get(socket_id), 'unsubscribe')
+
+
 @add_command('get_user_alias')
-def _command_get_user_alias(sock: socket.socket, msg: str, socket_id):
+def _command_get_user_alias(conn: Connection, msg: str, socket_id):
     arg: str
     _, arg = msg.replace('\n', '').replace('\r\n', '').split(' ', 1)
     if arg.isnumeric():
         user_id = int(arg)
 
-        def _fetch_user(rwq):
+        def _fetch_user(conn):
             u = main.User.get_by_local_id(user_id)
             if u is None:
-                rwq.put(
-                    b'!2\r\n'
-                    b'~A user with this ID doesn\'t exist.'
+                conn.send(
+                    error(2, 'A user with this ID doesn\'t exist.')
                     +
                     format_json({
                         'type': 'error',
@@ -343,7 +599,7 @@ def _command_get_user_alias(sock: socket.socket, msg: str, socket_id):
                         'message': 'A user with this ID doesn\'t exist.'
                     }))
             else:
-                rwq.put(format_json({
+                conn.send(format_json({
                     'type': 'user_fetch',
                     'source': 'get_user_alias',
                     'id': u.id,
@@ -353,11 +609,9 @@ def _command_get_user_alias(sock: socket.socket, msg: str, socket_id):
                     'username': u.last_known_username,
                 }))
 
-        t = threading.Thread(target=_fetch_user, args=(response_write_queues[socket_id],))
-        t.start()
+        return submit_query('get_user_alias', conn, _fetch_user)
     else:
-        return (b'!1\r\n'
-                b'~Bad user id\r\n'
+        return (error(1, 'Bad user id')
                 +
                 format_json({
                     'type': 'error',
@@ -367,18 +621,17 @@ def _command_get_user_alias(sock: socket.socket, msg: str, socket_id):
 
 
 @add_command('get_user_id')
-def _command_get_user_id(sock: socket.socket, msg: str, socket_id):
+def _command_get_user_id(conn: Connection, msg: str, socket_id):
     arg: str
     _, arg = msg.replace('\n', '').replace('\r\n', '').split(' ', 1)
     if arg.isnumeric():
         user_id = int(arg)
 
-        def _fetch_user(rwq):
+        def _fetch_user(conn):
             u = main.User.get_by_twitch_id(user_id)
             if u is None:
-                rwq.put(
-                    b'!2\r\n'
-                    b'~A user with this ID is not known to this bot.'
+                conn.send(
+                    error(2, 'A user with this ID is not known to this bot.')
                     +
                     format_json({
                         'type': 'error',
@@ -386,7 +639,7 @@ def _command_get_user_id(sock: socket.socket, msg: str, socket_id):
                         'message': 'A user with this ID is not known to this bot.'
                     }))
             else:
-                rwq.put(format_json({
+                conn.send(format_json({
                     'type': 'user_fetch',
                     'source': 'get_user_id',
                     'id': u.id,
@@ -396,11 +649,9 @@ def _command_get_user_id(sock: socket.socket, msg: str, socket_id):
                     'username': u.last_known_username,
                 }))
 
-        t = threading.Thread(target=_fetch_user, args=(response_write_queues[socket_id],))
-        t.start()
+        return submit_query('get_user_id', conn, _fetch_user)
     else:
-        return (b'!1\r\n'
-                b'~Bad user id\r\n'
+        return (error(1, 'Bad user id')
                 +
                 format_json({
                     'type': 'error',
@@ -410,16 +661,15 @@ def _command_get_user_id(sock: socket.socket, msg: str, socket_id):
 
 
 @add_command('get_user_name')
-def _command_get_user_name(sock: socket.socket, msg: str, socket_id):
+def _command_get_user_name(conn: Connection, msg: str, socket_id):
     arg: str
     _, arg = msg.replace('\n', '').replace('\r\n', '').split(' ', 1)
 
-    def _fetch_user(rwq):
+    def _fetch_user(conn):
         u = main.User.get_by_name(arg)
         if len(u) == 0:
-            rwq.put(
-                b'!2\r\n'
-                b'~A user with this ID is not known to this bot.'
+            conn.send(
+                error(2, 'A user with this ID is not known to this bot.')
                 +
                 format_json({
                     'type': 'error',
@@ -427,7 +677,7 @@ def _command_get_user_name(sock: socket.socket, msg: str, socket_id):
                     'message': 'A user with this ID is not known to this bot.'
                 }))
         elif len(u) > 1:
-            rwq.put(format_json({
+            conn.send(format_json({
                 'type': 'user_fetch',
                 'source': 'get_user_name',
                 'multiple': [
@@ -443,7 +693,7 @@ def _command_get_user_name(sock: socket.socket, msg: str, socket_id):
             }))
         else:
             u = u[0]
-            rwq.put(format_json({
+            conn.send(format_json({
                 'type': 'user_fetch',
                 'source': 'get_user_name',
                 'id': u.id,
@@ -453,8 +703,82 @@ def _command_get_user_name(sock: socket.socket, msg: str, socket_id):
                 'username': u.last_known_username,
             }))
 
-    t = threading.Thread(target=_fetch_user, args=(response_write_queues[socket_id],))
-    t.start()
+    return submit_query('get_user_name', conn, _fetch_user)
+
+
+# Most keys a single get_users_by_* command can look up.
+MAX_BATCH_KEYS = 100
+
+
+def _user_json(user) -> dict:
+    return {
+        'id': user.id,
+        'mod_in': user.mod_in,
+        'sub_in': user.sub_in,
+        'twitch_id': user.twitch_id,
+        'username': user.last_known_username,
+    }
+
+
+def _batch_lookup(command: str, conn: Connection, msg: str, column_name: str, numeric: bool):
+    """
+    Handle `command key1,key2,...`: look up all users matching the keys with one query and send them as one
+    JSON array. Keys that matched nothing are listed in `missing`.
+    """
+    arg = msg.replace('\n', '').replace('\r\n', '').split(' ', 1)[1] if ' ' in msg else ''
+    keys = list(dict.fromkeys(i.strip() for i in arg.split(',') if i.strip()))
+    if not keys or len(keys) > MAX_BATCH_KEYS or (numeric and not all(i.isnumeric() for i in keys)):
+        message = (f'Usage: {command} KEY1,KEY2,... with at most {MAX_BATCH_KEYS} '
+                   f'{"numeric " if numeric else ""}keys.')
+        return (error(1, message)
+                +
+                format_json({
+                    'type': 'error',
+                    'source': command,
+                    'message': message
+                }))
+    if numeric:
+        keys = [int(i) for i in keys]
+    else:
+        keys = list(dict.fromkeys(i.lower() for i in keys))
+
+    def _fetch_users(conn):
+        users = main.User.get_many(getattr(main.User, column_name), keys)
+        found = {getattr(u, column_name) for u in users}
+        conn.send(format_json({
+            'type': 'user_list',
+            'source': command,
+            'data': [_user_json(u) for u in users],
+            'missing': [i for i in keys if i not in found]
+        }))
+
+    return submit_query(command, conn, _fetch_users)
+
+
+@add_command('get_users_by_id')
+def _command_get_users_by_id(conn: Connection, msg: str, socket_id):
+    return _batch_lookup('get_users_by_id', conn, msg, 'twitch_id', numeric=True)
+
+
+@add_command('get_users_by_alias')
+def _command_get_users_by_alias(conn: Connection, msg: str, socket_id):
+    return _batch_lookup('get_users_by_alias', conn, msg, 'id', numeric=True)
+
+
+@add_command('get_users_by_name')
+def _command_get_users_by_name(conn: Connection, msg: str, socket_id):
+    return _batch_lookup('get_users_by_name', conn, msg, 'last_known_username', numeric=False)
+
+
+@add_command('db_stats')
+def _command_db_stats(conn: Connection, msg: str, socket_id):
+    return format_json({
+        'type': 'db_stats',
+        'source': 'db_stats',
+        'pending': db_executor.pending,
+        'max_pending': db_executor.max_pending,
+        'commands': [i.to_json() for i in db_executor.stats()]
+    })
 
 
 print(commands)
@@ -12,15 +12,23 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import collections
+import datetime
+import itertools
+import json
+import os
 import queue
 import threading
 import time
 import typing
 
 import regex
+import sqlalchemy
 
+import plugins.models.logcount as logcount_model
 import plugins.models.logentry as logentry_model
-from plugins.models.logentry import CAUSE_TASK, CAUSE_OTHER
+from plugins.models.logentry import CAUSE_TASK, CAUSE_OTHER, CAUSES
+from plugins.utils import arg_parser
 
 try:
     # noinspection PyPackageRequirements
@@ -37,11 +45,74 @@ NAME = 'logs'
 __meta_data__ = {
     'name': f'plugin_{NAME}',
     'commands': [
+        'mb.logs'
     ]
 }
 _print = print
 log = main.make_log_function(NAME)
 LogEntry = logentry_model.get(main.Base)
+LogCount = logcount_model.get(main.Base)
+
+# Entries waiting to be written, if the database can't keep up the rest goes to OVERFLOW_POLICY.
+MAX_QUEUE_SIZE = 10_000
+# 'spill' appends entries to SPILL_FILE, they are written to the database once it catches up. 'drop' drops them.
+OVERFLOW_POLICY = 'spill'
+SPILL_FILE = 'logs_spill.jsonl'
+# Batches grow with the number of waiting entries, between these sizes.
+MIN_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 1000
+# Longest time an entry waits before its batch is written, in seconds.
+FLUSH_INTERVAL = 5
+# After a failed write batches go straight to the spill file for this long, doubling up to the maximum while the
+# database stays unavailable.
+RETRY_MIN_DELAY = 5
+RETRY_MAX_DELAY = 300
+# Entries the database refused to store, even one by one.
+REJECTED_FILE = 'logs_rejected.jsonl'
+
+# Debug and info entries older than this many days are replaced with hourly counts (see LogCount).
+DETAIL_RETENTION = 7
+# All entries older than this many days are deleted.
+MAX_RETENTION = 90
+# How often to compact the logs, in seconds.
+COMPACTION_INTERVAL = 60 * 60
+# Rows handled in one transaction, so that the table isn't locked for long.
+COMPACTION_CHUNK = 5000
+
+# Number of recent entries kept in memory for every level, see Plugin.find_recent.
+RECENT_PER_LEVEL = 500
+# Entries shown by mb.logs, chat messages are too short for more.
+CHAT_MAX_RECORDS = 3
+
+
+class LogRecord:
+    __slots__ = ('seq', 'time', 'source', 'level', 'message', 'cause')
+
+    def __init__(self, seq: int, time_: datetime.datetime, source: str, level: int, message: str, cause: int):
+        self.seq = seq
+        self.time = time_
+        self.source = source
+        self.level = level
+        self.message = message
+        self.cause = cause
+
+    def matches(self, source: typing.Optional[str] = None, min_level: typing.Optional[int] = None,
+                since: typing.Optional[datetime.datetime] = None) -> bool:
+        return ((source is None or self.source == source)
+                and (min_level is None or self.level >= min_level)
+                and (since is None or self.time >= since))
+
+    def to_json(self) -> dict:
+        return {
+            'time': self.time.timestamp(),
+            'source': self.source,
+            'level': self.level,
+            'message': self.message,
+            'cause': CAUSES.get(self.cause, self.cause)
+        }
+
+    def __repr__(self):
+        return f'<LogRecord #{self.seq} {self.source}/{self.level} at {self.time}>'
 
 
 class Logger:
@@ -49,10 +120,21 @@ class Logger:
         self.source = source
         self.parent: 'Plugin' = parent
 
+    def is_enabled(self, level):
+        return main.log_gate.is_enabled(level, self.source)
+
     def log(self, level, message, cause=CAUSE_OTHER):
+        if not main.log_gate.allow(level, self.source):
+            return
+        suppressed = main.log_gate.take_suppressed(self.source)
+        if suppressed:
+            message += f'\n({suppressed} lines were dropped by the rate limit)'
         return self.parent.log(self.source, level, message, cause=cause)
 
     def __call__(self, level, *message, cause=CAUSE_OTHER):
+        # check before joining, most debug lines never get past this.
+        if not main.log_gate.is_enabled(level, self.source):
+            return
         self.log(level, ' '.join([str(i) for i in message]), cause)
 
 
@@ -74,23 +156,146 @@ class Plugin(main.Plugin):
         }
         self.log_level = self.log_levels['debug']
         self.db_log_level = self.log_levels['info']
-        self._logger_queue = queue.Queue()
+        self._logger_queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
+        self._spill_lock = threading.Lock()
+        self.dropped = 0
+        self.spilled = 0
+        self._replay_file = None
+        self._retry_delay = 0
+        self._retry_at = 0.0  # time.monotonic() of the next write attempt after a failure
         self._logger_thread = threading.Thread(target=self._logger_thread_func, args=(self._logger_queue,))
         self._logger_thread.start()
         self._logger_thread_stop_lock = threading.Lock()
         self.oauth_pat = regex.compile(
             'oauth:[a-z0-9]{30}'
         )
+        # level: newest entries of that level
+        self.recent: typing.Dict[int, typing.Deque[LogRecord]] = {
+            i: collections.deque(maxlen=RECENT_PER_LEVEL) for i in self.log_levels.values()
+        }
+        self._record_ids = itertools.count()
+        self.plugin_ipc = None
+
         self._patch_main()
         self._register_atexit()
+        self._register_ipc()
+        self.c_logs = main.bot.add_command('mb.logs', required_permissions=['util.logs'],
+                                           enable_local_bypass=False)(self.c_logs)
+        self._compaction_lock = threading.Lock()
+        self._indexes_checked = False
+        self.compaction_task = main.deadlines.call_every(COMPACTION_INTERVAL, self._start_compaction, delay=60,
+                                                         name='logs.compaction')
 
     def _patch_main(self):
         print('patching logger')
         main.make_log_function = self.create_logger
         main.log = self.create_logger('main')
+        main.chat_log = self.create_logger('chat')
         main.print = lambda *args, **kwargs: log('info', *args, **kwargs)
         print('patched logger')
 
+    def _register_ipc(self):
+        # loaded here, not at the top, so that plugin_ipc gets a patched logger
+        main.load_file('plugins/plugin_ipc.py')
+        try:
+            import plugin_plugin_ipc as plugin_ipc
+        except ImportError:
+            import plugins.plugin_ipc as plugin_ipc
+        self.plugin_ipc = plugin_ipc
+        plugin_ipc.add_command('logs')(self._ipc_logs)
+
+    def _parse_filters(self, text: str) -> typing.Tuple[dict, dict]:
+        """
+        Parse source:SOURCE level:LEVEL since:TIME limit:COUNT from `text`.
+
+        :return: Arguments for find_recent and all parsed arguments.
+        :raises arg_parser.ParserError: if the arguments are invalid.
+        """
+        args = arg_parser.parse_args(text, {
+            'source': str,
+            'level': str,
+            'since': datetime.timedelta,
+            'limit': int,
+            'tail': bool,
+            'stop': bool
+        })
+        if args['level'] is not ... and args['level'] not in self.log_levels:
+            raise arg_parser.ParserError(f'Unknown level: {args["level"]!r}, '
+                                         f'valid levels are {", ".join(self.log_levels)}')
+        filters = {
+            'source': args['source'] if args['source'] is not ... else None,
+            'min_level': self.log_levels[args['level']] if args['level'] is not ... else None,
+            'since': datetime.datetime.now() - args['since'] if args['since'] is not ... else None
+        }
+        return filters, args
+
+    def find_recent(self, source: typing.Optional[str] = None, min_level: typing.Optional[int] = None,
+                    since: typing.Optional[datetime.datetime] = None, limit: int = 50) -> typing.List[LogRecord]:
+        """Return the newest `limit` entries from memory that match the filters, oldest first."""
+        records = []
+        for level, ring in list(self.recent.items()):
+            if min_level is not None and level < min_level:
+                continue
+            records.extend(i for i in ring.copy() if i.matches(source, None, since))
+        records.sort(key=lambda i: i.seq)
+        return records[-limit:]
+
+    def c_logs(self, msg: twitchirc.ChannelMessage):
+        try:
+            filters, args = self._parse_filters(main.delete_spammer_chrs(msg.text))
+        except arg_parser.ParserError as e:
+            return f'@{msg.user}, error: {e.message}'
+        records = self.find_recent(**filters, limit=args['limit'] if args['limit'] is not ... else RECENT_PER_LEVEL)
+        if not records:
+            return f'@{msg.user}, no matching log entries.'
+        level_names = {v: k for k, v in self.log_levels.items()}
+        shown = [f'[{i.time.strftime("%H:%M:%S")}] {i.source}/{level_names.get(i.level, i.level)}: '
+                 f'{i.message if len(i.message) <= 100 else i.message[:99] + chr(0x2026)}'
+                 for i in records[-CHAT_MAX_RECORDS:]]
+        return f'@{msg.user}, {len(records)} matching entries, newest: ' + ' | '.join(shown)
+
+    def _ipc_logs(self, sock, msg: str, socket_id):
+        """
+        logs [source:SOURCE] [level:LEVEL] [since:TIME] [limit:COUNT] [+tail]: send recent entries from memory.
+        With +tail new entries matching the filters are sent as they come in, until `logs +stop`. These are events of
+        the `logs` topic, tailing is the same as `subscribe logs` with filters.
+        """
+        format_json = self.plugin_ipc.format_json
+        try:
+            filters, args = self._parse_filters(msg.split(' ', 1)[1] if ' ' in msg else '')
+        except arg_parser.ParserError as e:
+            return (self.plugin_ipc.error(1, e.message)
+                    + format_json({
+                        'type': 'error',
+                        'source': 'logs',
+                        'message': e.message
+                    }))
+        if args['stop'] is True:
+            self.plugin_ipc.unsubscribe(socket_id, ['logs'])
+            return format_json({
+                'type': 'logs/tail_stopped',
+                'source': 'logs'
+            })
+
+        records = self.find_recent(**filters, limit=args['limit'] if args['limit'] is not ... else 50)
+        if args['tail'] is True:
+            self.plugin_ipc.subscribe(sock, ['logs'], accept=self._make_tail_filter(filters))
+        return format_json({
+            'type': 'logs',
+            'source': 'logs',
+            'records': [i.to_json() for i in records],
+            'tail': args['tail'] is True
+        })
+
+    @staticmethod
+    def _make_tail_filter(filters) -> typing.Callable[[dict], bool]:
+        # `since` doesn't matter, new entries are always newer.
+        def _accept(record: dict) -> bool:
+            return ((filters['source'] is None or record['source'] == filters['source'])
+                    and (filters['min_level'] is None or record['level'] >= filters['min_level']))
+
+        return _accept
+
     @property
     def no_reload(self):
         return True
@@ -101,10 +306,11 @@ class Plugin(main.Plugin):
 
     @property
     def commands(self) -> typing.List[str]:
-        return []
+        return ['mb.logs']
 
     def on_reload(self):
         print('on reload/exit')
+        main.deadlines.cancel(self.compaction_task)
         try:
             self._logger_thread_stop_lock.acquire()
             self._logger_queue.put(None)
@@ -118,14 +324,62 @@ class Plugin(main.Plugin):
 
     def _db_log(self, source: str, level: int, message: str, cause):
         if self.db_log_level <= level:
-            self._logger_queue.put(
-                {
-                    'source': source,
-                    'level': level,
-                    'message': message,
-                    'cause': cause
-                }
-            )
+            entry = {
+                'time': datetime.datetime.now(),
+                'source': source,
+                'level': level,
+                'message': message,
+                'cause': cause
+            }
+            try:
+                self._logger_queue.put_nowait(entry)
+            except queue.Full:
+                self._overflow([entry])
+
+    @staticmethod
+    def _write_entries(path: str, entries: typing.List[dict]):
+        with open(path, 'a') as f:
+            for i in entries:
+                f.write(json.dumps({**i, 'time': i['time'].isoformat()}) + '\n')
+
+    def _overflow(self, entries: typing.List[dict]):
+        if OVERFLOW_POLICY == 'spill':
+            try:
+                with self._spill_lock:
+                    self._write_entries(SPILL_FILE, entries)
+                self.spilled += len(entries)
+                return
+            except OSError as e:
+                _print(f'Failed to spill {len(entries)} log entries: {e}')
+        self.dropped += len(entries)
+
+    def _load_spilled(self) -> typing.List[dict]:
+        """
+        Take up to a batch of entries out of the spill file. The file is moved away first, entries spilled while it's
+        being read go to a new one.
+        """
+        replay_file = SPILL_FILE + '.replay'
+        if self._replay_file is None:
+            with self._spill_lock:
+                if not os.path.exists(replay_file):
+                    if not os.path.exists(SPILL_FILE):
+                        return []
+                    os.replace(SPILL_FILE, replay_file)
+            self._replay_file = open(replay_file, 'r')
+        lines = list(itertools.islice(self._replay_file, MAX_BATCH_SIZE))
+        if len(lines) < MAX_BATCH_SIZE:
+            self._replay_file.close()
+            self._replay_file = None
+            os.remove(replay_file)
+        entries = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                entry['time'] = datetime.datetime.fromisoformat(entry['time'])
+            except (ValueError, KeyError):
+                continue  # the line was cut off when the bot stopped
+            entries.append(entry)
+        return entries
 
     def _translate_level(self, level):
         if isinstance(level, int):
@@ -135,26 +389,72 @@ class Plugin(main.Plugin):
 
     def log(self, source: str, level: typing.Union[str, int], *message, cause=CAUSE_OTHER):
         msg = self.oauth_pat.sub('[OAUTH TOKEN]', '  '.join([str(i) for i in message]))
-        self._db_log(source, self._translate_level(level), msg, cause)
-        self._print_log(source, self._translate_level(level), msg, cause)
+        level = self._translate_level(level)
+        record = LogRecord(next(self._record_ids), datetime.datetime.now(), source, level, msg, cause)
+        ring = self.recent.get(level)
+        if ring is None:
+            ring = self.recent.setdefault(level, collections.deque(maxlen=RECENT_PER_LEVEL))
+        ring.append(record)
+        # plugin_ipc logs every write, sending those would never end.
+        if (self.plugin_ipc is not None and source != 'plugin_ipc'
+                and self.plugin_ipc.has_subscribers('logs')):
+            self.plugin_ipc.publish('logs', record.to_json())
+        self._db_log(source, level, msg, cause)
+        self._print_log(source, level, msg, cause)
 
     def create_logger(self, source):
         logger = Logger(source, self)
         logger.log('debug', 'Initialized logger.', cause=CAUSE_TASK)
         return logger
 
-    # noinspection PyMethodMayBeStatic
-    def _flush_batch(self, batch):
-        _print('Flushing batch...')
-        with main.session_scope_local_thread() as session:
-            for obj in batch:
-                session.add(LogEntry(**obj))
-        _print('Flushing done...')
+    def _flush_batch(self, batch, force=False):
+        if not force and time.monotonic() < self._retry_at:
+            self._overflow(batch)  # the database was unavailable recently, don't hammer it
+            return
+        try:
+            with main.db_engine.begin() as conn:
+                conn.execute(LogEntry.__table__.insert(), batch)
+        except Exception as e:
+            _print(f'Failed to write {len(batch)} log entries: {e}')
+            try:
+                with main.db_engine.connect() as conn:
+                    conn.execute(sqlalchemy.text('SELECT 1'))
+            except Exception:
+                self._retry_delay = min(max(self._retry_delay * 2, RETRY_MIN_DELAY), RETRY_MAX_DELAY)
+                self._retry_at = time.monotonic() + self._retry_delay
+                _print(f'Database is unavailable, retrying in {self._retry_delay} seconds.')
+                self._overflow(batch)
+                return
+            # the database works, some entries must be bad. Find them instead of failing every batch after this.
+            self._flush_one_by_one(batch)
+        self._retry_delay = 0
+        self._retry_at = 0.0
+
+    def _flush_one_by_one(self, batch):
+        rejected = []
+        for entry in batch:
+            try:
+                with main.db_engine.begin() as conn:
+                    conn.execute(LogEntry.__table__.insert(), entry)
+            except Exception:
+                rejected.append(entry)
+        if rejected:
+            _print(f'Database refused {len(rejected)} log entries, moved them to {REJECTED_FILE}')
+            try:
+                self._write_entries(REJECTED_FILE, rejected)
+            except OSError as e:
+                _print(f'Failed to save rejected log entries: {e}')
+                self.dropped += len(rejected)
+
+    @staticmethod
+    def _batch_size(waiting: int) -> int:
+        return min(max(waiting, MIN_BATCH_SIZE), MAX_BATCH_SIZE)
 
     def _logger_thread_func(self, q: queue.Queue):
         _print('Started logging...')
         batch = [
             {
+                'time': datetime.datetime.now(),
                 'source': 'logs',
                 'level': -1,
                 'message': 'Started logging.',
@@ -162,19 +462,119 @@ class Plugin(main.Plugin):
                 'cause': CAUSE_TASK
             }
         ]
-        batch_start = time.time()
+        batch.extend(self._load_spilled())
+        batch_start = time.monotonic()
         while 1:
-            data = q.get()
+            try:
+                data = q.get(timeout=max(batch_start + FLUSH_INTERVAL - time.monotonic(), 0))
+                # take everything that's already waiting, up to a batch.
+                size = self._batch_size(q.qsize() + 1)
+                while data is not None and len(batch) < size:
+                    batch.append(data)
+                    data = q.get_nowait()
+            except queue.Empty:
+                data = ...
             if self._logger_thread_stop_lock.locked() or data is None:
                 print('t: stop!')
+                if data is not None and data is not ...:
+                    batch.append(data)
+                while not q.empty():
+                    data = q.get_nowait()
+                    if data is not None:
+                        batch.append(data)
                 if batch:
-                    self._flush_batch(batch)
+                    self._flush_batch(batch, force=True)
                 return
-            batch.append(data)
-            if len(batch) > 50 or time.time() > batch_start + 30:
-                self._flush_batch(batch)
+            if data is not ...:
+                batch.append(data)
+            if len(batch) >= MIN_BATCH_SIZE or time.monotonic() > batch_start + FLUSH_INTERVAL:
+                if batch:
+                    self._flush_batch(batch)
                 batch = []
-                batch_start = time.time()
+                # the database caught up and isn't failing
+                if q.qsize() < MIN_BATCH_SIZE and time.monotonic() >= self._retry_at:
+                    batch = self._load_spilled()
+                batch_start = time.monotonic()
+
+    def _start_compaction(self):
+        # this can take a while, don't block the bot.
+        threading.Thread(target=self._compact, daemon=True, name='logs_compaction').start()
+
+    def _ensure_indexes(self):
+        # create_all doesn't add indexes to tables that already exist.
+        existing = {i['name'] for i in sqlalchemy.inspect(main.db_engine).get_indexes(LogEntry.__tablename__)}
+        for index in LogEntry.__table__.indexes:
+            if index.name not in existing:
+                log('info', f'Creating index {index.name}, this might take a while.')
+                index.create(bind=main.db_engine)
+        self._indexes_checked = True
+
+    def _compact(self):
+        if not self._compaction_lock.acquire(blocking=False):
+            log('warn', 'Previous log compaction is still running, skipping.')
+            return
+        try:
+            if not self._indexes_checked:
+                self._ensure_indexes()
+            now = datetime.datetime.now()
+            detail_cutoff = (now - datetime.timedelta(days=DETAIL_RETENTION)).replace(minute=0, second=0,
+                                                                                       microsecond=0)
+            compacted = 0
+            while True:
+                count = self._compact_chunk(detail_cutoff)
+                compacted += count
+                if count < COMPACTION_CHUNK:
+                    break
+
+            deleted = 0
+            while True:
+                count = self._delete_chunk(now - datetime.timedelta(days=MAX_RETENTION))
+                deleted += count
+                if count < COMPACTION_CHUNK:
+                    break
+            if compacted or deleted:
+                log('info', f'Compacted {compacted} log entries, deleted {deleted} entries older than '
+                            f'{MAX_RETENTION} days.')
+        except Exception as e:
+            log('err', f'Log compaction failed: {e}')
+        finally:
+            self._compaction_lock.release()
+
+    def _compact_chunk(self, cutoff: datetime.datetime) -> int:
+        """Replace up to COMPACTION_CHUNK debug and info entries from before `cutoff` with hourly counts."""
+        logs = LogEntry.__table__
+        counts = LogCount.__table__
+        with main.db_engine.begin() as conn:
+            rows = conn.execute(
+                sqlalchemy.select([logs.c.id, logs.c.time, logs.c.source, logs.c.level])
+                .where(sqlalchemy.and_(logs.c.time < cutoff, logs.c.level <= self.log_levels['info']))
+                .limit(COMPACTION_CHUNK)
+            ).fetchall()
+            if not rows:
+                return 0
+            hourly = collections.Counter((row.time.replace(minute=0, second=0, microsecond=0), row.source, row.level)
+                                         for row in rows)
+            for (hour, source, level), count in hourly.items():
+                result = conn.execute(
+                    counts.update()
+                    .where(sqlalchemy.and_(counts.c.hour == hour, counts.c.source == source, counts.c.level == level))
+                    .values(count=counts.c.count + count)
+                )
+                if not result.rowcount:
+                    conn.execute(counts.insert().values(hour=hour, source=source, level=level, count=count))
+            conn.execute(logs.delete().where(logs.c.id.in_([row.id for row in rows])))
+        return len(rows)
+
+    # noinspection PyMethodMayBeStatic
+    def _delete_chunk(self, cutoff: datetime.datetime) -> int:
+        logs = LogEntry.__table__
+        with main.db_engine.begin() as conn:
+            ids = [row.id for row in conn.execute(sqlalchemy.select([logs.c.id])
+                                                  .where(logs.c.time < cutoff)
+                                                  .limit(COMPACTION_CHUNK))]
+            if ids:
+                conn.execute(logs.delete().where(logs.c.id.in_(ids)))
+        return len(ids)
 
     def _print_log(self, source, level, message, cause):
         if self.log_level <= level:
@@ -96,13 +96,13 @@ async def _acall_command_handlers(message: twitchirc.ChannelMessage):
         was_handled = False
         if ' ' not in message.text:
             message.text += ' '
-        for handler in main.bot.commands:
-            if callable(handler.matcher_function) and handler.matcher_function(message, handler):
-                await _acall_handler(handler, message)
-                was_handled = True
-            if message.text.startswith(main.bot.prefix + handler.ef_command):
+        for handler in main.bot.commands.matchers.copy():
+            if handler.matcher_function(message, handler):
                 await _acall_handler(handler, message)
                 was_handled = True
+        for handler in main.bot.commands.lookup(message.text, main.bot.prefix):
+            await _acall_handler(handler, message)
+            was_handled = True
 
         if not was_handled:
             main.bot._do_unknown_command(message)
@@ -12,13 +12,17 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import codecs
 import datetime
+import itertools
 import time
 import typing
+from collections import deque
 
 import aiohttp
 import regex
 
+import plugins.models.nukejob as nukejob_model
 from plugins.utils import arg_parser
 
 try:
@@ -53,15 +57,244 @@ except ImportError:
 # noinspection PyUnresolvedReferences
 import twitchirc
 
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.outbound import PRIORITY_MODERATION, ELEVATED_CHANNEL_LIMIT
+except ImportError:
+    from plugins.helpers.outbound import PRIORITY_MODERATION, ELEVATED_CHANNEL_LIMIT
+
+NukeJob = nukejob_model.get(main.Base, main.session_scope)
+
 NAME = 'nuke'
 __meta_data__ = {
     'name': f'plugin_{NAME}',
     'commands': [
-        'nuke'
+        'nuke',
+        'nuke_url',
+        'unnuke'
     ]
 }
 log = main.make_log_function(NAME)
 
+# Moderation actions sent per second. Moderators can send 100 messages per 30 seconds, a fifth of that is left for
+# other messages.
+ACTION_RATE = 0.8 * ELEVATED_CHANNEL_LIMIT[0] / ELEVATED_CHANNEL_LIMIT[1]
+# Actions handed to the outbound queue at once. The job waits if the previous batch wasn't sent yet.
+BATCH_SIZE = 5
+# How often to tell the issuer how far a job got, in seconds.
+PROGRESS_INTERVAL = 30
+# Number of finished jobs per channel that can be reverted with unnuke. They are kept in the database.
+JOB_LOG_SIZE = 10
+
+# Limits for user lists downloaded by nuke_url, in bytes and characters.
+MAX_USER_LIST_SIZE = 2 * 1024 * 1024
+MAX_LINE_LENGTH = 256
+# Twitch logins: letters, digits and underscores, at most 25 characters, can't start with an underscore.
+TWITCH_LOGIN_PATTERN = regex.compile(r'[a-z0-9][a-z0-9_]{0,24}')
+
+REVERSE_ACTIONS = {
+    'timeout': 'untimeout',
+    'ban': 'unban'
+}
+
+
+def _add_users(users: typing.Dict[str, None], lines: typing.Iterable[str]) -> int:
+    """Add valid logins from `lines` to `users`. Returns the number of invalid lines."""
+    invalid = 0
+    for line in lines:
+        login = line.strip().lstrip('@').lower()
+        if not login:
+            continue
+        if TWITCH_LOGIN_PATTERN.fullmatch(login):
+            users[login] = None
+        else:
+            invalid += 1
+    return invalid
+
+
+async def read_user_list(content: aiohttp.StreamReader,
+                         max_size: int = MAX_USER_LIST_SIZE) -> typing.Tuple[typing.List[str], int]:
+    """
+    Read a list of users, one per line or separated with `$(newline)`, without keeping the whole text in memory.
+
+    :return: Valid logins without duplicates, in order of appearance and the number of invalid lines.
+    :raises ValueError: if the list is larger than `max_size` or contains a line that is way too long.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    users = {}  # used as an ordered set
+    invalid = 0
+    size = 0
+    rest = ''
+    async for chunk in content.iter_chunked(8192):
+        size += len(chunk)
+        if size > max_size:
+            raise ValueError(f'the list is larger than {max_size} bytes')
+        lines = (rest + decoder.decode(chunk)).replace('$(newline)', '\n').split('\n')
+        rest = lines.pop()  # incomplete line, the rest of it is in the next chunk
+        if len(rest) > MAX_LINE_LENGTH:
+            raise ValueError(f'the list contains a line longer than {MAX_LINE_LENGTH} characters')
+        invalid += _add_users(users, lines)
+    invalid += _add_users(users, (rest + decoder.decode(b'', final=True)).replace('$(newline)', '\n').split('\n'))
+    return list(users), invalid
+
+
+class ModerationJob:
+    """
+    Timeouts or bans for a list of users, sent a few at a time.
+
+    `done` lists the users whose actions were sent, in order, this is what `unnuke` reverts. `queued` is the
+    number of actions handed to the outbound queue.
+    """
+
+    def __init__(self, job_id: int, channel: str, issuer: str, action: str, targets: typing.List[str],
+                 timeout: typing.Optional[int] = None, reverts: typing.Optional[int] = None,
+                 origin: typing.Optional[twitchirc.ChannelMessage] = None):
+        self.id = job_id
+        self.channel = channel
+        self.issuer = issuer
+        self.origin = origin  # None for jobs loaded from the database
+        self.action = action
+        self.targets = targets
+        self.timeout = timeout
+        self.reverts = reverts
+        self.done: typing.List[str] = []
+        self.queued = 0
+        self.state = 'running'
+        self.last_progress = time.monotonic()
+        self.task = None
+
+    @staticmethod
+    def from_row(row) -> 'ModerationJob':
+        job = ModerationJob(row.id, row.channel, row.issuer, row.action, [], reverts=row.reverts)
+        job.done = row.users.split('\n') if row.users else []
+        job.targets = job.done
+        job.state = row.state
+        return job
+
+    def to_row(self):
+        return NukeJob(id=self.id, channel=self.channel, issuer=self.issuer, action=self.action,
+                       users='\n'.join(self.done), state=self.state, reverts=self.reverts)
+
+    @property
+    def remaining(self) -> int:
+        return len(self.targets) - len(self.done)
+
+    @property
+    def eta(self) -> datetime.timedelta:
+        return datetime.timedelta(seconds=round(self.remaining / ACTION_RATE))
+
+    def command_for(self, user: str) -> str:
+        if self.action == 'timeout':
+            return f'/timeout {user} {self.timeout}s nuked by {self.issuer}'
+        elif self.action == 'ban':
+            return f'/ban {user} nuked by {self.issuer}'
+        else:
+            return f'/{self.action} {user}'
+
+    def describe(self) -> str:
+        text = f'job #{self.id} ({self.action}'
+        if self.reverts is not None:
+            text += f', reverting #{self.reverts}'
+        text += f'): {self.state}, {len(self.done)}/{len(self.targets)} users done'
+        if self.state == 'running':
+            text += f', ETA {self.eta}'
+        return text
+
+    def __repr__(self):
+        return f'<ModerationJob #{self.id} {self.action} in #{self.channel} {len(self.done)}/{len(self.targets)}>'
+
+
+class ModerationExecutor:
+    """
+    Run moderation jobs, at most one per channel.
+
+    Jobs are paced at `ACTION_RATE`, the actions are sent with PRIORITY_MODERATION so they don't wait for other
+    messages. Finished and aborted jobs are saved in the database, the last JOB_LOG_SIZE per channel are kept.
+    """
+
+    def __init__(self):
+        self.running: typing.Dict[str, ModerationJob] = {}
+        # channel: recent jobs, loaded from the database the first time they're needed
+        self.job_log: typing.Dict[str, typing.Deque[ModerationJob]] = {}
+        self._ids = None
+
+    def _next_id(self) -> int:
+        if self._ids is None:  # the table doesn't exist yet when the plugin is loaded
+            self._ids = itertools.count(NukeJob.max_id() + 1)
+        return next(self._ids)
+
+    def _get_job_log(self, channel: str) -> typing.Deque[ModerationJob]:
+        jobs = self.job_log.get(channel)
+        if jobs is None:
+            jobs = deque((ModerationJob.from_row(i) for i in NukeJob.load_recent(channel, JOB_LOG_SIZE)),
+                         maxlen=JOB_LOG_SIZE)
+            self.job_log[channel] = jobs
+        return jobs
+
+    def start(self, origin: twitchirc.ChannelMessage, action: str, targets: typing.List[str],
+              timeout: typing.Optional[int] = None,
+              reverts: typing.Optional[ModerationJob] = None) -> typing.Optional[ModerationJob]:
+        """Start a job in `origin.channel`. Returns None if another job is running there."""
+        if origin.channel in self.running:
+            return None
+        job = ModerationJob(self._next_id(), origin.channel, origin.user, action, targets, timeout,
+                            reverts.id if reverts is not None else None, origin)
+        self.running[job.channel] = job
+        job.task = main.deadlines.call_later(0, self._step, args=(job,), priority=10, name='nuke.job')
+        log('info', f'Started {job!r} for {origin.user}')
+        return job
+
+    def abort(self, channel: str) -> typing.Optional[ModerationJob]:
+        job = self.running.get(channel)
+        if job is not None:
+            dropped = main.outbound.cancel(job)
+            log('info', f'Dropped {dropped} queued actions of {job!r}')
+            self._finish(job, 'aborted')
+        return job
+
+    def find(self, channel: str, job_id: typing.Optional[int] = None) -> typing.Optional[ModerationJob]:
+        """Find a finished job in `channel`, the most recent one if `job_id` isn't given."""
+        for job in reversed(self._get_job_log(channel)):
+            if job_id is None or job.id == job_id:
+                return job
+        return None
+
+    def _step(self, job: ModerationJob):
+        if job.state != 'running':
+            return
+        # don't put more actions in the queue if the last batch is still waiting there.
+        pending = main.outbound.pending(job.channel, PRIORITY_MODERATION)
+        count = max(BATCH_SIZE - pending, 0)
+        for user in job.targets[job.queued:job.queued + count]:
+            main.bot.send(job.origin.reply(job.command_for(user), force_slash=True), priority=PRIORITY_MODERATION,
+                          tag=job, on_sent=lambda user=user: job.done.append(user))
+            job.queued += 1
+        if job.queued == len(job.targets) and not main.outbound.pending(tag=job):
+            self._finish(job, 'finished')
+            return
+
+        now = time.monotonic()
+        if now - job.last_progress >= PROGRESS_INTERVAL:
+            job.last_progress = now
+            main.bot.send(job.origin.reply(f'@{job.issuer}, {job.describe()}'))
+        main.deadlines.reschedule(job.task, now + BATCH_SIZE / ACTION_RATE)
+
+    def _finish(self, job: ModerationJob, state: str):
+        job.state = state
+        main.deadlines.cancel(job.task)
+        del self.running[job.channel]
+        if job.done and job.action in REVERSE_ACTIONS:
+            self._get_job_log(job.channel).append(job)
+            try:
+                with main.session_scope() as session:
+                    session.add(job.to_row())
+                    session.flush()
+                    NukeJob.prune(job.channel, JOB_LOG_SIZE, session)
+            except Exception as e:
+                log('err', f'Failed to save {job!r}, it can only be reverted until the bot restarts: {e}')
+        log('info', f'{job!r} {state}')
+        main.bot.send(job.origin.reply(f'@{job.issuer}, {job.describe()}'))
+
 
 class Plugin(main.Plugin):
     def __init__(self, module, source):
@@ -69,13 +302,24 @@ class Plugin(main.Plugin):
         self.c_nuke = main.bot.add_command('nuke', required_permissions=['util.nuke'],
                                            enable_local_bypass=True)(self.c_nuke)
         self.c_nuke_url = main.bot.add_command('nuke_url', required_permissions=['util.nuke'],
-                                               enable_local_bypass=True)(self.c_nuke)
+                                               enable_local_bypass=True)(self.c_nuke_url)
+        self.c_unnuke = main.bot.add_command('unnuke', required_permissions=['util.nuke'],
+                                             enable_local_bypass=True)(self.c_unnuke)
         self.max_nuke = 30
+        self.executor = ModerationExecutor()
 
         plugin_help.create_topic('nuke',
                                  'Timeout or ban in bulk, searches by message. '
-                                 'Usage: nuke regex:REGEX [+perma] timeout:TIME search:TIME [+dry-run] [+force]',
+                                 'Usage: nuke regex:REGEX [+perma] timeout:TIME search:TIME [+dry-run] [+force], '
+                                 'nuke +status, nuke +abort',
                                  section=plugin_help.SECTION_COMMANDS)
+        plugin_help.create_topic('nuke status',
+                                 'Show how far the nuke running in this channel got.',
+                                 section=plugin_help.SECTION_ARGS)
+        plugin_help.create_topic('nuke abort',
+                                 'Stop the nuke running in this channel. Users that were already punished stay '
+                                 'punished, use unnuke to revert that.',
+                                 section=plugin_help.SECTION_ARGS)
         plugin_help.create_topic('nuke regex',
                                  'Find message by this key.',
                                  section=plugin_help.SECTION_ARGS)
@@ -108,9 +352,6 @@ class Plugin(main.Plugin):
         plugin_help.create_topic('nuke_url timeout',
                                  'Amount of time to timeout the users for.',
                                  section=plugin_help.SECTION_ARGS)
-        plugin_help.create_topic('nuke_url search',
-                                 'How much of the message history to search',
-                                 section=plugin_help.SECTION_ARGS)
         plugin_help.create_topic('nuke_url dry-run',
                                  'Don\'t perform any actions just return the results.',
                                  section=plugin_help.SECTION_ARGS)
@@ -118,6 +359,18 @@ class Plugin(main.Plugin):
                                  f'Ban or timeout more than {self.max_nuke} users.',
                                  section=plugin_help.SECTION_ARGS)
 
+        plugin_help.create_topic('unnuke',
+                                 'Revert a nuke, users are unbanned or their timeouts removed, in reverse order. '
+                                 'Usage: unnuke [job:ID] [+dry-run]',
+                                 section=plugin_help.SECTION_COMMANDS)
+        plugin_help.create_topic('unnuke job',
+                                 f'Number of the nuke to revert, defaults to the last one. Only the last '
+                                 f'{JOB_LOG_SIZE} nukes in a channel are kept, this includes nukes from before a restart.',
+                                 section=plugin_help.SECTION_ARGS)
+        plugin_help.create_topic('unnuke dry-run',
+                                 'Don\'t perform any actions just return the results.',
+                                 section=plugin_help.SECTION_ARGS)
+
     async def c_nuke(self, msg: twitchirc.ChannelMessage):
         try:
             args = arg_parser.parse_args(main.delete_spammer_chrs(msg.text),
@@ -127,10 +380,23 @@ class Plugin(main.Plugin):
                                              'timeout': datetime.timedelta,
                                              'search': datetime.timedelta,
                                              'dry-run': bool,
-                                             'force': bool
+                                             'force': bool,
+                                             'abort': bool,
+                                             'status': bool
                                          })
         except arg_parser.ParserError as e:
             return f'@{msg.user}, error: {e.message}'
+        if args['abort'] is True:
+            job = self.executor.abort(msg.channel)
+            if job is None:
+                return f'@{msg.user}, there is no nuke running in this channel.'
+            return  # the executor reports that the job was aborted
+        if args['status'] is True:
+            job = self.executor.running.get(msg.channel)
+            if job is None:
+                return f'@{msg.user}, there is no nuke running in this channel.'
+            return f'@{msg.user}, {job.describe()}'
+
         arg_parser.check_required_keys(args, ('regex', 'timeout', 'search', 'perma', 'dry-run', 'force'))
         if args['regex'] is ... or args['timeout'] is ... or args['search'] is ...:
             return f'@{msg.user}, regex, timeout and search are required parameters'
@@ -142,12 +408,15 @@ class Plugin(main.Plugin):
         except Exception as e:
             return f'@{msg.user}, error while compiling regex: {e}'
 
-        results = plugin_chat_cache.find_messages(msg.channel, expr=r,
-                                                  min_timestamp=time.time() - args['search'].total_seconds())
+        try:
+            results = plugin_chat_cache.find_messages(msg.channel, expr=r,
+                                                      min_timestamp=time.time() - args['search'].total_seconds())
+        except TimeoutError:
+            return f'@{msg.user}, your regex took too long to run, try a simpler one.'
         if not results:
             return f'@{msg.user}, found no messages matching the regex.'
         else:
-            return await self.nuke_from_messages(args, msg, results)
+            return await self.nuke_from_messages(args, msg, results, force_nuke=args['force'] is True)
 
     async def c_nuke_url(self, msg: twitchirc.ChannelMessage):
         try:
@@ -161,11 +430,10 @@ class Plugin(main.Plugin):
                                          })
         except arg_parser.ParserError as e:
             return f'@{msg.user}, error: {e.message}'
-        arg_parser.check_required_keys(args, ('url', 'timeout', 'search', 'perma', 'dry-run'))
-        if args['url'] is ... or (args['timeout'] is ... and not args['perma']) or args['search'] is ...:
-            return f'@{msg.user}, url, timeout and search are required parameters'
         if args['perma'] is ...:
             args['perma'] = False
+        if args['url'] is ... or (args['timeout'] is ... and not args['perma']):
+            return f'@{msg.user}, url and timeout are required parameters'
 
         url = args['url']
         if url.startswith(plugin_hastebin.hastebin_addr):
@@ -173,68 +441,79 @@ class Plugin(main.Plugin):
         async with aiohttp.request('get', url) as req:
             if req.status != 200:
                 return f'@{msg.user}, failed to download user list :('
-            if req.content_type == 'text/plain':
-                users = (await req.text('utf-8')).replace('\r\n', '\n').replace('$(newline)', '\n').split('\n')
-
-                while '' in users:
-                    users.remove('')
-
-                return await self.nuke(args, msg, users, force_nuke=args['force'])
+            if req.content_type != 'text/plain':
+                return f'@{msg.user}, user list must be plain text, got {req.content_type}'
+            if req.content_length is not None and req.content_length > MAX_USER_LIST_SIZE:
+                return f'@{msg.user}, user list is too large, the limit is {MAX_USER_LIST_SIZE} bytes'
+            try:
+                users, invalid = await read_user_list(req.content)
+            except ValueError as e:
+                return f'@{msg.user}, failed to read user list: {e}'
+        if invalid:
+            log('info', f'Skipped {invalid} invalid lines in user list from {url}')
+        if not users:
+            return f'@{msg.user}, user list contains no valid usernames.'
+        return await self.nuke(args, msg, users, force_nuke=args['force'] is True)
 
     async def nuke_from_messages(self, args, msg, search_results, force_nuke=False):
-        users = []
-        for i in search_results:
-            if i.user not in users:
-                users.append(i.user)
-        return await self.nuke(args, msg, users, force_nuke)
+        return await self.nuke(args, msg, [i.user for i in search_results], force_nuke)
 
     async def nuke(self, args, msg, users, force_nuke=False):
-        if msg.user in users:
-            users.remove(msg.user)  # make the executor not get hit by the fallout.
-        if main.bot.username.lower() in users:
-            users.remove(main.bot.username.lower())
+        # dict keeps the order, duplicates would be wasted actions.
+        users = list(dict.fromkeys(i.lower() for i in users))
+        for i in (msg.user, main.bot.username.lower()):  # make the executor not get hit by the fallout.
+            if i in users:
+                users.remove(i)
         url = plugin_hastebin.hastebin_addr + await plugin_hastebin.upload("\n".join(users))
+        if msg.channel in self.executor.running:
+            return self._busy_message(msg)
         if len(users) > self.max_nuke and not force_nuke:
-            return (f'@{msg.user}, {"(dry run)" if args["dry-run"] else ""}'
+            return (f'@{msg.user}, {"(dry run)" if args["dry-run"] is True else ""}'
                     f'refusing to nuke {len(users)} users. Add the +force flag or force nuke the list.'
                     f'Full list here: {url}')
         if args['dry-run'] is True:
             return (f'@{msg.user}, (dry run) {"timing out" if not args["perma"] else "banning (!!)"} {len(users)} '
                     f'users. Full list here: '
                     f'{url}')
-        timeouts = []
         if not args['perma']:
-            t_o_length = int(args['timeout'].total_seconds())
-            for u in users:
-                timeouts.append(msg.reply(f'/timeout {u} {t_o_length}s nuked by {msg.user}', force_slash=True))
+            job = self.executor.start(msg, 'timeout', users, timeout=int(args['timeout'].total_seconds()))
         else:
-            for u in users:
-                timeouts.append(msg.reply(f'/ban {u} nuked by {msg.user}', force_slash=True))
-        ret = [f'@{msg.user}, {"timing out" if not args["perma"] else "banning (!!)"} {len(users)} users. '
-               f'Full list here: {url}']
-        ret.extend(timeouts)
-        return ret
-
-    async def unnuke(self, args, msg, users):
-        users.remove(msg.user)
-        users.remove(main.bot.username)
+            job = self.executor.start(msg, 'ban', users)
+        if job is None:
+            return self._busy_message(msg)
+        return (f'@{msg.user}, {"timing out" if not args["perma"] else "banning (!!)"} {len(users)} users '
+                f'(job #{job.id}, ETA {job.eta}). Full list here: {url}')
+
+    def _busy_message(self, msg) -> str:
+        return (f'@{msg.user}, another nuke is running in this channel: '
+                f'{self.executor.running[msg.channel].describe()}')
+
+    async def c_unnuke(self, msg: twitchirc.ChannelMessage):
+        try:
+            args = arg_parser.parse_args(main.delete_spammer_chrs(msg.text),
+                                         {
+                                             'job': int,
+                                             'dry-run': bool
+                                         })
+        except arg_parser.ParserError as e:
+            return f'@{msg.user}, error: {e.message}'
+        job = self.executor.find(msg.channel, args['job'] if args['job'] is not ... else None)
+        if job is None:
+            return f'@{msg.user}, no nuke to revert found.'
+        return await self.unnuke(args, msg, job)
+
+    async def unnuke(self, args, msg, job: ModerationJob):
+        users = job.done[::-1]
+        action = REVERSE_ACTIONS[job.action]
         url = plugin_hastebin.hastebin_addr + await plugin_hastebin.upload("\n".join(users))
         if args['dry-run'] is True:
-            return (f'@{msg.user}, {"removing time out from" if not args["perma"] else "unbanning"} {len(users)} '
-                    f'users. Full list here: '
-                    f'{url}')
-
-        untimeouts = []
-        if not args['perma']:
-            for u in users:
-                untimeouts.append(msg.reply(f'/untimeout {u}', force_slash=True))
-        else:
-            for u in users:
-                untimeouts.append(msg.reply(f'/unban {u}', force_slash=True))
-        ret = [f'@{msg.user}, {"removing time out from" if not args["perma"] else "unbanning"} {len(users)} users. '
-               f'Full list here: {url}']
-        ret.extend(untimeouts)
-        return ret
+            return (f'@{msg.user}, (dry run) {"removing time out from" if action == "untimeout" else "unbanning"} '
+                    f'{len(users)} users. Full list here: {url}')
+        new_job = self.executor.start(msg, action, users, reverts=job)
+        if new_job is None:
+            return self._busy_message(msg)
+        return (f'@{msg.user}, {"removing time out from" if action == "untimeout" else "unbanning"} {len(users)} '
+                f'users (job #{new_job.id}, ETA {new_job.eta}). Full list here: {url}')
 
     @property
     def no_reload(self):
@@ -246,7 +525,7 @@ class Plugin(main.Plugin):
 
     @property
     def commands(self) -> typing.List[str]:
-        return ['nuke']
+        return ['nuke', 'nuke_url', 'unnuke']
 
     def on_reload(self):
         pass
@@ -55,10 +55,9 @@ async def new_handler(message: twitchirc.ChannelMessage):
             was_handled = False
             if ' ' not in message.text:
                 message.text += ' '
-            for handler in main.bot.commands:
-                if message.text.startswith(chan_prefix + handler.ef_command):
-                    await plugin_manager._acall_handler(handler, message)
-                    was_handled = True
+            for handler in main.bot.commands.lookup(message.text, chan_prefix):
+                await plugin_manager._acall_handler(handler, message)
+                was_handled = True
 
             if not was_handled:
                 main.bot._do_unknown_command(message)
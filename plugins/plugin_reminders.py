@@ -14,7 +14,6 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import datetime
-import re
 import time
 import typing
 
@@ -28,36 +27,31 @@ except ImportError:
     exit()
 # noinspection PyUnresolvedReferences
 import twitchirc
+import plugins.models.reminder as reminder_model
+
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers.reminder_scheduler import ReminderScheduler, process_time
+except ImportError:
+    from plugins.helpers.reminder_scheduler import ReminderScheduler, process_time
 
 __meta_data__ = {
     'name': 'plugin_reminders',
     'commands': []
 }
 log = main.make_log_function('reminders')
-reminders: typing.Dict[str, typing.List[typing.Dict[str, typing.Union[str, int]]]] = {
-    # 'channel': [
-    #     {
-    #         'text': 'some_text',
-    #         'seconds': 0,
-    #         'timestamp': 0,
-    #         'user': 'user'
-    #     }
-    # ]
-}
-TIME_STR_PATTERN = r'(?:([0-9]+)h)?([0-9]+)m(?:([0-9]+)s)?'
+Reminder = reminder_model.get(main.Base, main.session_scope)
 
 
-def process_time(time_string: str) -> int:
-    m = re.match(TIME_STR_PATTERN, time_string)
-    if m:
-        print(m, m[1], m[2], m[3], m[0])
-        seconds = (
-                ((int(m[1]) * 3600) if m[1] is not None else 0)
-                + (int(m[2]) * 60)
-                + ((int(m[3])) if m[3] is not None else 0)
-        )
-        return seconds
-    return -1
+def _save_sent(finished: typing.List[int], rearmed: typing.List[Reminder]):
+    try:
+        with main.session_scope() as session:
+            if finished:
+                Reminder.delete_by_ids(finished, session)
+            if rearmed:
+                session.bulk_update_mappings(Reminder, [{'id': i.id, 'due': i.due} for i in rearmed])
+    except Exception as e:
+        log('err', f'Failed to save sent reminders: {e!r}')
 
 
 c_rem_parser = twitchirc.ArgumentParser(prog='!reminder', add_help=False)
@@ -90,24 +84,24 @@ def command_reminder(msg: twitchirc.ChannelMessage):
             return (f'@{msg.user} Cannot add reminder for other user, you don\'t have the permissions '
                     f'needed')
     if aargs.remove:
-        if msg.channel not in reminders:
+        if msg.channel not in scheduler.by_channel:
             return (f'@{msg.user} Cannot remove reminders: channel is not registered. '
                     f'No reminders here.')
-        count = 0
-        for r in reminders[msg.channel].copy():
-            if r['user'] == aargs.remove.lower():
-                count += 1
-                reminders[msg.channel].remove(r)
-        return f'@{msg.user} removed {count} reminder(s).'
+        to_remove = [r for r in scheduler.by_channel[msg.channel] if r.user == aargs.remove.lower()]
+        if to_remove:
+            Reminder.delete_by_ids([r.id for r in to_remove])
+        for r in to_remove:
+            scheduler.remove(r)
+        return f'@{msg.user} removed {len(to_remove)} reminder(s).'
     if aargs.list:
         output = ''
-        if msg.channel not in reminders:
+        if msg.channel not in scheduler.by_channel:
             main.bot.send(msg.reply(f'@{msg.user} Cannot list reminders: channel is not registered. '
                                     f'No reminders here.'))
             return
-        for r in reminders[msg.channel]:
-            output += f'<{r["text"]!r} on ' \
-                      f'{datetime.datetime.fromtimestamp(r["timestamp"]).strftime("%Y-%M-%d %H:%m:%S")}>, '
+        for r in scheduler.by_channel[msg.channel]:
+            output += f'<{r.text!r} on ' \
+                      f'{datetime.datetime.fromtimestamp(r.due).strftime("%Y-%m-%d %H:%M:%S")}>, '
         output = output[:-2]
         return f'@{msg.user} List: {output}'
     if aargs.add:
@@ -116,17 +110,13 @@ def command_reminder(msg: twitchirc.ChannelMessage):
         #     return
         text = ' '.join(aargs.add)
         seconds = process_time(aargs.time)
-        print(text, seconds)
-        new_timestamp = time.time() + seconds
-        if msg.channel not in reminders:
-            reminders[msg.channel] = []
-        reminders[msg.channel].append({
-            'text': text,
-            'seconds': seconds,
-            'timestamp': new_timestamp,
-            'user': msg.user,
-            'nr': aargs.nr
-        })
+        if seconds <= 0:
+            return f'@{msg.user} Invalid time: {aargs.time!r}. {c_rem_parser.format_usage()}'
+        with main.session_scope() as session:
+            reminder = Reminder(channel=msg.channel, user=msg.user, text=text, seconds=seconds,
+                                due=time.time() + seconds, recurring=aargs.nr)
+            session.add(reminder)
+        scheduler.add(reminder)
         if not aargs.nr:
             return (f'@{msg.user} , I will be messaging you in {seconds} seconds '
                     f'or ({seconds // 3600:.0f} hours, '
@@ -184,24 +174,20 @@ def make_successful_set_reminder_message(msg, all_seconds, text, reoccurring):
             f'{all_seconds} seconds or ({time_text}) with the message {text!r}')
 
 
-def remind(reminder, channel):
-    msg = twitchirc.ChannelMessage(user='OUTGOING', channel=channel,
-                                   text=f'@{reminder["user"]} As promised I\'m reminding you: {reminder["text"]}')
+def remind(reminder: Reminder):
+    msg = twitchirc.ChannelMessage(user='OUTGOING', channel=reminder.channel,
+                                   text=f'@{reminder.user} As promised I\'m reminding you: {reminder.text}')
     msg.outgoing = True
     main.bot.send(msg)
-    if reminder['nr']:
-        reminder['timestamp'] = time.time() + reminder['seconds']
 
 
-def reminder_handler():
-    current_time = time.time()
-    for channel in reminders:
-        for r in reminders[channel].copy():
-            if r['timestamp'] <= current_time:
-                remind(r, channel)
-                if not r['nr']:
-                    reminders[channel].remove(r)
+scheduler = ReminderScheduler(main.deadlines, remind, _save_sent)
+
+
+def _load_reminders():
+    reminders = Reminder.load_pending()
+    scheduler.extend(reminders)
+    log('info', f'Loaded {len(reminders)} pending reminders.')
 
 
-# main.bot.handlers['any_msg'].append(reminder_handler)
-main.bot.schedule_repeated_event(0.11, 5, reminder_handler, (), {})
+main.bot.schedule_event(0.1, 5, _load_reminders, (), {})
@@ -13,10 +13,9 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import socket
-import threading
 
 import twitchirc
+from sqlalchemy.orm import joinedload
 
 try:
     # noinspection PyUnresolvedReferences
@@ -161,7 +160,7 @@ PAGE_SIZE = 50
 
 
 @plugin_ipc.add_command('get_user_suggestions')
-def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
+def _ipc_command_list_suggestions(conn: plugin_ipc.Connection, msg: str, socket_id):
     arg: str
     _, arg = msg.replace('\n', '').replace('\r\n', '').split(' ', 1)
     args = arg.split(' ', 1)
@@ -173,8 +172,7 @@ def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
         if args[1].isnumeric():
             page_num = int(args[1])
     if user_id is None or page_num is None:
-        return (b'!1\r\n'
-                b'~Invalid usage.\r\n'
+        return (plugin_ipc.error(1, 'Invalid usage.')
                 +
                 plugin_ipc.format_json(
                     {
@@ -184,15 +182,15 @@ def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
                     })
                 )
     else:
-        def _fetch_suggestions(rwq):
-            print(f'fetch {user_id} p {page_num}')
+        def _fetch_suggestions(conn):
+            log('debug', f'fetch {user_id} p {page_num}')
             with main.session_scope() as session:
                 suggestions = (session.query(Suggestion)
                                .filter(Suggestion.author_alias == user_id)
                                .offset(page_num * PAGE_SIZE)
                                .limit(PAGE_SIZE)
                                .all())
-                rwq.put(
+                conn.send(
                     plugin_ipc.format_json(
                         {
                             'type': 'suggestion_list',
@@ -211,12 +209,11 @@ def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
                     )
                 )
 
-        t = threading.Thread(target=_fetch_suggestions, args=(plugin_ipc.response_write_queues[socket_id],))
-        t.start()
+        return plugin_ipc.submit_query('get_user_suggestions', conn, _fetch_suggestions)
 
 
 @plugin_ipc.add_command('get_suggestion')
-def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
+def _ipc_command_list_suggestions(conn: plugin_ipc.Connection, msg: str, socket_id):
     arg: str
     _, arg = msg.replace('\n', '').replace('\r\n', '').split(' ', 1)
     args = arg.split(' ', 1)
@@ -225,8 +222,7 @@ def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
         if args[0].isnumeric():
             suggestion_id = int(args[0])
     if suggestion_id is None:
-        return (b'!1\r\n'
-                b'~Invalid usage.\r\n'
+        return (plugin_ipc.error(1, 'Invalid usage.')
                 +
                 plugin_ipc.format_json(
                     {
@@ -236,13 +232,14 @@ def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
                     })
                 )
     else:
-        def _fetch_suggestions(rwq):
-            print(f'fetch suggestion {suggestion_id}')
+        def _fetch_suggestions(conn):
+            log('debug', f'fetch suggestion {suggestion_id}')
             with main.session_scope() as session:
                 suggestion = (session.query(Suggestion)
+                              .options(joinedload(Suggestion.author))
                               .filter(Suggestion.id == suggestion_id)
                               .first())
-                rwq.put(
+                conn.send(
                     plugin_ipc.format_json(
                         {
                             'type': 'suggestion_list',
@@ -265,12 +262,11 @@ def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
                     )
                 )
 
-        t = threading.Thread(target=_fetch_suggestions, args=(plugin_ipc.response_write_queues[socket_id],))
-        t.start()
+        return plugin_ipc.submit_query('get_suggestion', conn, _fetch_suggestions)
 
 
 @plugin_ipc.add_command('get_suggestions')
-def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
+def _ipc_command_list_suggestions(conn: plugin_ipc.Connection, msg: str, socket_id):
     arg: str
     _, arg = msg.replace('\n', '').replace('\r\n', '').split(' ', 1)
     args = arg.split(' ', 1)
@@ -279,8 +275,7 @@ def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
         if args[0].isnumeric():
             page_num = int(args[0])
     if page_num is None:
-        return (b'!1\r\n'
-                b'~Invalid usage.\r\n'
+        return (plugin_ipc.error(1, 'Invalid usage.')
                 +
                 plugin_ipc.format_json(
                     {
@@ -290,14 +285,15 @@ def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
                     })
                 )
     else:
-        def _fetch_suggestions(rwq):
-            print(f'fetch suggestions, p {page_num}')
+        def _fetch_suggestions(conn):
+            log('debug', f'fetch suggestions, p {page_num}')
             with main.session_scope() as session:
                 suggestions = (session.query(Suggestion)
+                               .options(joinedload(Suggestion.author))
                                .offset(page_num * PAGE_SIZE)
                                .limit(PAGE_SIZE)
                                .all())
-                rwq.put(
+                conn.send(
                     plugin_ipc.format_json(
                         {
                             'type': 'suggestion_list',
@@ -320,5 +316,4 @@ def _ipc_command_list_suggestions(sock: socket.socket, msg: str, socket_id):
                     )
                 )
 
-        t = threading.Thread(target=_fetch_suggestions, args=(plugin_ipc.response_write_queues[socket_id],))
-        t.start()
+        return plugin_ipc.submit_query('get_suggestions', conn, _fetch_suggestions)
@@ -15,8 +15,6 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import json
 import threading
-import time
-import atexit
 
 import requests
 
@@ -37,46 +35,31 @@ log = main.make_log_function('supibot_is_alive')
 with open('supibot_auth.json', 'r') as f:
     supibot_auth = json.load(f)
 
-killer_lock = threading.Lock()
+HEARTBEAT_INTERVAL = 30 * 60
 
 
-def job_active(job_kill_lock: threading.Lock):
-    while 1:
-        if job_kill_lock.locked():
-            break
-        r = requests.put('https://supinic.com/api/bot/active',
-                         headers={
-                             'Authorization': f'Basic {supibot_auth["id"]}:{supibot_auth["key"]}',
-                             'User-Agent': 'Mm\'sUtilityBot/v1.0 (by Mm2PL), Twitch chat bot'
-                         })
-        if r.status_code == 400:
-            log('err', 'Sent Supibot active call, not a bot :(, won\'t attempt again.')
-            break
+def job_active():
+    r = requests.put('https://supinic.com/api/bot/active',
+                     headers={
+                         'Authorization': f'Basic {supibot_auth["id"]}:{supibot_auth["key"]}',
+                         'User-Agent': 'Mm\'sUtilityBot/v1.0 (by Mm2PL), Twitch chat bot'
+                     })
+    if r.status_code == 400:
+        log('err', 'Sent Supibot active call, not a bot :(, won\'t attempt again.')
+        main.deadlines.cancel(heartbeat_task)
 
-        elif r.status_code == 200:
-            log('info', 'Sent Supibot active call. OK')
+    elif r.status_code == 200:
+        log('info', 'Sent Supibot active call. OK')
 
-        elif r.status_code in [401, 403]:
-            log('warn', 'Sent Supibot active call. Bad authorization.')
-        else:
-            log('err', f'Sent Supibot active call. Invalid status code: {r.status_code}, {r.content.decode("utf-8")}')
-        current_sleep_time = 0
-        while 1:
-            current_sleep_time += 1
-            time.sleep(1)
-            if current_sleep_time >= 60 * 60 * 0.5:
-                break
-            if job_kill_lock.locked():
-                return
+    elif r.status_code in [401, 403]:
+        log('warn', 'Sent Supibot active call. Bad authorization.')
+    else:
+        log('err', f'Sent Supibot active call. Invalid status code: {r.status_code}, {r.content.decode("utf-8")}')
 
 
-thread = threading.Thread(target=job_active, args=(killer_lock,))
-thread.start()
+def _start_job_active():
+    # don't block the bot while waiting for the request
+    threading.Thread(target=job_active, args=(), daemon=True, name='supibot_heartbeat').start()
 
 
-@atexit.register
-def auto_kill_job(*args):
-    print('Stopping Supibot heartbeat thread.')
-    killer_lock.acquire()
-    thread.join()
-    print('Done.')
+heartbeat_task = main.deadlines.call_every(HEARTBEAT_INTERVAL, _start_job_active, delay=0, name='supibot_heartbeat')
@@ -0,0 +1,57 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import unittest
+
+import twitchirc
+
+from plugins.helpers.compact_message import CompactMessage
+
+RAW = ('@badge-info=subscriber/14;badges=subscriber/12,premium/1;color=#FF0000;display-name=Someone;emotes=;'
+       'flags=;id=3a51b0f4-7a3d-4c84-a1c2-000000000001;mod=0;room-id=117691339;subscriber=1;'
+       'tmi-sent-ts=1600000000123;turbo=0;user-id=1234;user-type= '
+       ':someone!someone@someone.tmi.twitch.tv PRIVMSG #channel :hello there Kappa')
+
+
+def _compact(raw=RAW):
+    msg = twitchirc.auto_message(raw)
+    return msg, CompactMessage.from_message(msg, int(msg.flags['tmi-sent-ts']) / 1000)
+
+
+class CompactMessageTest(unittest.TestCase):
+    def test_round_trip(self):
+        original, compact = _compact()
+        rebuilt = compact.message
+        self.assertEqual(rebuilt.text, original.text)
+        self.assertEqual(rebuilt.user, original.user)
+        self.assertEqual(rebuilt.channel, original.channel)
+        for flag in ('badges', 'badge-info', 'user-id', 'tmi-sent-ts', 'display-name', 'id', 'color', 'room-id'):
+            self.assertEqual(rebuilt.flags[flag], original.flags[flag], flag)
+
+    def test_single_badge_stays_a_string(self):
+        original, compact = _compact(RAW.replace('subscriber/12,premium/1', 'moderator/1'))
+        self.assertEqual(compact.message.flags['badges'], 'moderator/1')
+        self.assertTrue(compact.has_badge('moderator'))
+        self.assertFalse(compact.has_badge('subscriber'))
+
+    def test_missing_flags(self):
+        msg = twitchirc.ChannelMessage(text='hi', user='someone', channel='channel')
+        msg.flags = {}
+        rebuilt = CompactMessage.from_message(msg, 1600000000.5).message
+        self.assertEqual(rebuilt.flags, {'user-id': '', 'tmi-sent-ts': '1600000000500'})
+
+
+if __name__ == '__main__':
+    unittest.main()
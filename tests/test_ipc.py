@@ -0,0 +1,193 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import os
+import select
+import sys
+import tempfile
+import threading
+import types
+import unittest
+
+# plugins import the running bot as `main`, only the parts used while loading plugin_ipc are provided here.
+if 'main' not in sys.modules:
+    _main = types.ModuleType('main')
+    _main.bot = types.SimpleNamespace(middleware=[])
+    _main.make_log_function = lambda name: (lambda level, *data, **kwargs: None)
+    sys.modules['main'] = _main
+
+_loop = asyncio.new_event_loop()
+asyncio.set_event_loop(_loop)
+import plugins.plugin_ipc as ipc  # noqa: E402
+from web import ipc as web_ipc  # noqa: E402
+
+ipc.server_task.cancel()  # the tests start their own server, not one on SOCKET_PATH
+asyncio.set_event_loop(None)
+
+
+@ipc.add_command('echo')
+def _command_echo(conn, msg: str, socket_id):
+    return ipc.output(msg.split(' ', 1)[1])
+
+
+def _decoder(binary: bool) -> web_ipc.Connection:
+    """A web client that isn't connected, only to use its `decode`."""
+    decoder = web_ipc.Connection.__new__(web_ipc.Connection)
+    decoder.buf = b''
+    decoder.use_binary = binary
+    decoder.binary = binary
+    return decoder
+
+
+def _frame(payload: bytes, kind=ipc.KIND_COMMAND) -> bytes:
+    return ipc.FRAME_HEADER.pack(len(payload), kind) + payload
+
+
+class IPCServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmp.name, 'ipc_server')
+        cls.thread = threading.Thread(target=_loop.run_forever, daemon=True)
+        cls.thread.start()
+        cls.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_unix_server(ipc._handle_connection, path=cls.path, limit=ipc.MAX_MESSAGE_SIZE),
+            _loop
+        ).result(5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        _loop.call_soon_threadsafe(_loop.stop)
+        cls.thread.join(5)
+        cls.tmp.cleanup()
+
+    def connect(self, binary=False) -> web_ipc.Connection:
+        client = web_ipc.Connection(self.path, binary=binary)
+        self.addCleanup(client.sock.close)
+        welcome = self.read(client, 3)
+        self.assertEqual(welcome[0], ('output', 'Welcome to the Mm\'s Utility bot IPC interface.'))
+        self.assertEqual(welcome[2][0], 'json')
+        self.assertEqual(welcome[2][1]['type'], 'login/your_id')
+        return client
+
+    def read(self, client: web_ipc.Connection, count: int, timeout=5.0):
+        messages = []
+        while len(messages) < count:
+            self.assertTrue(select.select([client.sock], [], [], timeout)[0], f'only got {messages!r}')
+            data = client.sock.recv(65536)
+            self.assertNotEqual(data, b'', f'connection closed, got {messages!r}')
+            messages += client.decode(data)
+        return messages
+
+    def assertClosed(self, client: web_ipc.Connection, timeout=5.0):
+        while select.select([client.sock], [], [], timeout)[0]:
+            if client.sock.recv(65536) == b'':
+                return
+        self.fail('connection is still open')
+
+    def test_text_mode(self):
+        client = self.connect()
+        client.command(b'echo hello there')
+        self.assertEqual(self.read(client, 1), [('output', 'hello there')])
+        client.command(b'no_such_command')
+        messages = self.read(client, 3)
+        self.assertEqual(messages[:2], [('error', '1'), ('output', 'No command')])
+        self.assertEqual(messages[2][1]['source'], 'command_handler')
+
+    def test_text_mode_many_lines_at_once(self):
+        client = self.connect()
+        client.sock.sendall(b''.join(b'echo %d\r\n' % i for i in range(20)))
+        self.assertEqual(self.read(client, 20), [('output', str(i)) for i in range(20)])
+
+    def test_binary_mode(self):
+        client = self.connect(binary=True)
+        # sent right after the switch, before the confirmation arrived
+        client.command('echo zażółć\r\ngęślą jaźń'.encode('utf-8'))
+        self.assertEqual(self.read(client, 1), [('output', 'zażółć\r\ngęślą jaźń')])
+        self.assertTrue(client.binary)
+
+        client.sock.sendall(_frame(b'echo x', ipc.KIND_JSON))
+        messages = self.read(client, 3)
+        self.assertEqual(messages[:2], [('error', '1'), ('output', 'Unknown frame kind')])
+        client.command(b'echo still open')
+        self.assertEqual(self.read(client, 1), [('output', 'still open')])
+
+    def test_switch_to_binary_mid_stream(self):
+        client = self.connect()
+        client.use_binary = True
+        client.sock.sendall(b'echo text\r\nbinary\r\n' + _frame(b'echo one') + _frame(b'echo two'))
+        self.assertEqual(self.read(client, 3), [('output', 'text'), ('output', 'one'), ('output', 'two')])
+        self.assertTrue(client.binary)
+
+    def test_text_message_too_long(self):
+        client = self.connect()
+        client.sock.sendall(b'echo ' + b'a' * ipc.MAX_MESSAGE_SIZE + b'\r\n')
+        messages = self.read(client, 3)
+        self.assertEqual(messages[:2], [('error', '1'), ('output', 'Message too long')])
+        self.assertClosed(client)
+
+    def test_binary_message_too_long(self):
+        client = self.connect(binary=True)
+        client.sock.sendall(ipc.FRAME_HEADER.pack(ipc.MAX_MESSAGE_SIZE + 1, ipc.KIND_COMMAND))
+        messages = self.read(client, 3)
+        self.assertEqual(messages[:2], [('error', '1'), ('output', 'Message too long')])
+        self.assertClosed(client)
+
+    def test_subscriber_overflow(self):
+        client = self.connect()
+        client.command(b'subscribe logs')
+        self.assertEqual(self.read(client, 2)[1][1]['topics'], ['logs'])
+        total = ipc.SUBSCRIBER_QUEUE_SIZE + 100
+
+        def _publish():
+            # all at once on the event loop, nothing is written in between
+            for i in range(total):
+                ipc.publish('logs', {'num': i})
+
+        _loop.call_soon_threadsafe(_publish)
+        messages = self.read(client, ipc.SUBSCRIBER_QUEUE_SIZE + 1)
+        self.assertEqual(messages[0][1], {'type': 'subscription/dropped', 'source': 'subscribe', 'count': 100})
+        self.assertEqual([i[1]['data']['num'] for i in messages[1:]], list(range(100, total)))
+
+        client.command(b'unsubscribe')
+        self.assertEqual(self.read(client, 2)[1][1]['topics'], [])
+        self.assertFalse(ipc.has_subscribers('logs'))
+
+
+class FramingTest(unittest.TestCase):
+    MESSAGES = ipc.output('hello') + [(ipc.KIND_CHAT, 'zażółć'.encode('utf-8'))] + ipc.error(2, 'oops') \
+        + ipc.format_json({'type': 'test', 'list': [1, 2]})
+    DECODED = [('output', 'hello'), ('command_output', 'zażółć'), ('error', '2'), ('output', 'oops'),
+               ('json', {'type': 'test', 'list': [1, 2]})]
+
+    def test_text(self):
+        self.assertEqual(_decoder(False).decode(ipc.encode_messages(self.MESSAGES, False)), self.DECODED)
+
+    def test_binary(self):
+        self.assertEqual(_decoder(True).decode(ipc.encode_messages(self.MESSAGES, True)), self.DECODED)
+
+    def test_binary_split_frames(self):
+        decoder = _decoder(True)
+        messages = []
+        for i in ipc.encode_messages(self.MESSAGES, True):
+            messages += decoder.decode(bytes([i]))
+        self.assertEqual(messages, self.DECODED)
+        self.assertEqual(decoder.buf, b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
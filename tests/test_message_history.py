@@ -0,0 +1,76 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import random
+import types
+import unittest
+
+from plugins.helpers.message_history import MessageHistory
+
+
+def _message(user, text=''):
+    return types.SimpleNamespace(user=user, text=text)
+
+
+class MessageHistoryTest(unittest.TestCase):
+    def assertUsersInSync(self, history: MessageHistory):
+        by_user = {}
+        for message, timestamp in history:
+            by_user.setdefault(message.user, []).append((id(message), timestamp))
+        self.assertEqual(set(history.users.keys()), set(by_user.keys()))
+        for user, entries in by_user.items():
+            user_entries = [(id(message), timestamp) for message, timestamp in history.users[user]]
+            self.assertEqual(sorted(user_entries, key=lambda e: e[1]), user_entries)
+            self.assertEqual(sorted(user_entries), sorted(entries))
+
+    def test_in_order(self):
+        history = MessageHistory(max_length=3)
+        for i in range(5):
+            history.add(_message('a', str(i)), i)
+        self.assertEqual([m.text for m in history.between()], ['2', '3', '4'])
+        self.assertEqual([m.text for m in history.between(2, 4)], ['3'])
+        self.assertEqual(len(history.users['a']), 3)
+
+    def test_late_messages_are_sorted(self):
+        history = MessageHistory()
+        for timestamp in (10, 11, 3, 12, 1, 2):
+            history.add(_message('a', str(timestamp)), timestamp)
+        self.assertEqual([m.text for m in history.between()], ['1', '2', '3', '10', '11', '12'])
+        self.assertEqual([m.text for m in history.between(1, 11)], ['2', '3', '10'])
+
+    def test_eviction_keeps_user_index_in_sync(self):
+        rng = random.Random(1234)
+        history = MessageHistory(max_length=50)
+        for i in range(2000):
+            # few distinct timestamps and users, most messages arrive late
+            timestamp = i // 10 - rng.randint(0, 30)
+            history.add(_message(rng.choice('abcd'), str(i)), timestamp)
+            self.assertEqual(len(history), min(i + 1, 50))
+            if i % 97 == 0:
+                self.assertUsersInSync(history)
+        self.assertUsersInSync(history)
+        self.assertEqual(sum(len(i) for i in history.users.values()), len(history))
+
+    def test_evicts_oldest_not_first_added(self):
+        history = MessageHistory(max_length=2)
+        history.add(_message('a', 'new'), 10)
+        history.add(_message('b', 'newer'), 11)
+        history.add(_message('c', 'old'), 5)
+        self.assertEqual([m.text for m in history.between()], ['new', 'newer'])
+        self.assertNotIn('c', history.users)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import unittest
+
+from plugins.helpers.outbound import OutboundScheduler, PRIORITY_MODERATION, PRIORITY_REPLY
+
+
+class OutboundSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.outbound = OutboundScheduler(self.sent.append, 0)
+        self.outbound.set_elevated('channel', True)
+
+    def test_on_sent_runs_after_send(self):
+        done = []
+        self.outbound.enqueue('channel', b'PRIVMSG #channel :/ban a', PRIORITY_MODERATION,
+                              on_sent=lambda: done.append(list(self.sent)))
+        self.assertEqual(done, [])
+        self.outbound.flush()
+        self.assertEqual(done, [[b'PRIVMSG #channel :/ban a']])
+
+    def test_pending_and_cancel_by_tag(self):
+        job = object()
+        for i in range(3):
+            self.outbound.enqueue('channel', b'PRIVMSG #channel :/ban %d' % i, PRIORITY_MODERATION, tag=job)
+        self.outbound.enqueue('channel', b'PRIVMSG #channel :hi', PRIORITY_REPLY)
+        self.assertEqual(self.outbound.pending(tag=job), 3)
+        self.assertEqual(self.outbound.pending('channel'), 4)
+
+        self.assertEqual(self.outbound.cancel(job), 3)
+        self.assertEqual(self.outbound.pending(tag=job), 0)
+        self.outbound.flush()
+        self.assertEqual(self.sent, [b'PRIVMSG #channel :hi'])
+        self.assertEqual(self.outbound.pending(), 0)
+
+    def test_failed_send_is_kept(self):
+        def send(data):
+            if data == b'PRIVMSG #channel :b':
+                raise ConnectionError('gone')
+            self.sent.append(data)
+
+        self.outbound._send = send
+        for text in (b'a', b'b', b'c'):
+            self.outbound.enqueue('channel', b'PRIVMSG #channel :' + text, PRIORITY_REPLY)
+        with self.assertRaises(ConnectionError):
+            self.outbound.flush()
+        self.assertEqual(self.sent, [b'PRIVMSG #channel :a'])
+        self.assertEqual(self.outbound.pending(), 2)
+
+        self.outbound._send = self.sent.append
+        self.outbound.flush()
+        self.assertEqual(self.sent, [b'PRIVMSG #channel :a', b'PRIVMSG #channel :b', b'PRIVMSG #channel :c'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import unittest
+from unittest import mock
+
+import regex
+
+from plugins.helpers import regex_budget
+from plugins.helpers.regex_budget import RegexBudget
+
+
+class SlowPattern:
+    """Stands in for a pattern that always hits the time limit."""
+    pattern = 'slow'
+
+    def search(self, text):
+        raise TimeoutError('regex timed out')
+
+
+class RegexBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.budget = RegexBudget(bad_after=3, bad_expire_time=60)
+        self.marked = []
+        self.budget.on_bad.append(self.marked.append)
+
+    def _time_out(self, pattern, times):
+        for _ in range(times):
+            with self.assertRaises(TimeoutError):
+                self.budget.run('test', pattern, 'search', 'text')
+
+    def test_marked_bad_after_threshold(self):
+        pattern = SlowPattern()
+        self._time_out(pattern, 2)
+        self.assertFalse(self.budget.is_bad('test', pattern))
+        self.assertEqual(self.marked, [])
+
+        self._time_out(pattern, 1)
+        self.assertTrue(self.budget.is_bad('test', pattern))
+        self.assertFalse(self.budget.is_bad('other source', pattern))
+        self.assertEqual([(i.source, i.pattern, i.timeouts) for i in self.marked], [('test', 'slow', 3)])
+
+        self._time_out(pattern, 2)
+        self.assertEqual(len(self.marked), 1)  # only called when the pattern gets marked
+        stats = self.budget.most_expensive(1)[0]
+        self.assertEqual((stats.calls, stats.timeouts, stats.bad), (5, 5, True))
+
+    def test_mark_expires(self):
+        pattern = SlowPattern()
+        with mock.patch.object(regex_budget.time, 'monotonic', return_value=1000):
+            self._time_out(pattern, 3)
+        with mock.patch.object(regex_budget.time, 'monotonic', return_value=1059):
+            self.assertTrue(self.budget.is_bad('test', pattern))
+        with mock.patch.object(regex_budget.time, 'monotonic', return_value=1060):
+            self.assertFalse(self.budget.is_bad('test', pattern))
+            # it needs to time out `bad_after` times again
+            self._time_out(pattern, 2)
+            self.assertFalse(self.budget.is_bad('test', pattern))
+            self._time_out(pattern, 1)
+            self.assertTrue(self.budget.is_bad('test', pattern))
+        self.assertEqual(len(self.marked), 2)
+
+    def test_clear(self):
+        pattern = SlowPattern()
+        self._time_out(pattern, 3)
+        self.assertEqual(self.budget.clear('other source'), 0)
+        self.assertTrue(self.budget.is_bad('test', pattern))
+        self.assertEqual(self.budget.clear(), 1)
+        self.assertFalse(self.budget.is_bad('test', pattern))
+
+    def test_regex_patterns_get_a_timeout(self):
+        pattern = regex.compile('a+b')
+        self.assertIsNotNone(self.budget.run('test', pattern, 'search', 'aaab'))
+        self.budget.timeout = 0.0001
+        with self.assertRaises(TimeoutError):
+            self.budget.run('test', regex.compile(r'(a|aa)+$'), 'search', 'a' * 40 + 'b')
+
+
+if __name__ == '__main__':
+    unittest.main()
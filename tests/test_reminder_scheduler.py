@@ -0,0 +1,101 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import time
+import types
+import unittest
+from unittest import mock
+
+from plugins.helpers.deadline_scheduler import DeadlineScheduler
+from plugins.helpers.reminder_scheduler import ReminderScheduler, process_time
+
+
+def _reminder(id_, due, seconds=60, recurring=False, channel='channel'):
+    return types.SimpleNamespace(id=id_, channel=channel, due=due, seconds=seconds, recurring=recurring)
+
+
+class ProcessTimeTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(process_time('10m'), 600)
+        self.assertEqual(process_time('0h10m0s'), 600)
+        self.assertEqual(process_time('1h0m'), 3600)
+        self.assertEqual(process_time('2h30m15s'), 2 * 3600 + 30 * 60 + 15)
+        self.assertEqual(process_time('0m30s'), 30)
+
+    def test_invalid(self):
+        self.assertEqual(process_time(''), -1)
+        self.assertEqual(process_time('30s'), -1)  # minutes are required
+        self.assertEqual(process_time('1h'), -1)
+        self.assertEqual(process_time('soon'), -1)
+
+
+class ReminderSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.deadlines = DeadlineScheduler(log=lambda *args: None)
+        self.sent = []
+        self.saved = []
+        self.scheduler = ReminderScheduler(self.deadlines, self.sent.append,
+                                           lambda finished, rearmed: self.saved.append((finished, list(rearmed))))
+
+    def test_one_shot_reminder_is_removed(self):
+        reminder = _reminder(1, time.time() - 1)
+        self.scheduler.add(reminder)
+        self.deadlines.run_due()
+        self.assertEqual(self.sent, [reminder])
+        self.assertEqual(self.saved, [([1], [])])
+        self.assertEqual(self.scheduler.reminders, {})
+        self.assertEqual(self.scheduler.by_channel, {})
+
+    def test_recurring_reminder_is_rearmed(self):
+        reminder = _reminder(1, time.time() - 1, seconds=60, recurring=True)
+        self.scheduler.add(reminder)
+        before = time.time()
+        self.deadlines.run_due()
+        self.assertEqual(self.sent, [reminder])
+        self.assertEqual(self.saved, [([], [reminder])])
+        self.assertGreaterEqual(reminder.due, before + 60)
+        self.assertLessEqual(reminder.due, time.time() + 60)
+        # the timer now waits for the next run
+        self.assertAlmostEqual(self.deadlines.timeout(max_timeout=3600), 60, delta=1)
+
+        self.deadlines.run_due()
+        self.assertEqual(len(self.sent), 1)
+
+        # a minute later it's sent again
+        due = reminder.due
+        with mock.patch('time.time', return_value=due + 1), \
+                mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            self.deadlines.run_due()
+        self.assertEqual(self.sent, [reminder, reminder])
+        self.assertEqual(reminder.due, due + 1 + 60)
+        self.assertIn(1, self.scheduler.reminders)
+
+    def test_earlier_reminder_moves_the_timer(self):
+        self.scheduler.add(_reminder(1, time.time() + 600))
+        self.assertAlmostEqual(self.deadlines.timeout(max_timeout=3600), 600, delta=1)
+        self.scheduler.add(_reminder(2, time.time() + 60))
+        self.assertAlmostEqual(self.deadlines.timeout(max_timeout=3600), 60, delta=1)
+
+    def test_removed_reminder_is_skipped(self):
+        reminder = _reminder(1, time.time() - 1)
+        self.scheduler.add(reminder)
+        self.scheduler.remove(reminder)
+        self.deadlines.run_due()
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.saved, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import unittest
+from unittest import mock
+
+from plugins.models import user as user_model
+from plugins.models.user import UserIdentity, UserIdentityCache
+
+
+class UserIdentityCacheTest(unittest.TestCase):
+    def test_hit_and_miss_counters(self):
+        cache = UserIdentityCache(max_size=10, ttl=60)
+        self.assertIsNone(cache.get(1))
+        cache.put(1, UserIdentity(100, 1))
+        self.assertEqual(cache.get(1), UserIdentity(100, 1))
+        self.assertEqual(cache.get(1).id, 100)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 2 / 3)
+
+    def test_evicts_least_recently_used(self):
+        cache = UserIdentityCache(max_size=2, ttl=60)
+        cache.put(1, UserIdentity(100, 1))
+        cache.put(2, UserIdentity(200, 2))
+        cache.get(1)  # 2 is now the least recently used
+        cache.put(3, UserIdentity(300, 3))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(1))
+        self.assertIsNotNone(cache.get(3))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        cache = UserIdentityCache(max_size=10, ttl=60)
+        with mock.patch.object(user_model.time, 'monotonic', return_value=1000):
+            cache.put(1, UserIdentity(100, 1))
+        with mock.patch.object(user_model.time, 'monotonic', return_value=1059):
+            self.assertIsNotNone(cache.get(1))
+        with mock.patch.object(user_model.time, 'monotonic', return_value=1060):
+            self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
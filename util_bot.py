@@ -17,6 +17,8 @@ import atexit
 import builtins
 import contextlib
 import inspect
+import math
+import re
 import types
 import urllib.parse
 import importlib.util
@@ -46,6 +48,10 @@ from twitchirc import Command
 from sqlalchemy.ext.declarative import declarative_base
 
 import plugins.models.user as user_model
+import plugins.helpers.regex_budget as regex_budget
+import plugins.helpers.deadline_scheduler as deadline_scheduler
+import plugins.helpers.outbound as outbound_module
+import plugins.helpers.log_gate as log_gate_module
 import twitch_auth
 
 LOG_LEVELS = {
@@ -65,6 +71,101 @@ class Args:
     restart_from: typing.List[str]
 
 
+class CommandRegistry(list):
+    """
+    Drop-in replacement for `bot.commands` that keeps a dict index of the commands.
+
+    Commands are indexed by their `ef_command` without the trailing space, which is what the first word of a message
+    (after the prefix) needs to be equal to. Commands with a `matcher_function` and commands with spaces in their name
+    cannot be found this way, they are kept in separate lists that get checked every time.
+    """
+
+    def __init__(self, iterable=()):
+        super().__init__()
+        self.index: typing.Dict[str, typing.List[twitchirc.Command]] = {}
+        self.matchers: typing.List[twitchirc.Command] = []
+        self.unindexed: typing.List[twitchirc.Command] = []
+        self.extend(iterable)
+
+    def _add_to_index(self, command: twitchirc.Command):
+        if callable(command.matcher_function):
+            self.matchers.append(command)
+        key = command.ef_command[:-1]
+        if ' ' in key:
+            self.unindexed.append(command)
+        else:
+            self.index.setdefault(key, []).append(command)
+
+    def _remove_from_index(self, command: twitchirc.Command):
+        if command in self.matchers:
+            self.matchers.remove(command)
+        if command in self.unindexed:
+            self.unindexed.remove(command)
+        key = command.ef_command[:-1]
+        if key in self.index and command in self.index[key]:
+            self.index[key].remove(command)
+            if not self.index[key]:
+                del self.index[key]
+
+    def _rebuild_index(self):
+        self.index = {}
+        self.matchers = []
+        self.unindexed = []
+        for i in self:
+            self._add_to_index(i)
+
+    def append(self, command: twitchirc.Command) -> None:
+        super().append(command)
+        self._add_to_index(command)
+
+    def extend(self, iterable) -> None:
+        for i in iterable:
+            self.append(i)
+
+    def insert(self, index, command: twitchirc.Command) -> None:
+        super().insert(index, command)
+        self._rebuild_index()  # keep the order of commands in the buckets the same as in the list.
+
+    def remove(self, command: twitchirc.Command) -> None:
+        super().remove(command)
+        self._remove_from_index(command)
+
+    def pop(self, index=-1) -> twitchirc.Command:
+        command = super().pop(index)
+        self._remove_from_index(command)
+        return command
+
+    def clear(self) -> None:
+        super().clear()
+        self._rebuild_index()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._rebuild_index()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._rebuild_index()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def lookup(self, text: str, prefix: str) -> typing.List[twitchirc.Command]:
+        """
+        Find commands that would be triggered by `text`, this doesn't check matcher functions.
+
+        :param text: Message text, it needs to contain a space, just like with `ef_command` matching.
+        :param prefix: Prefix used in this channel.
+        :return: A list of commands, in the order they were added.
+        """
+        found = list(self.index.get(text[len(prefix):].split(' ', 1)[0], ()))
+        for handler in self.unindexed:
+            if text.startswith(prefix + handler.ef_command):
+                found.append(handler)
+        return found
+
+
 # twitchirc.logging.LOG_FORMAT = '[{time}] [TwitchIRC/{level}] {message}\n'
 # twitchirc.logging.DISPLAY_LOG_LEVELS = LOG_LEVELS
 debug = False
@@ -110,6 +211,7 @@ else:
 bot = twitchirc.Bot(address='irc.chat.twitch.tv', username='Mm_sUtilityBot', password=passwd,
                     storage=storage)
 bot.prefix = '!'
+bot.commands = CommandRegistry(bot.commands)
 del passwd
 # noinspection PyTypeHints
 bot.storage: twitchirc.JsonStorage
@@ -162,6 +264,15 @@ def _is_mod(msg: twitchirc.ChannelMessage):
     return 'moderator/1' in msg.flags['badges'] or 'broadcaster/1' in msg.flags['badges']
 
 
+# Sources that are too noisy to be logged in full by default. Levels can be changed in storage.json ('log_levels')
+# or using mb.log_level, rate limits are set in storage.json ('log_rate_limits': {"source": [lines, seconds]}).
+DEFAULT_LOG_LEVELS = {
+    'chat': 'info'
+}
+log_gate = log_gate_module.LogGate(levels={**DEFAULT_LOG_LEVELS, **bot.storage.data.get('log_levels', {})},
+                                   rate_limits=bot.storage.data.get('log_rate_limits', {}))
+
+
 def make_log_function(plugin_name: str):
     def log(level, *data, **kwargs):
         if prog_args.escalate:
@@ -169,6 +280,9 @@ def make_log_function(plugin_name: str):
                 level = 'err'
             elif level in ['err']:
                 level = 'fat'
+        # nothing gets formatted for lines that would be dropped anyway.
+        if not log_gate.allow(level, plugin_name):
+            return
         if level == 'fat':
             _print(f'[{datetime.datetime.now().strftime("%H:%M:%S")}] '
                    f'[{plugin_name}/{LOG_LEVELS[level]}] {" ".join([str(i) for i in data])}',
@@ -176,17 +290,125 @@ def make_log_function(plugin_name: str):
             bot.stop()
             exit(1)
         data = ' '.join([str(i) for i in data])
+        suppressed = log_gate.take_suppressed(plugin_name)
+        if suppressed:
+            data += f'\n({suppressed} lines were dropped by the rate limit)'
         for line in data.split('\n'):
             _print((f'[{datetime.datetime.now().strftime("%H:%M:%S")}] '
                     f'[{plugin_name}/{LOG_LEVELS[level]}] {line}'),
                    **kwargs)
 
+    log.is_enabled = lambda level: log_gate.is_enabled(level, plugin_name)
     return log
 
 
 log = make_log_function('main')
 _print = print
 print = lambda *args, **kwargs: log('info', *args, **kwargs)
+chat_log = make_log_function('chat')
+
+# Everything that needs to run at some time goes through here, the bot sleeps until the next deadline or until it
+# receives something.
+deadlines = deadline_scheduler.DeadlineScheduler(make_log_function('deadlines'))
+
+
+def _select_socket():
+    # _run_once already waited for the socket or a deadline.
+    return bool(deadlines.poll([bot.socket], 0))
+
+
+_old_run_once = bot._run_once
+
+
+async def _run_once():
+    # Wait in the event loop, not in select, so that asyncio servers and tasks run while the bot is idle.
+    # Finished command tasks are only picked up after this returns, don't wait for long while there are any.
+    if bot.socket is not None:
+        # noinspection PyProtectedMember
+        await deadlines.wait([bot.socket], 0.1 if bot._tasks else deadline_scheduler.MAX_SLEEP)
+    return await _old_run_once()
+
+
+def _schedule_event(delay, priority, function, args: tuple, kwargs: dict):
+    return deadlines.call_later(delay, function, args, kwargs, priority=priority)
+
+
+def _schedule_event_absolute(time_, priority, function, args: tuple, kwargs: dict):
+    """
+    Run `function` at `time_`, which is a `time.monotonic()` value, like with twitchirc's own scheduler.
+
+    :raises ValueError: if `time_` looks like a `time.time()` value, use `schedule_event` with a delay for those.
+    """
+    if abs(time_ - time.time()) < abs(time_ - time.monotonic()):
+        raise ValueError(f'schedule_event_absolute takes a time.monotonic() value, got what looks like a '
+                         f'time.time() value: {time_!r}')
+    return deadlines.call_at(time_, function, args, kwargs, priority=priority)
+
+
+def _schedule_repeated_event(delay, priority, function, args: tuple, kwargs: dict):
+    return deadlines.call_every(delay, function, args, kwargs, priority=priority)
+
+
+bot._select_socket = _select_socket
+bot._run_once = _run_once
+bot.schedule_event = _schedule_event
+bot.schedule_event_absolute = _schedule_event_absolute
+bot.schedule_repeated_event = _schedule_repeated_event
+
+# Outgoing messages wait here instead of bot.queue, they get sent as soon as Twitch's limits allow.
+# noinspection PyProtectedMember
+outbound = outbound_module.OutboundScheduler(bot._send, bot.message_cooldown)
+
+
+def _flush_outbound():
+    wait = 1  # retry in a second if sending is on hold or failed
+    try:
+        if not bot.hold_send:
+            _, wait = outbound.flush()
+    finally:
+        deadlines.reschedule(outbound_task, time.monotonic() + wait)
+
+
+outbound_task = deadlines.call_at(math.inf, _flush_outbound, priority=0, name='outbound')
+
+
+def _send(message: typing.Union[str, twitchirc.Message], queue='misc', priority: typing.Optional[int] = None,
+          tag=None, on_sent: typing.Optional[typing.Callable[[], typing.Any]] = None):
+    """
+    Replacement for twitchirc.Bot.send that puts messages in `outbound`.
+
+    :param priority: One of outbound_module.PRIORITY_*. By default moderation commands get PRIORITY_MODERATION,
+    everything else PRIORITY_REPLY.
+    :param tag: See OutboundScheduler.pending and OutboundScheduler.cancel.
+    :param on_sent: Called once the message was actually sent.
+    """
+    o = bot.call_middleware('send', dict(message=message, queue=queue), cancelable=True)
+    if o is False:
+        twitchirc.log('debug', str(message), ': canceled')
+        return
+
+    if isinstance(message, twitchirc.ChannelMessage):
+        if message.user == 'rcfile':
+            twitchirc.info(str(message))
+            return
+        queue = message.channel
+    if bot.socket is None and not bot.hold_send:
+        twitchirc.warn(f'Cannot queue message: {message!r}: Not connected.')
+        return
+    outbound.enqueue(queue, message.encode('utf-8') if isinstance(message, str) else bytes(message), priority,
+                     tag=tag, on_sent=on_sent)
+    deadlines.wake(outbound_task)
+
+
+def _flush_queue(max_messages: int = 1) -> int:
+    if bot.hold_send:
+        return 0
+    sent, _ = outbound.flush(max_messages)
+    return sent
+
+
+bot.send = _send
+bot.flush_queue = _flush_queue
 
 
 def do_cooldown(cmd: str, msg: twitchirc.ChannelMessage,
@@ -249,9 +471,7 @@ def new_echo_command(command_name: str, echo_data: str,
 
 
 def _is_pleb(msg: twitchirc.ChannelMessage) -> bool:
-    print(msg.flags['badges'])
     for i in (msg.flags['badges'] if isinstance(msg.flags['badges'], list) else [msg.flags['badges']]):
-        # print(i)
         if i.startswith('subscriber'):
             return False
     return True
@@ -349,6 +569,67 @@ def count_chatters(msg: twitchirc.ChannelMessage):
                        f'chatters active here in the last hour.'))
 
 
+@bot.add_command('mb.user_cache', required_permissions=['util.user_cache'], enable_local_bypass=False)
+def command_user_cache(msg: twitchirc.ChannelMessage):
+    stats = user_model.identity_cache.stats()
+    return (f'@{msg.user}, User cache: {stats["size"]}/{stats["max_size"]} entries, {stats["hits"]} hits, '
+            f'{stats["misses"]} misses ({stats["hit_rate"]:.1%} hit rate), {stats["evictions"]} evictions.')
+
+
+@bot.add_command('mb.regex_stats', required_permissions=['util.regex_stats'], enable_local_bypass=False)
+def command_regex_stats(msg: twitchirc.ChannelMessage):
+    argv = delete_spammer_chrs(msg.text).rstrip(' ').split(' ')[1:]
+    if argv and argv[0] == 'clear':
+        cleared = regex_budget.budget.clear(argv[1] if len(argv) > 1 else None)
+        return f'@{msg.user}, Cleared {cleared} bad pattern marks.'
+    elif argv:
+        return f'@{msg.user}, Usage: mb.regex_stats [clear [SOURCE]]'
+    stats = regex_budget.budget.most_expensive(5)
+    if not stats:
+        return f'@{msg.user}, No patterns were run yet.'
+    patterns = []
+    for i in stats:
+        pattern = i.pattern if len(i.pattern) <= 30 else i.pattern[:29] + '\u2026'
+        patterns.append(f'{pattern!r} ({i.source}): {i.cpu_time:.3f}s in {i.calls} calls, {i.timeouts} timeouts'
+                        f'{", BAD" if i.bad else ""}')
+    return f'@{msg.user}, Most expensive patterns: ' + '; '.join(patterns)
+
+
+@bot.add_command('mb.outbound', required_permissions=['util.outbound'], enable_local_bypass=False)
+def command_outbound(msg: twitchirc.ChannelMessage):
+    sent = ', '.join(f'{outbound_module.PRIORITY_NAMES[k]}: {v}' for k, v in outbound.sent.items())
+    return (f'@{msg.user}, {outbound.pending()} messages waiting. Sent {sent}. '
+            f'Global bucket: {outbound.global_bucket.tokens:.1f}/{outbound.global_bucket.capacity}, '
+            f'moderator/VIP in {len(outbound.elevated)} channels.')
+
+
+@bot.add_command('mb.log_level', required_permissions=['util.log_level'], enable_local_bypass=False)
+def command_log_level(msg: twitchirc.ChannelMessage):
+    argv = delete_spammer_chrs(msg.text).split(' ')[1:]
+    if len(argv) != 2 or (argv[1] not in log_gate_module.LEVELS and argv[1] != 'default'):
+        return (f'@{msg.user}, Usage: mb.log_level SOURCE LEVEL, LEVEL is one of '
+                f'{", ".join(log_gate_module.LEVELS)} or default.')
+    source, level = argv
+    levels = bot.storage.data.setdefault('log_levels', {})
+    if level == 'default':
+        level = DEFAULT_LOG_LEVELS.get(source)
+        levels.pop(source, None)
+    else:
+        levels[source] = level
+    bot.storage.save()
+    log_gate.set_level(source, level)
+    return f'@{msg.user}, Log level for {source} is now {level or "default"}.'
+
+
+@bot.add_command('mb.tasks', required_permissions=['util.tasks'], enable_local_bypass=False)
+def command_tasks(msg: twitchirc.ChannelMessage):
+    tasks = []
+    for i in deadlines.stats()[:5]:
+        tasks.append(f'{i.name}: {i.runs} runs, {i.total_time * 1000:.0f}ms total, {i.max_time * 1000:.1f}ms max'
+                     f'{f", {i.errors} errors" if i.errors else ""}')
+    return f'@{msg.user}, Most expensive tasks: ' + '; '.join(tasks)
+
+
 counters = {}
 
 
@@ -548,29 +829,44 @@ def check_quick_clips():
             tasks.remove(i)
 
 
+USERSTATE_PATTERN = re.compile(r'^@(?P<tags>\S+) :tmi\.twitch\.tv USERSTATE #(?P<channel>\S+)')
+ELEVATED_BADGES = ('broadcaster', 'moderator', 'vip')
+
+
+def _check_userstate(msg: twitchirc.Message):
+    m = USERSTATE_PATTERN.match(msg.args)
+    if not m:
+        return
+    tags = dict(i.split('=', 1) for i in m.group('tags').split(';') if '=' in i)
+    badges = [i.split('/', 1)[0] for i in tags.get('badges', '').split(',')]
+    outbound.set_elevated(m.group('channel'), any(i in badges for i in ELEVATED_BADGES))
+
+
 def any_msg_handler(event: str, msg: twitchirc.Message, *args):
-    del event, args, msg
+    del event, args
+    if type(msg) is twitchirc.Message:
+        _check_userstate(msg)
     check_quick_clips()
 
 
 def chat_msg_handler(event: str, msg: twitchirc.ChannelMessage, *args):
     global plebs
-    user = User.get_by_message(msg, no_create=False)
+    user = User.get_identity(msg)
     user.schedule_update(msg)
 
     if _is_pleb(msg):
         if msg.channel not in plebs:
             plebs[msg.channel] = {}
         plebs[msg.channel][msg.user] = time.time() + 60 * 60
-        print(event, '(pleb)', msg)
+        chat_log('debug', event, '(pleb)', msg)
     else:
         if msg.channel not in subs:
             subs[msg.channel] = {}
         subs[msg.channel][msg.user] = time.time() + 60 * 60
-        print(event, '(sub)', msg)
+        chat_log('debug', event, '(sub)', msg)
 
 
-bot.schedule_repeated_event(0.1, 100, flush_users, args=(), kwargs={})
+deadlines.call_every(1, flush_users, name='flush_users')
 
 
 class PluginStorage:
@@ -681,17 +977,11 @@ def command_restart(msg: twitchirc.ChannelMessage):
         return
     bot.send(msg.reply(f'Restarting MrDestructoid {chr(128299)}'))
     # Restaring MrDestructoid :gun:
-    print('.')
-    while 1:
-        print(f'\033[A\033[KFlushing queues... Non-empty queues: {list(filter(lambda i: bool(i), bot.queue))}')
-        bot.flush_queue(1000)
-        all_empty = True
-        for q in bot.queue:
-            if bot.queue[q]:
-                all_empty = False
-        if all_empty:
-            break
-    print('\033[A\033[KFlushing queues: DONE!')
+    print(f'Flushing queues, {outbound.pending()} messages waiting...')
+    if outbound.drain(30):
+        print('Flushing queues: DONE!')
+    else:
+        print(f'Flushing queues: timed out, dropping {outbound.pending()} messages.')
     time.sleep(1)
 
     bot.stop()
@@ -991,7 +1281,7 @@ finally:
     for k, v in user_model.cached_users.items():
         user_model.cached_users[k]['expire_time'] = 0
     user_model.users_lock.release()
-    flush_users()
+    flush_users(wait=True)
     print('flush cached users: done')
     print('update channels and counters')
     bot.storage.auto_save = False
@@ -246,7 +246,7 @@ def test():
     return 'KKaper Test successful KKaper'
 
 
-ipc_conn = ipc.Connection('../ipc_server')
+ipc_conn = ipc.Connection('../ipc_server', binary=True)
 ipc_conn.max_recv = 32_768  # should capture even the biggest json message.
 time.sleep(0.5)  # wait for the welcome burst to come in fully.
 ipc_conn.receive()  # receive the welcome burst
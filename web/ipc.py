@@ -16,17 +16,32 @@
 import json
 import select
 import socket
+import struct
+import time
 from typing import List, Tuple
 
 import typing
 
+# Binary mode framing, same as in plugins/plugin_ipc.py
+FRAME_HEADER = struct.Struct('>IB')
+KIND_COMMAND = ord('>')
+FRAME_KINDS = {
+    ord('~'): 'output',
+    ord('%'): 'command_output',
+    ord('!'): 'error',
+    ord('$'): 'json',
+}
+BINARY_CONFIRMATION = b'~Switched to binary mode.'
+
 
 class Connection:
-    def __init__(self, address='ipc_server'):
+    def __init__(self, address='ipc_server', binary=False):
         self.address = address
         self.max_recv = 8192
         self.buf = b''
         self.sock = None
+        self.use_binary = binary
+        self.binary = False  # True once the server confirmed the switch
         self.connect()
 
     def reconnect(self):
@@ -36,10 +51,18 @@ class Connection:
     def connect(self):
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sock.connect(self.address)
+        self.buf = b''
+        self.binary = False
+        if self.use_binary:
+            # the server switches modes before reading anything else, so framed commands can follow right away.
+            self.sock.send(b'binary\r\n')
 
     def command(self, command: bytes, no_reconnect=False):
         try:
-            self.sock.send(command + b'\r\n')
+            if self.use_binary:
+                self.sock.send(FRAME_HEADER.pack(len(command), KIND_COMMAND) + command)
+            else:
+                self.sock.send(command + b'\r\n')
         except BrokenPipeError:
             if no_reconnect:
                 raise
@@ -67,28 +90,79 @@ class Connection:
                 return None
 
     def decode(self, data: bytes) -> List[Tuple[str, str]]:
-        lines = (self.buf + data).split(b'\r\n')
-        self.buf = b''
-        if lines[-1] != '':
-            self.buf += lines.pop()
+        self.buf += data
         messages: List[Tuple[str, str]] = []
-        for line in lines:
-            line = line.decode('utf-8')
-            if line.startswith('~~'):
-                messages.append(('command_output', line[2:]))
-            elif line.startswith('~'):
-                messages.append(('output', line[1:]))
-            elif line.startswith('!'):
-                messages.append(('error', line[1:]))
-            elif line.startswith('$'):
-                try:
-                    messages.append(('json', json.loads(line[1:])))
-                except:
-                    messages.append(('failed_json', line[1:]))
+        while not self.binary:
+            end = self.buf.find(b'\r\n')
+            if end == -1:
+                return messages
+            line = self.buf[:end]
+            self.buf = self.buf[end + 2:]
+            if self.use_binary and line == BINARY_CONFIRMATION:
+                self.binary = True  # everything after this is framed
+            else:
+                messages.append(self._decode_line(line.decode('utf-8')))
+
+        offset = 0
+        while len(self.buf) - offset >= FRAME_HEADER.size:
+            length, kind = FRAME_HEADER.unpack_from(self.buf, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > len(self.buf):
+                break
+            payload = self.buf[offset + FRAME_HEADER.size:end].decode('utf-8')
+            offset = end
+            kind = FRAME_KINDS.get(kind, 'unknown')
+            if kind == 'json':
+                messages.append(self._decode_json(payload))
             else:
-                messages.append(('unknown', line))
+                messages.append((kind, payload))
+        self.buf = self.buf[offset:]
         return messages
 
+    @staticmethod
+    def _decode_json(data: str) -> Tuple[str, typing.Any]:
+        try:
+            return 'json', json.loads(data)
+        except:
+            return 'failed_json', data
+
+    def _decode_line(self, line: str) -> Tuple[str, typing.Any]:
+        if line.startswith('~~'):
+            return 'command_output', line[2:]
+        elif line.startswith('~'):
+            return 'output', line[1:]
+        elif line.startswith('!'):
+            return 'error', line[1:]
+        elif line.startswith('$'):
+            return self._decode_json(line[1:])
+        else:
+            return 'unknown', line
+
+    def get_users(self, by: str, keys: typing.Iterable[typing.Union[int, str]],
+                  timeout: float = 10) -> typing.List[dict]:
+        """
+        Look up many users with one request.
+
+        :param by: 'id' for Twitch ids, 'alias' for the bot's ids or 'name' for user names.
+        :raises ValueError: if the bot refused the request or failed to handle it.
+        :raises TimeoutError: if the bot didn't respond within `timeout` seconds.
+        """
+        source = f'get_users_by_{by}'
+        self.command(f'{source} {",".join(str(i) for i in keys)}'.encode('utf-8'))
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.sock], [], [], remaining)[0]:
+                raise TimeoutError(f'The bot didn\'t respond to {source} in {timeout} seconds.')
+            for kind, data in self.receive():
+                if kind != 'json':
+                    continue
+                # internal errors come from the command handler, not the command
+                if data.get('type') == 'error' and data.get('source') in (source, 'command_handler'):
+                    raise ValueError(data['message'])
+                if data.get('source') == source:
+                    return data['data']
+
     def close(self):
         self.command(b'quit')
         self.sock.close()
@@ -16,6 +16,7 @@
 import sqlalchemy
 from flask import abort, jsonify
 from sqlalchemy import text
+from sqlalchemy.orm import joinedload
 
 try:
     from plugins.models import suggestion as suggestion_model
@@ -163,7 +164,9 @@ def init(register_endpoint, ipc_conn, main_module):
             suggestion_query = (session.query(Suggestion)
                                 .filter(Suggestion.is_hidden == False))
             count = suggestion_query.count()
-            suggestions = (suggestion_query.offset(page * main_module.PAGE_SIZE)
+            # load the authors in the same query, not one by one while building the response
+            suggestions = (suggestion_query.options(joinedload(Suggestion.author))
+                           .offset(page * main_module.PAGE_SIZE)
                            .limit(main_module.PAGE_SIZE)
                            .all())
             return jsonify({